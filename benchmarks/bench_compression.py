@@ -0,0 +1,65 @@
+"""
+Response Compression Benchmark
+
+Measures the bytes saved and the CPU spent compressing a list response
+of 10k inventory items at several gzip and brotli levels.
+
+Usage:
+    python -m benchmarks.bench_compression [--items 10000] [--repeat 5]
+"""
+import json
+import time
+import argparse
+from service.common.compression import GzipCompressor, BrotliCompressor
+from tests.factories import InventoryFactory
+
+LEVELS = [
+    ("gzip", GzipCompressor, 1),
+    ("gzip", GzipCompressor, 6),
+    ("gzip", GzipCompressor, 9),
+    ("br", BrotliCompressor, 1),
+    ("br", BrotliCompressor, 4),
+    ("br", BrotliCompressor, 9),
+]
+
+
+def build_payload(count: int) -> bytes:
+    """Builds a list response body like GET /api/inventory returns"""
+    items = []
+    for item_id, item in enumerate(InventoryFactory.build_batch(count), start=1):
+        item.id = item_id
+        items.append(item.serialize())
+    return json.dumps(items).encode("utf-8")
+
+
+def measure(compressor_class, level: int, payload: bytes, repeat: int):
+    """Returns the compressed size and the best CPU time in milliseconds"""
+    best = None
+    size = 0
+    for _ in range(repeat):
+        start = time.process_time()
+        compressor = compressor_class(level)
+        size = len(compressor.compress(payload) + compressor.finish())
+        elapsed = (time.process_time() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return size, best
+
+
+def main():
+    """Runs the benchmark and prints a table of results"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--items", type=int, default=10000, help="number of items in the payload")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per level, the best one is kept")
+    options = parser.parse_args()
+
+    payload = build_payload(options.items)
+    print(f"Uncompressed payload: {len(payload):,} bytes for {options.items:,} items")
+    print(f"{'encoding':<10}{'level':>6}{'bytes':>12}{'ratio':>8}{'cpu ms':>10}{'MB/s':>10}")
+    for name, compressor_class, level in LEVELS:
+        size, cpu_ms = measure(compressor_class, level, payload, options.repeat)
+        throughput = len(payload) / 1e6 / (cpu_ms / 1000) if cpu_ms else float("inf")
+        print(f"{name:<10}{level:>6}{size:>12,}{len(payload) / size:>8.1f}{cpu_ms:>10.2f}{throughput:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
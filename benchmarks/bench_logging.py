@@ -0,0 +1,122 @@
+"""
+Logging Overhead Benchmark
+
+Measures what logging adds to the latency of a request by reading one item
+through the REST API with logging turned off, with the text handlers
+writing in the request thread, and with LOG_FORMAT=json writing from the
+queue listener thread. Every mode runs in its own process and logs to a
+file in a temporary directory; the drain column is the time the listener
+needed to write what was still queued when the requests ended.
+--write-delay makes every write block for that many microseconds, like a
+stdout pipe to a log collector that is falling behind.
+
+Usage:
+    DATABASE_URI=sqlite:///bench.db python -m benchmarks.bench_logging [--requests 2000] [--repeat 5]
+        [--write-delay 0]
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import tempfile
+import subprocess
+
+# name, LOG_FORMAT, gunicorn log level
+MODES = [("off", "text", logging.WARNING), ("text", "text", logging.INFO), ("json", "json", logging.INFO)]
+WARMUP = 100
+
+
+class SlowFileHandler(logging.FileHandler):
+    """A file handler whose writes block for a while"""
+
+    def __init__(self, path: str, delay: float):
+        super().__init__(path)
+        self.write_delay = delay
+
+    def emit(self, record):
+        time.sleep(self.write_delay)
+        super().emit(record)
+
+
+def measure(client, url: str, requests: int, repeat: int) -> float:
+    """Returns the best mean latency of a request in microseconds"""
+    for _ in range(WARMUP):
+        client.get(url)
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(requests):
+            client.get(url)
+        elapsed = (time.perf_counter() - start) / requests
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1e6
+
+
+def run_mode(level: int, path: str, options) -> dict:
+    """Builds the app with LOG_FORMAT from the environment and times item reads"""
+    # pylint: disable=import-outside-toplevel
+    gunicorn_logger = logging.getLogger("gunicorn.error")
+    gunicorn_logger.handlers = [SlowFileHandler(path, options.write_delay / 1e6)]
+    gunicorn_logger.setLevel(level)
+    from service import create_app
+    from service.models import Inventory
+    from tests.factories import InventoryFactory
+
+    app = create_app()
+    with app.app_context():
+        Inventory.remove_all()
+        item = InventoryFactory()
+        item.id = None
+        item.create()
+        url = f"/api/inventory/{item.id}"
+    latency = measure(app.test_client(), url, options.requests, options.repeat)
+    start = time.perf_counter()
+    if "log_queue_handler" in app.extensions:
+        app.extensions["log_queue_handler"].stop()
+    drain = (time.perf_counter() - start) * 1000
+    with app.app_context():
+        Inventory.remove_all()
+    with open(path, encoding="utf-8") as file:
+        lines = sum(1 for _ in file)
+    return {"latency": latency, "lines": lines, "drain": drain}
+
+
+def main():
+    """Runs every mode in its own process and prints a table of results"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000, help="requests per run")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per mode, the best one is kept")
+    parser.add_argument("--write-delay", type=float, default=0, help="microseconds each log write blocks")
+    parser.add_argument("--mode", help=argparse.SUPPRESS)
+    parser.add_argument("--log", help=argparse.SUPPRESS)
+    options = parser.parse_args()
+
+    if options.mode:
+        level = {name: level for name, _, level in MODES}[options.mode]
+        print(json.dumps(run_mode(level, options.log, options)))
+        return
+
+    print(f"{'logging':<10}{'us/request':>12}{'overhead us':>13}{'lines':>8}{'drain ms':>10}")
+    baseline = None
+    with tempfile.TemporaryDirectory() as directory:
+        for name, log_format, _ in MODES:
+            # a process per mode, since the app and its routes are only built once per process
+            output = subprocess.run(
+                [sys.executable, "-m", "benchmarks.bench_logging", "--mode", name,
+                 "--log", os.path.join(directory, f"{name}.log"),
+                 "--requests", str(options.requests), "--repeat", str(options.repeat),
+                 "--write-delay", str(options.write_delay)],
+                env=dict(os.environ, LOG_FORMAT=log_format), capture_output=True, text=True, check=True,
+            ).stdout
+            result = json.loads(output.splitlines()[-1])
+            baseline = baseline or result["latency"]
+            print(
+                f"{name:<10}{result['latency']:>12.1f}{result['latency'] - baseline:>13.1f}"
+                f"{result['lines']:>8}{result['drain']:>10.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
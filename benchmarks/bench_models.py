@@ -0,0 +1,118 @@
+"""
+Model Micro-Benchmarks
+
+Times Inventory.serialize(), Inventory.deserialize() and Inventory.search()
+with 1, 1k and 100k items and records the peak memory of each run, measured
+with tracemalloc, next to the timings. Runs are saved per commit by
+pytest-benchmark so that later commits can be compared against them.
+
+Usage:
+    DATABASE_URI=sqlite:///bench.db pytest benchmarks/bench_models.py --no-cov --benchmark-autosave
+    DATABASE_URI=sqlite:///bench.db pytest benchmarks/bench_models.py --no-cov --benchmark-compare
+"""
+import logging
+import tracemalloc
+import pytest
+from wsgi import app
+from service.models import db, Inventory, InventoryChange, Reservation
+from tests.factories import InventoryFactory
+
+SIZES = [1, 1_000, 100_000]
+SEED_CHUNK = 5_000
+
+
+def rounds(size: int) -> int:
+    """Returns how many rounds to time, fewer for the large sizes"""
+    return 100 if size == 1 else 20 if size <= 1_000 else 3
+
+
+def record_memory(benchmark, function, *args):
+    """Runs the function once under tracemalloc and saves its peak memory"""
+    tracemalloc.start()
+    try:
+        function(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    benchmark.extra_info["peak_bytes"] = peak
+    benchmark.extra_info["peak_bytes_per_item"] = peak // benchmark.extra_info["items"]
+
+
+@pytest.fixture(scope="module", autouse=True)
+def context():
+    """Runs the benchmarks in an application context"""
+    app.logger.setLevel(logging.CRITICAL)
+    with app.app_context():
+        yield
+
+
+@pytest.fixture(scope="module")
+def seeded():
+    """Loads the largest number of items once and removes them afterwards"""
+    remove_items()
+    for _ in range(0, max(SIZES), SEED_CHUNK):
+        Inventory.bulk_upsert([item.to_row() for item in InventoryFactory.build_batch(SEED_CHUNK)])
+    yield
+    remove_items()
+
+
+def remove_items():
+    """Deletes every item and the changes recorded for them"""
+    db.session.query(Reservation).delete()
+    db.session.query(Inventory).delete()
+    db.session.query(InventoryChange).delete()
+    db.session.commit()
+
+
+######################################################################
+#  B E N C H M A R K S
+######################################################################
+@pytest.mark.parametrize("size", SIZES)
+def test_serialize(benchmark, size):
+    """Serializes items into dictionaries"""
+    items = InventoryFactory.build_batch(size)
+
+    def serialize():
+        return [item.serialize() for item in items]
+
+    benchmark.extra_info["items"] = size
+    record_memory(benchmark, serialize)
+    assert len(benchmark.pedantic(serialize, rounds=rounds(size))) == size
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_deserialize(benchmark, size):
+    """Deserializes and validates payloads into items"""
+    payloads = [item.serialize() for item in InventoryFactory.build_batch(size)]
+
+    def deserialize():
+        return [Inventory().deserialize(payload) for payload in payloads]
+
+    benchmark.extra_info["items"] = size
+    record_memory(benchmark, deserialize)
+    assert len(benchmark.pedantic(deserialize, rounds=rounds(size))) == size
+
+
+def test_search_construction(benchmark):
+    """Builds and compiles a query with every filter without running it"""
+    args = {"name": "Apple 1", "category": "Fruits", "quantity": 20, "condition": "NEW", "restock_level": 100}
+
+    def construct():
+        return str(Inventory.search(args).statement.compile(db.engine))
+
+    benchmark.extra_info["items"] = 1
+    record_memory(benchmark, construct)
+    assert "WHERE" in benchmark.pedantic(construct, rounds=rounds(1))
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_search(benchmark, size, seeded):  # pylint: disable=unused-argument, redefined-outer-name
+    """Runs a search returning size items"""
+    args = {"name": None, "category": None, "quantity": None, "condition": None, "restock_level": None}
+
+    def search():
+        return Inventory.search(args).limit(size).all()
+
+    benchmark.extra_info["items"] = size
+    record_memory(benchmark, search)
+    assert len(benchmark.pedantic(search, rounds=rounds(size))) == size
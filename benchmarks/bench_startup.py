@@ -0,0 +1,52 @@
+"""
+Startup Benchmark
+
+Measures how long it takes to import the service and build the app with
+and without creating the schema on startup. Every run is a fresh
+interpreter so that import time is included.
+
+Usage:
+    DATABASE_URI=sqlite:///bench.db python -m benchmarks.bench_startup [--repeat 5]
+"""
+import os
+import sys
+import argparse
+import statistics
+import subprocess
+
+PROBE = """
+import time
+start = time.perf_counter()
+from service import create_app
+create_app()
+print(time.perf_counter() - start)
+"""
+
+
+def measure(create_on_startup: bool, repeat: int) -> list:
+    """Returns the startup times in milliseconds of repeat fresh processes"""
+    env = dict(os.environ, DB_CREATE_ON_STARTUP=str(create_on_startup).lower())
+    timings = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, "-c", PROBE], env=env, check=True, capture_output=True, text=True
+        ).stdout
+        timings.append(float(output.strip().splitlines()[-1]) * 1000)
+    return timings
+
+
+def main():
+    """Runs the benchmark and prints the median and worst startup times"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5, help="number of fresh processes per mode")
+    options = parser.parse_args()
+
+    print(f"{'mode':<28}{'median ms':>12}{'max ms':>10}")
+    for create_on_startup in (True, False):
+        timings = measure(create_on_startup, options.repeat)
+        mode = f"DB_CREATE_ON_STARTUP={str(create_on_startup).lower()}"
+        print(f"{mode:<28}{statistics.median(timings):>12.1f}{max(timings):>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+Payload Validation Benchmark
+
+Compares the CPU spent validating inventory payloads by running the
+flask-restx JSON Schema check before Inventory.deserialize(), as
+@api.expect(..., validate=True) would, against the precompiled validator
+alone, one payload at a time and as a batch.
+
+Usage:
+    python -m benchmarks.bench_validation [--payloads 10000] [--repeat 5]
+"""
+import time
+import argparse
+from wsgi import app  # noqa: F401 pylint: disable=unused-import
+from service.models import Inventory
+from service.routes import inventory_item
+from tests.factories import InventoryFactory
+
+
+def jsonschema_and_deserialize(payloads: list):
+    """Validates with JSON Schema, then deserializes every payload"""
+    for payload in payloads:
+        inventory_item.validate(payload)
+        Inventory().deserialize(payload)
+
+
+def deserialize(payloads: list):
+    """Validates and deserializes every payload with the precompiled validator"""
+    for payload in payloads:
+        Inventory().deserialize(payload)
+
+
+def deserialize_many(payloads: list):
+    """Validates the payloads in one pass, then deserializes them"""
+    Inventory.deserialize_many(payloads)
+
+
+CANDIDATES = [
+    ("jsonschema + deserialize", jsonschema_and_deserialize),
+    ("deserialize", deserialize),
+    ("deserialize_many", deserialize_many),
+]
+
+
+def measure(function, payloads: list, repeat: int) -> float:
+    """Returns the best CPU time per payload in microseconds"""
+    best = None
+    for _ in range(repeat):
+        start = time.process_time()
+        function(payloads)
+        elapsed = time.process_time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(payloads) * 1e6
+
+
+def main():
+    """Runs the benchmark and prints a table of results"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--payloads", type=int, default=10000, help="number of payloads to validate")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per candidate, the best one is kept")
+    options = parser.parse_args()
+
+    payloads = []
+    for item in InventoryFactory.build_batch(options.payloads):
+        payload = item.serialize()
+        del payload["id"]
+        payloads.append(payload)
+    print(f"{'validation':<28}{'cpu us/payload':>16}{'speedup':>10}")
+    baseline = None
+    for name, function in CANDIDATES:
+        cpu_us = measure(function, payloads, options.repeat)
+        baseline = baseline or cpu_us
+        print(f"{name:<28}{cpu_us:>16.2f}{baseline / cpu_us:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+"""
+REST API Load Test
+
+Seeds the inventory with factory items and drives every endpoint at a
+given concurrency, then reports the p50/p95/p99 latency and throughput
+of each one. Results can be saved as a baseline and later runs compared
+against it, failing when the p50, p95 or throughput of an endpoint
+regresses beyond the tolerance or an endpoint returns unexpected errors.
+Baselines are only comparable on the same machine and database.
+
+Without --url the app is served in-process from DATABASE_URI (SQLite or
+PostgreSQL); with --url the service must be running with TESTING enabled
+so that the inventory can be cleared before seeding.
+
+Usage:
+    DATABASE_URI=sqlite:///bench.db python -m benchmarks.load_test [--items 1000]
+        [--requests 500] [--concurrency 8] [--save benchmarks/baseline.json]
+        [--baseline benchmarks/baseline.json] [--tolerance 0.25]
+"""
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from tests.factories import InventoryFactory
+
+SEED_CHUNK = 500
+WARMUP = 20
+
+# a process-wide counter keeps the names of created items unique
+_names = itertools.count()
+_local = threading.local()
+
+
+def session() -> requests.Session:
+    """Returns the HTTP session of the current thread"""
+    if not hasattr(_local, "session"):
+        _local.session = requests.Session()
+    return _local.session
+
+
+######################################################################
+# Scenarios: each takes the API url and an item and returns a response
+######################################################################
+def get_item(api, item):
+    """Reads one item"""
+    return session().get(f"{api}/inventory/{item['id']}")
+
+
+def list_filtered(api, item):
+    """Lists the items of a category in a condition"""
+    return session().get(f"{api}/inventory", params={"category": item["category"], "condition": item["condition"]})
+
+
+def create_item(api, item):
+    """Creates a new item with a unique name"""
+    payload = dict(item, inventory_name=f"load-test {next(_names)}")
+    del payload["id"]
+    return session().post(f"{api}/inventory", json=payload)
+
+
+def update_item(api, item):
+    """Replaces an item with a new quantity"""
+    return session().put(f"{api}/inventory/{item['id']}", json=dict(item, quantity=random.randint(0, 100)))
+
+
+def restock_item(api, item):
+    """Restocks an item below its restock level (each item only once)"""
+    return session().put(f"{api}/inventory/{item['id']}/restock")
+
+
+def delete_item(api, item):
+    """Deletes an item (each item only once)"""
+    return session().delete(f"{api}/inventory/{item['id']}")
+
+
+# name, function, expected status, whether the scenario uses up its items
+SCENARIOS = [
+    ("get", get_item, 200, False),
+    ("list", list_filtered, 200, False),
+    ("create", create_item, 201, False),
+    ("put", update_item, 200, False),
+    ("restock", restock_item, 200, True),
+    ("delete", delete_item, 204, True),
+]
+
+
+######################################################################
+# Seeding and measuring
+######################################################################
+def seed(api: str, count: int, rng: random.Random) -> list:
+    """Clears the inventory and creates count items, returning them"""
+    response = session().delete(f"{api}/inventory")
+    response.raise_for_status()
+    if session().get(f"{api}/inventory", params={"count_only": "true"}).json()["count"]:
+        sys.exit("The inventory could not be cleared, run the service with TESTING enabled")
+    items = []
+    for start in range(0, count, SEED_CHUNK):
+        chunk = []
+        for item in InventoryFactory.build_batch(min(SEED_CHUNK, count - start)):
+            payload = item.serialize()
+            del payload["id"]
+            # below the restock level so that every item can be restocked once
+            payload["restock_level"] = rng.randint(50, 150)
+            payload["quantity"] = rng.randint(0, payload["restock_level"])
+            chunk.append(payload)
+        response = session().post(f"{api}/inventory/upsert", json=chunk)
+        response.raise_for_status()
+        items.extend(response.json())
+    return items
+
+
+def percentile(latencies: list, fraction: float) -> float:
+    """Returns a percentile of sorted latencies by the nearest rank"""
+    return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))]
+
+
+def run_scenario(api: str, function, expected: int, items: list, concurrency: int) -> dict:
+    """Runs one request per item and returns the latency and throughput statistics"""
+
+    def timed(item):
+        start = time.perf_counter()
+        response = function(api, item)
+        return time.perf_counter() - start, response.status_code == expected
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(timed, items))
+    elapsed = time.perf_counter() - started
+    latencies = sorted(latency * 1000 for latency, _ in results)
+    return {
+        "requests": len(results),
+        "errors": sum(1 for _, ok in results if not ok),
+        "p50": round(percentile(latencies, 0.50), 2),
+        "p95": round(percentile(latencies, 0.95), 2),
+        "p99": round(percentile(latencies, 0.99), 2),
+        "throughput": round(len(results) / elapsed, 1),
+    }
+
+
+def run(api: str, options) -> dict:
+    """Seeds the inventory and runs every scenario in turn"""
+    rng = random.Random(options.seed)
+    random.seed(options.seed)
+    consumed = sum(1 for scenario in SCENARIOS if scenario[3])
+    items = seed(api, options.items + consumed * (options.requests + WARMUP), rng)
+    shared, spare = items[: options.items], items[options.items:]
+    results = {}
+    for name, function, expected, uses_up in SCENARIOS:
+        if uses_up:
+            pool, spare = spare[: options.requests + WARMUP], spare[options.requests + WARMUP:]
+        else:
+            pool = [rng.choice(shared) for _ in range(options.requests + WARMUP)]
+        run_scenario(api, function, expected, pool[:WARMUP], options.concurrency)
+        results[name] = run_scenario(api, function, expected, pool[WARMUP:], options.concurrency)
+    return results
+
+
+######################################################################
+# Reporting
+######################################################################
+def regressions(results: dict, baseline: dict, tolerance: float) -> list:
+    """Returns a description of every metric worse than the baseline allows"""
+    found = []
+    for name, result in results.items():
+        if result["errors"]:
+            found.append(f"{name}: {result['errors']} unexpected responses")
+        if name not in baseline:
+            continue
+        # p99 is reported but too noisy at these sample sizes to gate on
+        for metric in ("p50", "p95"):
+            if result[metric] > baseline[name][metric] * (1 + tolerance):
+                found.append(f"{name}: {metric} {result[metric]:.1f} ms > baseline {baseline[name][metric]:.1f} ms")
+        if result["throughput"] < baseline[name]["throughput"] * (1 - tolerance):
+            found.append(
+                f"{name}: throughput {result['throughput']:.0f}/s < baseline {baseline[name]['throughput']:.0f}/s"
+            )
+    return found
+
+
+def report(results: dict):
+    """Prints a table of results"""
+    print(f"{'endpoint':<10}{'requests':>9}{'errors':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'req/s':>9}")
+    for name, result in results.items():
+        print(
+            f"{name:<10}{result['requests']:>9}{result['errors']:>8}{result['p50']:>9.1f}"
+            f"{result['p95']:>9.1f}{result['p99']:>9.1f}{result['throughput']:>9.0f}"
+        )
+
+
+def serve():
+    """Serves the app in a background thread and returns the API url"""
+    # pylint: disable=import-outside-toplevel
+    import logging
+    from werkzeug.serving import make_server
+    from wsgi import app
+    from service.common.admission import admission
+
+    app.config["TESTING"] = True
+    # the server runs a thread per client rather than the fixed threads of a
+    # gunicorn worker that the admission limits are sized for
+    admission.enabled = False
+    app.logger.setLevel(logging.WARNING)
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}/api"
+
+
+def main():
+    """Runs the load test, reports and compares the results"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="API root of a running service, e.g. http://localhost:8080/api")
+    parser.add_argument("--items", type=int, default=1000, help="number of items to seed")
+    parser.add_argument("--requests", type=int, default=500, help="measured requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent clients")
+    parser.add_argument("--seed", type=int, default=42, help="random seed for reproducible runs")
+    parser.add_argument("--save", help="write the results to this baseline file")
+    parser.add_argument("--baseline", help="compare the results against this baseline file")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown relative to the baseline")
+    options = parser.parse_args()
+
+    api = options.url or serve()
+    results = run(api, options)
+    report(results)
+    if options.save:
+        with open(options.save, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+        print(f"Saved baseline to {options.save}")
+    baseline = {}
+    if options.baseline:
+        with open(options.baseline, encoding="utf-8") as file:
+            baseline = json.load(file)
+    found = regressions(results, baseline, options.tolerance)
+    for regression in found:
+        print(f"REGRESSION {regression}")
+    sys.exit(1 if found else 0)
+
+
+if __name__ == "__main__":
+    main()
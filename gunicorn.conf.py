@@ -0,0 +1,23 @@
+"""
+Gunicorn configuration
+
+With GUNICORN_PRELOAD=true the app is built once in the master before the
+workers are forked. Connections opened while building it must not be
+shared by the workers, so every worker starts with a fresh pool.
+"""
+import os
+import sys
+
+preload_app = os.getenv("GUNICORN_PRELOAD", "false").lower() == "true"
+
+
+def post_fork(server, worker):  # pylint: disable=unused-argument
+    """Drops the database connections inherited from the master"""
+    wsgi = sys.modules.get("wsgi")
+    if wsgi is None:
+        return
+    # pylint: disable=import-outside-toplevel
+    from service.models import db
+
+    with wsgi.app.app_context():
+        db.engine.dispose(close=False)
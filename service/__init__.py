@@ -21,8 +21,9 @@ and SQL database
 import sys
 from flask import Flask
 from flask_restx import Api
+from werkzeug.middleware.proxy_fix import ProxyFix
 from service import config
-from service.common import log_handlers
+from service.common import log_handlers, compression, tracing, resilience, cache
 
 # Will be initialize when app is created
 api = None  # pylint: disable=invalid-name
@@ -37,6 +38,9 @@ def create_app():
     # Create Flask application
     app = Flask(__name__)
     app.config.from_object(config)
+    if app.config["TRUSTED_PROXIES"]:
+        # take the client address from the X-Forwarded-For entries the proxies added
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config["TRUSTED_PROXIES"])
 
     app.url_map.strict_slashes = False
 
@@ -45,6 +49,11 @@ def create_app():
     from service.models import db
 
     db.init_app(app)
+    # first, so that the request span covers the other request hooks
+    tracing.init_tracing(app)
+    resilience.init_resilience(app)
+    cache.init_cache(app)
+    compression.init_compression(app)
 
     # Configure Swagger before initializing it
     global api
@@ -64,14 +73,20 @@ def create_app():
         # pylint: disable=wrong-import-position, wrong-import-order, unused-import
         from service import routes, models  # noqa: F401 E402
         from service.common import error_handlers, cli_commands  # noqa: F401, E402
+        from service.common import idempotency, adjustments, reservations, change_log, events  # noqa: E402
+        from service.common import health, admission, rate_limit, timeouts  # noqa: E402
 
-        # try creating all tables of db
-        try:
-            db.create_all()
-        except Exception as error:  # pylint: disable=broad-except
-            app.logger.critical("%s: Cannot continue", error)
-            # gunicorn requires exit code 4 to stop spawning workers when they die
-            sys.exit(4)
+        health.init_health(app)
+        rate_limit.init_rate_limit(app)
+        admission.init_admission(app)
+        timeouts.init_timeouts(app)
+        idempotency.init_idempotency(app)
+        adjustments.init_adjustments(app)
+        reservations.init_reservations(app)
+        change_log.init_change_log(app)
+        events.init_events(app)
+
+        init_db(app)
 
         # Set up logging for production
         log_handlers.init_logging(app, "gunicorn.error")
@@ -83,3 +98,27 @@ def create_app():
         app.logger.info("Service initialized!")
 
         return app
+
+
+def init_db(app):
+    """Creates the tables and applies any pending migrations on startup
+
+    Set DB_CREATE_ON_STARTUP=false to boot workers without touching the
+    schema, and run `flask db-upgrade` once per deploy instead
+    """
+    # pylint: disable=import-outside-toplevel
+    from service import migrations
+
+    if not app.config["DB_CREATE_ON_STARTUP"]:
+        app.logger.info("Skipping schema creation on startup")
+        return
+
+    # try creating all tables of db and bringing them up to date
+    try:
+        applied = migrations.upgrade(None, app.config["MIGRATION_LOCK_TIMEOUT"], app.config["MIGRATION_BATCH_SIZE"])
+    except Exception as error:  # pylint: disable=broad-except
+        app.logger.critical("%s: Cannot continue", error)
+        # gunicorn requires exit code 4 to stop spawning workers when they die
+        sys.exit(4)
+    for revision in applied:
+        app.logger.info("Applied schema revision %d", revision)
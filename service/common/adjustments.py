@@ -0,0 +1,126 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Quantity Adjustments
+
+This module buffers quantity deltas in memory, merges them per item and
+writes them behind the requests in batched UPDATE statements
+"""
+import atexit
+import logging
+import threading
+from service.models import Inventory, DataValidationError
+from service.common.background import PeriodicTask
+
+logger = logging.getLogger("flask.app")
+
+
+class AdjustmentBuffer:
+    """Coalesces quantity deltas per inventory id until they are flushed"""
+
+    def __init__(self, max_size: int = 1000):
+        self.max_size = max_size
+        self._deltas = {}
+        self._lock = threading.Lock()
+        # held for the whole of a flush, so that flushes run one at a time
+        self._flush_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._deltas)
+
+    def add(self, inventory_id: int, delta: int, quantity: int = None):
+        """Merges a delta into the buffer and returns the pending delta of the item
+
+        When the stored quantity of the item is given, a delta that would
+        take it below zero together with the pending one is rejected and
+        None is returned. The buffer is flushed right away once it holds
+        max_size items.
+        """
+        with self._lock:
+            pending = self._deltas.get(inventory_id, 0) + delta
+            if quantity is not None and delta < 0 and quantity + pending < 0:
+                return None
+            self._deltas[inventory_id] = pending
+            full = len(self._deltas) >= self.max_size
+        if full:
+            self.flush()
+        return pending
+
+    def flush(self) -> int:
+        """Writes all buffered deltas and returns the number of items updated
+
+        Flushes run one at a time. A caller whose delta was taken by a
+        concurrent flush waits for it here, and writes the delta itself when
+        that flush failed and put it back, so once this returns every delta
+        added before the call is committed or was dropped for good.
+        """
+        with self._flush_lock:
+            with self._lock:
+                deltas = {key: value for key, value in self._deltas.items() if value}
+                self._deltas = {}
+            if not deltas:
+                return 0
+            try:
+                updated = self._write(deltas)
+            except Exception:
+                # put the unwritten deltas back so that they are written by the next flush
+                with self._lock:
+                    for key, value in deltas.items():
+                        self._deltas[key] = self._deltas.get(key, 0) + value
+                raise
+        logger.info("Flushed quantity adjustments for %d items", updated)
+        return updated
+
+    def _write(self, deltas: dict) -> int:
+        """Writes deltas and removes the ones that were committed or dropped
+
+        The deltas of deleted items are dropped. A batch rejected by the
+        database, e.g. for a constraint violation, would fail the same way
+        every time, so it is written again item by item and only the
+        deltas that still fail are dropped. Deltas left after any other
+        error are kept by flush() for a retry.
+        """
+        try:
+            missing = Inventory.adjust_quantities(dict(deltas))
+        except DataValidationError as error:
+            if len(deltas) == 1:
+                logger.error("Dropping the quantity adjustment %s: %s", deltas, error)
+                deltas.clear()
+                return 0
+            updated = 0
+            for key in list(deltas):
+                updated += self._write({key: deltas[key]})
+                del deltas[key]
+            return updated
+        if missing:
+            logger.warning("Dropping the quantity adjustments of deleted items %s", missing)
+        updated = len(deltas) - len(missing)
+        deltas.clear()
+        return updated
+
+
+# One buffer per worker process
+buffer = AdjustmentBuffer()
+
+
+def init_adjustments(app):
+    """Flushes the buffer periodically and when the worker exits"""
+    buffer.max_size = app.config["ADJUST_FLUSH_SIZE"]
+    flusher = PeriodicTask("adjustment-flush", app.config["ADJUST_FLUSH_INTERVAL"], buffer.flush)
+    flusher.attach(app)
+    atexit.register(flusher.run_once, app)
+    return flusher
@@ -0,0 +1,170 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Admission Control
+
+Rejects requests with 503 and Retry-After before they reach the database
+once the worker is overloaded, instead of letting them queue until they
+time out. Requests are admitted by priority: health probes always, cheap
+reads of a single resource up to the in-flight limit, writes and plain or
+paginated lists up to a smaller share of it, and filtered lists without a
+limit, bulk upserts and change-log reads up to half of it. While
+the average database statement latency is over its budget, only health
+probes and cheap reads are admitted. The average decays while no
+statements run, so shedding stops once the database has had time to
+recover even though the shed requests never measure it.
+"""
+import time
+from flask import request, jsonify
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from service.common import status
+from service.common.health import in_flight
+
+# Priorities, most important first
+CRITICAL = "critical"
+CHEAP = "cheap"
+NORMAL = "normal"
+EXPENSIVE = "expensive"
+
+CRITICAL_ENDPOINTS = {"health_check", "liveness_check", "readiness_check"}
+CHEAP_ENDPOINTS = {"inventory_resource", "reservation_resource", "index", "static", "doc", "specs", "root",
+                   "restx_doc.static"}
+EXPENSIVE_ENDPOINTS = {"inventory_collection", "upsert_collection", "inventory_change_collection", "inventory_events"}
+# a list filtered on any of these without a limit may scan the whole table
+LIST_FILTERS = {"name", "category", "quantity", "condition", "restock_level"}
+
+# share of the in-flight limit that each priority may use
+SHARES = {CHEAP: 1.0, NORMAL: 0.75, EXPENSIVE: 0.5}
+
+# weight of the latest statement in the average database latency
+LATENCY_WEIGHT = 0.1
+
+
+def classify(method: str, endpoint: str, args=None) -> str:
+    """Returns the priority of a request given its query arguments"""
+    if endpoint in CRITICAL_ENDPOINTS:
+        return CRITICAL
+    if method in ("GET", "HEAD") and endpoint in CHEAP_ENDPOINTS:
+        return CHEAP
+    if endpoint == "inventory_collection":
+        # the main read path, plain or paginated, ranks with the writes
+        args = args or {}
+        filtered = any(args.get(name) for name in LIST_FILTERS) and not args.get("limit")
+        return EXPENSIVE if filtered else NORMAL
+    if endpoint in EXPENSIVE_ENDPOINTS:
+        return EXPENSIVE
+    return NORMAL
+
+
+class AdmissionController:
+    """Admits or sheds each request of a worker"""
+
+    def __init__(self):
+        self.enabled = True
+        self.max_in_flight = 8
+        self.db_latency_limit = 0.25
+        self.retry_after = 2
+        self.latency_half_life = 5.0
+        self._db_latency = 0.0
+        self._db_latency_at = time.monotonic()
+        self.rejected = {CHEAP: 0, NORMAL: 0, EXPENSIVE: 0}
+
+    def configure(self, config):
+        """Takes the limits from the app configuration"""
+        self.enabled = config["ADMISSION_ENABLED"]
+        self.max_in_flight = config["ADMISSION_MAX_IN_FLIGHT"]
+        self.db_latency_limit = config["ADMISSION_DB_LATENCY_LIMIT"]
+        self.retry_after = config["ADMISSION_RETRY_AFTER"]
+        self.latency_half_life = config["ADMISSION_LATENCY_HALF_LIFE"]
+
+    def attach(self, app):
+        """Checks every request of the app after it has been counted as in flight"""
+        app.before_request(self.admit)
+        if not event.contains(Engine, "before_cursor_execute", _before_cursor_execute):
+            event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+            event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+            event.listen(Engine, "handle_error", _handle_error)
+
+    def overloaded(self, priority: str) -> str:
+        """Returns why a request of this priority must be shed, or None"""
+        if priority == CRITICAL:
+            return None
+        if priority != CHEAP and self.db_latency > self.db_latency_limit:
+            return f"database latency {self.db_latency * 1000:.0f} ms is over its budget"
+        if in_flight.count > self.max_in_flight * SHARES[priority]:
+            return f"{in_flight.count} requests in flight"
+        return None
+
+    def admit(self):
+        """Returns a 503 response for a request that must be shed"""
+        if not self.enabled:
+            return None
+        priority = classify(request.method, request.endpoint, request.args)
+        reason = self.overloaded(priority)
+        if reason is None:
+            return None
+        self.rejected[priority] += 1
+        response = jsonify(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            error="Service Unavailable",
+            message=f"Overloaded, {reason}; retry later",
+        )
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+        response.headers["Retry-After"] = str(self.retry_after)
+        return response
+
+    @property
+    def db_latency(self) -> float:
+        """The average statement latency, halved every latency_half_life seconds without statements"""
+        idle = time.monotonic() - self._db_latency_at
+        return self._db_latency * 0.5 ** (idle / self.latency_half_life)
+
+    @db_latency.setter
+    def db_latency(self, seconds: float):
+        self._db_latency = seconds
+        self._db_latency_at = time.monotonic()
+
+    def record_latency(self, seconds: float):
+        """Adds the latency of a statement to the moving average"""
+        self.db_latency += LATENCY_WEIGHT * (seconds - self.db_latency)
+
+
+admission = AdmissionController()
+
+
+def init_admission(app):
+    """Sheds the requests of the app that it cannot serve in time"""
+    admission.configure(app.config)
+    admission.attach(app)
+
+
+def _before_cursor_execute(conn, *_):
+    """Notes when a statement starts"""
+    conn.info.setdefault("admission_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, *_):
+    """Records how long a statement took"""
+    admission.record_latency(time.perf_counter() - conn.info["admission_start"].pop())
+
+
+def _handle_error(context):
+    """Records how long a failed statement took, timeouts included"""
+    starts = context.connection.info.get("admission_start") if context.connection is not None else None
+    if starts:
+        admission.record_latency(time.perf_counter() - starts.pop())
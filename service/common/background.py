@@ -0,0 +1,75 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Background Tasks
+
+This module runs periodic maintenance jobs in a daemon thread per worker
+"""
+import threading
+from flask import current_app
+
+
+class PeriodicTask:
+    """Calls a function every interval seconds inside an app context
+
+    The thread is started by the first request a worker serves, so that it
+    is never created before gunicorn forks its workers
+    """
+
+    def __init__(self, name: str, interval: float, func):
+        self.name = name
+        self.interval = interval
+        self.func = func
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def attach(self, app):
+        """Starts the task when the app serves its first request"""
+        app.before_request(self.start)
+
+    def start(self):
+        """Starts the thread unless it is disabled or already running"""
+        if self.interval <= 0 or self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._stopped.clear()
+                self._thread = threading.Thread(
+                    target=self._run, args=(current_app._get_current_object(),), name=self.name, daemon=True
+                )
+                self._thread.start()
+
+    def stop(self):
+        """Stops the thread after its current run"""
+        self._stopped.set()
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join()
+
+    def run_once(self, app):
+        """Runs the task once, logging instead of raising any error"""
+        with app.app_context():
+            try:
+                self.func()
+            except Exception as error:  # pylint: disable=broad-except
+                app.logger.error("Background task %s failed: %s", self.name, error)
+
+    def _run(self, app):
+        """Thread body"""
+        while not self._stopped.wait(self.interval):
+            self.run_once(app)
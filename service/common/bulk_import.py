@@ -0,0 +1,127 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Bulk Import
+
+Streams a CSV file of inventory items, validates every row with the same
+rules as the REST API and loads the valid rows in batches
+"""
+import csv
+import time
+import logging
+from service.models import Inventory, DataValidationError
+from service.common.transactions import unit_of_work
+
+logger = logging.getLogger("flask.app")
+
+INTEGER_FIELDS = ("quantity", "restock_level")
+
+
+class ImportReport:
+    """The outcome of an import"""
+
+    def __init__(self):
+        self.loaded = 0
+        self.rejected = []
+        self.started = time.perf_counter()
+        self.elapsed = 0.0
+
+    @property
+    def rate(self) -> float:
+        """Returns the number of rows loaded per second"""
+        return self.loaded / self.elapsed if self.elapsed else 0.0
+
+    def reject(self, line: int, reason: str):
+        """Remembers a row that could not be imported"""
+        self.rejected.append((line, reason))
+
+    def load(self, batch: dict):
+        """Loads a batch of rows keyed on their id or natural key as (line, row)
+
+        A batch the database refuses is rolled back and loaded again row by
+        row in a unit of work, so that only the refused rows are rejected and
+        the others still share a single commit
+        """
+        try:
+            self.loaded += Inventory.bulk_upsert([record for _, record in batch.values()])
+            return
+        except DataValidationError as error:
+            if len(batch) == 1:
+                line, _ = next(iter(batch.values()))
+                self.reject(line, f"Row not loaded: {error}")
+                return
+            logger.error("Loading a refused batch of %d rows one by one: %s", len(batch), error)
+        loaded = 0
+        with unit_of_work():
+            for line, record in batch.values():
+                try:
+                    loaded += Inventory.bulk_upsert([record])
+                except DataValidationError as error:
+                    self.reject(line, f"Row not loaded: {error}")
+        self.loaded += loaded
+
+
+def parse_row(row: dict) -> dict:
+    """Validates a CSV row and returns it as a deserialized item
+
+    Numbers arrive as text, so they are converted before the row goes
+    through Inventory.deserialize(); an empty or missing id means a new item
+    """
+    data = dict(row)
+    for field in INTEGER_FIELDS:
+        try:
+            data[field] = int(data[field])
+        except (KeyError, TypeError, ValueError):
+            pass  # deserialize() reports the missing or invalid value
+    item = Inventory().deserialize(data)
+    record = item.to_row()
+    if (data.get("id") or "").strip():
+        try:
+            record["id"] = int(data["id"])
+        except ValueError as error:
+            raise DataValidationError(f"Invalid id: {data['id']}") from error
+    return record
+
+
+def import_csv(stream, batch_size: int = 5000) -> ImportReport:
+    """Imports the items of a CSV stream with a header row
+
+    Args:
+        stream: a text file object with the columns id (optional),
+            inventory_name, category, quantity, condition, restock_level
+        batch_size (int): the number of rows loaded per transaction; the
+            rows of a batch the database refuses are all rejected
+    """
+    report = ImportReport()
+    batch = {}
+    reader = csv.DictReader(stream)
+    for row in reader:
+        try:
+            record = parse_row(row)
+        except DataValidationError as error:
+            report.reject(reader.line_num, str(error))
+            continue
+        # a later row for the same id or natural key replaces an earlier one in the batch
+        batch[record.get("id", tuple(record[name] for name in Inventory.NATURAL_KEY))] = (reader.line_num, record)
+        if len(batch) >= batch_size:
+            report.load(batch)
+            batch = {}
+    if batch:
+        report.load(batch)
+    report.elapsed = time.perf_counter() - report.started
+    logger.info("Imported %d items, rejected %d", report.loaded, len(report.rejected))
+    return report
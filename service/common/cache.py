@@ -0,0 +1,338 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Read-Through Cache
+
+Item lookups are served from a cache tier in front of the database. The
+backend is pluggable: MemoryBackend keeps entries in the worker, while
+RedisBackend keeps them in a Redis server that every pod shares. Concurrent
+misses on the same key are coalesced, so a hot item that expires costs one
+query per worker instead of one per request. Writes invalidate the keys of
+the items they change once their transaction commits, and bump a
+generation counter per category they touch; results keyed on those
+generations, such as lists of items, are never looked up again. Each
+invalidation also bumps a version counter of the key, so a load that ran
+across it does not store the value it read before the write.
+"""
+import time
+import logging
+import threading
+import importlib.util
+from collections import OrderedDict
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+logger = logging.getLogger("flask.app")
+
+# redis is optional, the memory backend needs nothing
+REDIS_AVAILABLE = importlib.util.find_spec("redis") is not None
+# the session.info key of the cache keys and categories a transaction invalidates when it commits
+PENDING = "cache_invalidations"
+# the category of writes that may have moved items between categories
+ALL_CATEGORIES = None
+
+
+######################################################################
+# Backends
+######################################################################
+class MemoryBackend:
+    """Keeps the entries of one worker, evicting the least recently used"""
+
+    def __init__(self, max_keys: int = 10000):
+        self.max_keys = max_keys
+        self._entries = OrderedDict()
+        # counters are never evicted, a reset one could make old entries current again
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        """Returns the value of a key, or None when it is missing or expired"""
+        with self._lock:
+            value, expires = self._entries.get(key, (None, 0))
+            if expires < time.monotonic():
+                self._entries.pop(key, None)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: bytes, ttl: float):
+        """Stores the value of a key for ttl seconds"""
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_keys:
+                self._entries.popitem(last=False)
+
+    def delete(self, keys: list):
+        """Removes keys"""
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def incr(self, key: str) -> int:
+        """Adds one to a counter"""
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            return self._counters[key]
+
+    def incr_many(self, keys: list):
+        """Adds one to counters"""
+        with self._lock:
+            for key in keys:
+                self._counters[key] = self._counters.get(key, 0) + 1
+
+    def get_many(self, keys: list) -> list:
+        """Returns the values of counters, None for those never incremented"""
+        with self._lock:
+            return [self._counters.get(key) for key in keys]
+
+
+class RedisBackend:
+    """Keeps the entries in a Redis server shared by every pod
+
+    The client may be anything with the get, set, delete, incr, mget and
+    pipeline methods of redis-py, such as a local stand-in in tests. Entries expire
+    while counters do not, so a volatile-* maxmemory policy never evicts
+    the counters.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    @classmethod
+    def from_url(cls, url: str, timeout: float = 0.5):
+        """Connects to the Redis server at a redis:// URL"""
+        # pylint: disable=import-outside-toplevel
+        import redis
+
+        return cls(redis.Redis.from_url(url, socket_timeout=timeout, socket_connect_timeout=timeout))
+
+    def get(self, key: str):
+        """Returns the value of a key, or None when it is missing"""
+        return self.client.get(key)
+
+    def set(self, key: str, value: bytes, ttl: float):
+        """Stores the value of a key for ttl seconds"""
+        self.client.set(key, value, px=int(ttl * 1000))
+
+    def delete(self, keys: list):
+        """Removes keys"""
+        if keys:
+            self.client.delete(*keys)
+
+    def incr(self, key: str) -> int:
+        """Adds one to a counter, which has no expiry"""
+        return self.client.incr(key)
+
+    def incr_many(self, keys: list):
+        """Adds one to counters in one round trip"""
+        pipeline = self.client.pipeline(transaction=False)
+        for key in keys:
+            pipeline.incr(key)
+        pipeline.execute()
+
+    def get_many(self, keys: list) -> list:
+        """Returns the values of keys in one round trip"""
+        return self.client.mget(keys)
+
+
+######################################################################
+# Request coalescing
+######################################################################
+class Flight:  # pylint: disable=too-few-public-methods
+    """A load in progress that other callers wait for"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight:
+    """Runs one load per key at a time; concurrent callers share its result"""
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: str, load) -> tuple:
+        """Returns the result of load() and whether it came from another caller's load"""
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value, True
+        try:
+            flight.value = load()
+        except Exception as error:
+            flight.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.value, False
+
+
+######################################################################
+# The cache
+######################################################################
+class ReadThroughCache:
+    """Loads missing entries through single flights and stores them in the backend
+
+    An unavailable backend is treated as a miss, so the database keeps
+    answering when the cache is down
+    """
+
+    def __init__(self):
+        self.backend = None
+        self.ttl = 30.0
+        self.result_ttl = 300.0
+        self.flights = SingleFlight()
+        self.hits = self.misses = self.coalesced = 0
+
+    @property
+    def enabled(self) -> bool:
+        """Whether a backend is configured"""
+        return self.backend is not None
+
+    def configure(self, config):
+        """Takes the backend and the time to live from the app configuration"""
+        self.ttl = config["CACHE_TTL"]
+        self.result_ttl = config["CACHE_RESULT_TTL"]
+        name = config["CACHE_BACKEND"]
+        if name == "memory":
+            self.backend = MemoryBackend(config["CACHE_MAX_ITEMS"])
+        elif name == "redis" and REDIS_AVAILABLE:
+            self.backend = RedisBackend.from_url(config["CACHE_URL"])
+        else:
+            if name not in ("none", "redis"):
+                logger.warning("Unknown cache backend %s, caching is off", name)
+            elif name == "redis":
+                logger.warning("The redis package is not installed, caching is off")
+            self.backend = None
+
+    def get(self, key: str, load, ttl: float = None):
+        """Returns the cached bytes of a key, loading and storing them on a miss
+
+        load() returns the bytes to cache, or None for nothing to cache;
+        they are kept for ttl seconds, CACHE_TTL by default
+        """
+        value = self._call("get", key)
+        if value is not None:
+            self.hits += 1
+            return value
+        value, shared = self.flights.do(key, lambda: self._load(key, load, ttl or self.ttl))
+        if shared:
+            self.coalesced += 1
+        return value
+
+    def _load(self, key: str, load, ttl: float):
+        """Loads a value and stores it unless the key was invalidated meanwhile
+
+        The version is read again after the set, since the invalidation of a
+        write that committed during the load may have deleted the key before it
+        """
+        self.misses += 1
+        version = self._version(key)
+        value = load()
+        if value is not None and version is not None:
+            self._call("set", key, value, ttl)
+            if self._version(key) != version:
+                self._call("delete", [key])
+        return value
+
+    def _version(self, key: str):
+        """Returns how many times a key was invalidated, or None when the backend fails"""
+        values = self._call("get_many", [f"version:{key}"])
+        return None if values is None else int(values[0] or 0)
+
+    def invalidate(self, keys):
+        """Removes keys from the cache, bumping their versions first"""
+        if self.enabled and keys:
+            keys = sorted(keys)
+            self._call("incr_many", [f"version:{key}" for key in keys])
+            self._call("delete", keys)
+
+    def generations(self, category) -> str:
+        """Returns the generations a result filtered on a category (None for any) depends on
+
+        Returns None when the backend fails, so that nothing is cached
+        """
+        names = ["generation:all", "generation:any" if category is None else f"generation:category:{category}"]
+        values = self._call("get_many", names)
+        if values is None:
+            return None
+        return ".".join(str(int(value or 0)) for value in values)
+
+    def bump(self, categories):
+        """Bumps the generations of categories, every one for ALL_CATEGORIES"""
+        if not self.enabled or not categories:
+            return
+        if ALL_CATEGORIES in categories:
+            self._call("incr", "generation:all")
+            return
+        self._call("incr", "generation:any")
+        for category in sorted(categories):
+            self._call("incr", f"generation:category:{category}")
+
+    def _call(self, method: str, *args):
+        """Calls the backend, logging its errors instead of raising them"""
+        try:
+            return getattr(self.backend, method)(*args)
+        except Exception as error:  # pylint: disable=broad-except
+            logger.warning("Cache %s failed: %s", method, error)
+            return None
+
+
+cache = ReadThroughCache()
+
+
+def init_cache(app):
+    """Configures the cache and invalidates the keys of committed writes"""
+    cache.configure(app.config)
+    if not event.contains(Session, "after_commit", _invalidate_committed):
+        event.listen(Session, "after_commit", _invalidate_committed)
+        event.listen(Session, "after_soft_rollback", _forget_pending)
+
+
+def invalidate_on_commit(session, keys=(), categories=()):
+    """Invalidates keys and bumps the generations of categories when the transaction of a session commits"""
+    if cache.enabled:
+        pending = session.info.setdefault(PENDING, {"keys": set(), "categories": set()})
+        pending["keys"].update(keys)
+        pending["categories"].update(categories)
+
+
+def _invalidate_committed(session):
+    # releasing a savepoint of a unit of work commits nothing yet
+    if session.in_nested_transaction():
+        return
+    pending = session.info.pop(PENDING, None)
+    if pending is not None:
+        cache.invalidate(pending["keys"])
+        cache.bump(pending["categories"])
+
+
+def _forget_pending(session, previous_transaction):
+    if not previous_transaction.nested:
+        session.info.pop(PENDING, None)
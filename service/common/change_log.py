@@ -0,0 +1,53 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Change Log Sequencing and Compaction
+
+The changes of a transaction are numbered as it commits, and changes every
+known consumer has read are deleted in the background
+"""
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from service.models import InventoryChange, ChangeConsumer, UNSEQUENCED
+from service.common.background import PeriodicTask
+
+
+def compact(app) -> int:
+    """Forgets the stale consumers and compacts the change log"""
+    ChangeConsumer.forget_stale(app.config["CHANGES_CONSUMER_TTL"])
+    return InventoryChange.compact(app.config["CHANGES_BATCH_SIZE"])
+
+
+def init_change_log(app):
+    """Numbers the changes of committing transactions and compacts the change log periodically in every worker"""
+    if not event.contains(Session, "before_commit", _sequence_changes):
+        event.listen(Session, "before_commit", _sequence_changes)
+        event.listen(Session, "after_soft_rollback", _forget_changes)
+    compactor = PeriodicTask("change-log-compact", app.config["CHANGES_COMPACT_INTERVAL"], lambda: compact(app))
+    compactor.attach(app)
+    return compactor
+
+
+def _sequence_changes(session):
+    # releasing a savepoint of a unit of work commits nothing yet
+    if not session.in_nested_transaction() and session.info.pop(UNSEQUENCED, False):
+        InventoryChange.sequence(session)
+
+
+def _forget_changes(session, previous_transaction):
+    if not previous_transaction.nested:
+        session.info.pop(UNSEQUENCED, None)
@@ -16,8 +16,11 @@
 """
 Flask CLI Command Extensions
 """
+import click
 from flask import current_app as app  # Import Flask application
-from service.models import db
+from service.models import db, IdempotencyKey, Reservation
+from service.common import change_log, bulk_import
+from service import migrations
 
 
 ######################################################################
@@ -34,3 +37,111 @@ def db_create():
     db.drop_all()
     db.create_all()
     db.session.commit()
+    migrations.stamp(migrations.head())
+
+
+######################################################################
+# Command to create the tables that do not exist yet
+# Usage:
+#   flask db-init
+######################################################################
+@app.cli.command("db-init")
+def db_init():
+    """Creates the tables of an empty database without touching existing data"""
+    revision = migrations.init_schema()
+    click.echo(f"Database initialized at revision {revision}")
+
+
+######################################################################
+# Commands to move the schema between revisions
+# Usage:
+#   flask db-upgrade [--to REVISION]
+#   flask db-downgrade [--to REVISION]
+#   flask db-current
+######################################################################
+@app.cli.command("db-upgrade")
+@click.option("--to", "target", type=int, default=None, help="Revision to upgrade to (default: latest)")
+def db_upgrade(target):
+    """Applies the pending schema migrations"""
+    applied = migrations.upgrade(target, app.config["MIGRATION_LOCK_TIMEOUT"], app.config["MIGRATION_BATCH_SIZE"])
+    for revision in applied:
+        click.echo(f"Applied revision {revision}")
+    click.echo(f"Database is at revision {migrations.current()}")
+
+
+@app.cli.command("db-downgrade")
+@click.option("--to", "target", type=int, default=None, help="Revision to downgrade to (default: previous)")
+def db_downgrade(target):
+    """Reverts the applied schema migrations"""
+    if target is None:
+        target = (migrations.current() or 0) - 1
+    try:
+        reverted = migrations.downgrade(
+            target, app.config["MIGRATION_LOCK_TIMEOUT"], app.config["MIGRATION_BATCH_SIZE"]
+        )
+    except migrations.MigrationError as error:
+        raise click.ClickException(str(error)) from error
+    for revision in reverted:
+        click.echo(f"Reverted revision {revision}")
+    click.echo(f"Database is at revision {migrations.current()}")
+
+
+@app.cli.command("db-current")
+def db_current():
+    """Shows the revision of the database and the latest revision"""
+    click.echo(f"Database is at revision {migrations.current()} of {migrations.head()}")
+
+
+######################################################################
+# Command to load inventory items from a CSV file
+# Usage:
+#   flask inventory-import items.csv [--batch-size N]
+######################################################################
+@app.cli.command("inventory-import")
+@click.argument("file", type=click.File("r", encoding="utf-8"))
+@click.option("--batch-size", type=int, default=None, help="Rows loaded per transaction")
+def inventory_import(file, batch_size):
+    """Inserts or updates the items of a CSV file, matching rows on id"""
+    report = bulk_import.import_csv(file, batch_size or app.config["IMPORT_BATCH_SIZE"])
+    for line, reason in report.rejected:
+        click.echo(f"Rejected line {line}: {reason}", err=True)
+    click.echo(
+        f"Imported {report.loaded} rows in {report.elapsed:.2f}s ({report.rate:.0f} rows/s), "
+        f"rejected {len(report.rejected)}"
+    )
+
+
+######################################################################
+# Command to purge the expired idempotency keys
+# Usage:
+#   flask idempotency-purge
+######################################################################
+@app.cli.command("idempotency-purge")
+def idempotency_purge():
+    """Deletes the expired idempotency keys in batches"""
+    deleted = IdempotencyKey.purge_expired(app.config["IDEMPOTENCY_PURGE_BATCH_SIZE"])
+    click.echo(f"Purged {deleted} expired idempotency keys")
+
+
+######################################################################
+# Command to release the expired reservations
+# Usage:
+#   flask reservations-sweep
+######################################################################
+@app.cli.command("reservations-sweep")
+def reservations_sweep():
+    """Releases the expired reservations in batches"""
+    released = Reservation.release_expired(app.config["RESERVATION_SWEEP_BATCH_SIZE"])
+    click.echo(f"Released {released} expired reservations")
+
+
+######################################################################
+# Command to compact the change log
+# Usage:
+#   flask changes-compact
+######################################################################
+@app.cli.command("changes-compact")
+def changes_compact():
+    """Deletes the changes every known consumer has read"""
+    deleted = change_log.compact(app)
+    click.echo(f"Compacted {deleted} changes")
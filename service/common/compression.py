@@ -0,0 +1,135 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Response Compression
+
+This module negotiates Accept-Encoding with the client and compresses
+responses with brotli or gzip, including streamed responses
+"""
+import zlib
+import brotli
+from flask import request, current_app
+
+GZIP = "gzip"
+BROTLI = "br"
+# Order matters: brotli wins when the client accepts both equally
+ENCODINGS = [BROTLI, GZIP]
+
+
+def init_compression(app):
+    """Compress every eligible response the app sends"""
+    app.after_request(compress_response)
+
+
+def compress_response(response):
+    """Compresses a response if the client accepts it and it is worth it"""
+    config = current_app.config
+    if not config["COMPRESS_ENABLED"] or not _is_compressible(response, config["COMPRESS_MIMETYPES"]):
+        return response
+
+    response.vary.add("Accept-Encoding")
+    encoding = request.accept_encodings.best_match(ENCODINGS)
+    if not encoding:
+        return response
+
+    if response.is_streamed:
+        response.response = _compress_stream(response.response, _compressor(encoding, config))
+        response.direct_passthrough = False
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < config["COMPRESS_MIN_SIZE"]:
+            return response
+        compressor = _compressor(encoding, config)
+        response.set_data(compressor.compress(data) + compressor.finish())
+
+    response.headers["Content-Encoding"] = encoding
+    tag, weak = response.get_etag()
+    if tag:
+        # the compressed body is a different representation with its own tag
+        response.set_etag(f"{tag}-{encoding}", weak)
+    return response
+
+
+def _is_compressible(response, mimetypes) -> bool:
+    """Checks whether a response can be compressed at all"""
+    return (
+        request.method != "HEAD"
+        and 200 <= response.status_code < 300
+        and response.status_code not in (204, 206)
+        and "Content-Encoding" not in response.headers
+        and "Content-Range" not in response.headers
+        and response.mimetype in mimetypes
+    )
+
+
+def _compress_stream(chunks, compressor):
+    """Compresses a streamed body chunk by chunk
+
+    Every chunk is flushed so that a slow stream still reaches the
+    client as soon as it is produced
+    """
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+        yield compressor.compress(chunk) + compressor.flush()
+    yield compressor.finish()
+
+
+def _compressor(encoding, config):
+    """Creates a compressor for the negotiated encoding"""
+    if encoding == BROTLI:
+        return BrotliCompressor(config["COMPRESS_BR_LEVEL"])
+    return GzipCompressor(config["COMPRESS_LEVEL"])
+
+
+class GzipCompressor:
+    """Streaming gzip compressor"""
+
+    def __init__(self, level: int):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data: bytes) -> bytes:
+        """Compresses a block of data"""
+        return self._compressor.compress(data)
+
+    def flush(self) -> bytes:
+        """Emits everything compressed so far without ending the stream"""
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        """Ends the stream"""
+        return self._compressor.flush()
+
+
+class BrotliCompressor:
+    """Streaming brotli compressor"""
+
+    def __init__(self, quality: int):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data: bytes) -> bytes:
+        """Compresses a block of data"""
+        return self._compressor.process(data)
+
+    def flush(self) -> bytes:
+        """Emits everything compressed so far without ending the stream"""
+        return self._compressor.flush()
+
+    def finish(self) -> bytes:
+        """Ends the stream"""
+        return self._compressor.finish()
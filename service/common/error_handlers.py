@@ -19,23 +19,42 @@ Module: error_handlers
 # from flask import jsonify
 from service import api
 from flask import current_app as app  # Import Flask application
-from service.models import DataValidationError, DatabaseConnectionError
+from sqlalchemy.exc import OperationalError
+from service.models import DataValidationError, DuplicateItemError, DatabaseConnectionError
+from service.common.timeouts import is_statement_timeout, current_timeout
+from service.common.resilience import breaker, is_transient
 from . import status
 
 
 ######################################################################
 # Error Handlers
 ######################################################################
+# registered before DataValidationError, its base class, so that it wins
+@api.errorhandler(DuplicateItemError)
+def duplicate_item_error(error):
+    """Handles items that already exist with 409_CONFLICT"""
+    message = str(error)
+    app.logger.warning(message)
+    return {
+        "status_code": status.HTTP_409_CONFLICT,
+        "error": "Conflict",
+        "message": message,
+    }, status.HTTP_409_CONFLICT
+
+
 @api.errorhandler(DataValidationError)
 def request_validation_error(error):
     """Handles Value Errors from bad data"""
     message = str(error)
     app.logger.error(message)
-    return {
+    body = {
         "status_code": status.HTTP_400_BAD_REQUEST,
         "error": "Bad Request",
         "message": message,
-    }, status.HTTP_400_BAD_REQUEST
+    }
+    if error.errors:
+        body["errors"] = error.errors
+    return body, status.HTTP_400_BAD_REQUEST
 
 
 @api.errorhandler(DatabaseConnectionError)
@@ -47,7 +66,33 @@ def database_connection_error(error):
         "status_code": status.HTTP_503_SERVICE_UNAVAILABLE,
         "error": "Service Unavailable",
         "message": message,
-    }, status.HTTP_503_SERVICE_UNAVAILABLE
+    }, status.HTTP_503_SERVICE_UNAVAILABLE, {"Retry-After": str(int(breaker.reset_timeout))}
+
+
+@api.errorhandler(OperationalError)
+def database_operational_error(error):
+    """Handles statements cancelled by their timeout and lost connections with 503_SERVICE_UNAVAILABLE
+
+    Any other database error is a fault of the service and gets 500_INTERNAL_SERVER_ERROR
+    """
+    if is_statement_timeout(error):
+        message = f"The database did not answer within {current_timeout()} ms, retry later"
+        app.logger.error("Statement timed out: %s", error.statement)
+    elif is_transient(error):
+        message = "The database is unavailable, retry later"
+        app.logger.critical("Database error: %s", error)
+    else:
+        app.logger.exception("Database error: %s", error)
+        return {
+            "status_code": status.HTTP_500_INTERNAL_SERVER_ERROR,
+            "error": "Internal Server Error",
+            "message": "The database could not run the request",
+        }, status.HTTP_500_INTERNAL_SERVER_ERROR
+    return {
+        "status_code": status.HTTP_503_SERVICE_UNAVAILABLE,
+        "error": "Service Unavailable",
+        "message": message,
+    }, status.HTTP_503_SERVICE_UNAVAILABLE, {"Retry-After": "1"}
 
 
 # @app.errorhandler(status.HTTP_404_NOT_FOUND)
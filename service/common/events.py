@@ -0,0 +1,173 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Inventory Events
+
+Each worker tails the change log with a single background poller and fans
+the changes out to its Server-Sent Events subscribers through bounded
+in-memory queues, so subscribers never hold a database connection. A
+stream waits on its queue for as long as the client stays connected, which
+costs a greenlet in a gevent worker but a whole thread in a gthread one.
+"""
+import sys
+import json
+import queue
+import logging
+import threading
+from service.models import Inventory, InventoryChange
+from service.common.background import PeriodicTask
+
+logger = logging.getLogger("flask.app")
+
+
+class Subscriber:
+    """A client listening for events, optionally filtered by category or id"""
+
+    def __init__(self, max_queue: int, category: str = None, inventory_id: int = None):
+        self.queue = queue.Queue(max_queue)
+        self.category = category
+        self.inventory_id = inventory_id
+        self.dropped = False
+
+    def matches(self, event: dict) -> bool:
+        """Checks whether the subscriber wants an event"""
+        if self.inventory_id is not None and event["inventory_id"] != self.inventory_id:
+            return False
+        return self.category is None or event["data"].get("category") == self.category
+
+    def offer(self, event: dict) -> bool:
+        """Queues an event without blocking; a full queue drops the subscriber"""
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            self.dropped = True
+        return not self.dropped
+
+
+class EventBroker:
+    """Fans the changes out to every subscriber of this worker"""
+
+    def __init__(self):
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self.last_seq = None
+
+    def __len__(self):
+        return len(self._subscribers)
+
+    def subscribe(self, subscriber: Subscriber, limit: int = None) -> bool:
+        """Starts delivering events to a subscriber unless limit subscribers already have one
+
+        Returns whether the subscriber was added
+        """
+        with self._lock:
+            if limit is not None and len(self._subscribers) >= limit:
+                return False
+            self._subscribers.add(subscriber)
+        return True
+
+    def unsubscribe(self, subscriber: Subscriber):
+        """Stops delivering events to a subscriber"""
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def publish(self, event: dict):
+        """Delivers an event to every matching subscriber, dropping slow ones"""
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            if subscriber.matches(event) and not subscriber.offer(event):
+                logger.warning("Dropping slow event subscriber")
+                self.unsubscribe(subscriber)
+
+    def poll(self, batch_size: int = 500) -> int:
+        """Publishes the changes committed since the last poll
+
+        The change log is read batch by batch until the poll has caught up,
+        so a burst of writes never leaves the events behind. Nothing is read
+        while there are no subscribers, and the first poll only remembers
+        where the change log ends
+        """
+        if not self._subscribers:
+            self.last_seq = None
+            return 0
+        if self.last_seq is None:
+            self.last_seq = InventoryChange.last_seq()
+            return 0
+        published = 0
+        while self._subscribers:
+            changes = InventoryChange.since(self.last_seq, batch_size)
+            published += self._publish_changes(changes)
+            if len(changes) < batch_size:
+                break
+        return published
+
+    def _publish_changes(self, changes: list) -> int:
+        """Publishes a batch of changes and moves past it"""
+        if not changes:
+            return 0
+        events = [change.serialize() for change in changes]
+        self.last_seq = events[-1]["seq"]
+        # quantity deltas only know the item id, so look up what watchers need
+        deltas = {event["inventory_id"] for event in events if "category" not in event["data"]}
+        levels = Inventory.stock_levels(deltas) if deltas else {}
+        for event in events:
+            event["data"].update(levels.get(event["inventory_id"], {}))
+            self.publish(event)
+        return len(events)
+
+
+# One broker per worker process
+broker = EventBroker()
+
+
+def init_events(app):
+    """Tails the change log periodically in every worker"""
+    poller = PeriodicTask(
+        "event-poll",
+        app.config["EVENTS_POLL_INTERVAL"],
+        lambda: broker.poll(app.config["CHANGES_BATCH_SIZE"]),
+    )
+    poller.attach(app)
+    return poller
+
+
+def async_worker() -> bool:
+    """Checks whether requests run in greenlets, as in gunicorn's gevent workers"""
+    monkey = sys.modules.get("gevent.monkey")
+    return monkey is not None and monkey.is_module_patched("threading")
+
+
+def subscriber_limit(config) -> int:
+    """Returns how many streams this worker may serve at once"""
+    return config["EVENTS_MAX_SUBSCRIBERS"] if async_worker() else config["EVENTS_THREAD_SUBSCRIBERS"]
+
+
+def stream(subscriber: Subscriber, keepalive: float):
+    """Yields the events of a subscriber in the text/event-stream format"""
+    try:
+        yield "retry: 3000\n\n"
+        while not subscriber.dropped:
+            try:
+                event = subscriber.queue.get(timeout=keepalive)
+            except queue.Empty:
+                yield ": keepalive\n\n"
+                continue
+            yield f"id: {event['seq']}\nevent: {event['operation']}\ndata: {json.dumps(event)}\n\n"
+        yield "event: dropped\ndata: {}\n\n"
+    finally:
+        broker.unsubscribe(subscriber)
@@ -0,0 +1,164 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Health Checks
+
+Liveness only says that the worker answers. Readiness also checks that the
+database answers a SELECT 1 within its latency limit, that the connection
+pool has a free connection and that the worker is not overloaded with
+in-flight requests. The readiness result is cached for a few seconds, so
+probes from the kubelet and load balancers add no load on the database.
+"""
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from flask import g, request
+from sqlalchemy import text
+from service.models import db
+
+
+class InFlight:
+    """Counts the requests a worker is serving
+
+    Event streams are long-lived and capped by EVENTS_MAX_SUBSCRIBERS
+    instead, so they are not counted
+    """
+
+    EXEMPT = {"inventory_events"}
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def attach(self, app):
+        """Counts every request of the app"""
+        app.before_request(self.enter)
+        app.teardown_request(self.leave)
+
+    def enter(self):
+        """Counts a request that starts"""
+        if request.endpoint in self.EXEMPT:
+            return
+        with self._lock:
+            self.count += 1
+        g.in_flight = True
+
+    def leave(self, _error=None):
+        """Counts a request that ends, if it was counted when it started"""
+        if g.pop("in_flight", False):
+            with self._lock:
+                self.count -= 1
+
+
+in_flight = InFlight()
+
+
+class Readiness:
+    """Runs the readiness checks at most once per ttl seconds"""
+
+    def __init__(self):
+        self.ttl = 5.0
+        self.db_latency_limit = 1.0
+        self.max_in_flight = 50
+        self._result = None
+        self._expires = 0.0
+        self._lock = threading.Lock()
+
+    def configure(self, config):
+        """Takes the limits from the app configuration"""
+        self.ttl = config["HEALTH_CACHE_TTL"]
+        self.db_latency_limit = config["HEALTH_DB_LATENCY_LIMIT"]
+        self.max_in_flight = config["HEALTH_MAX_IN_FLIGHT"]
+        self._expires = 0.0
+
+    def check(self) -> dict:
+        """Returns the cached result, refreshing it when it has expired
+
+        Only one thread refreshes; the others keep returning the last result
+        """
+        if time.monotonic() >= self._expires and self._lock.acquire(blocking=self._result is None):
+            try:
+                self._result = self._run_checks()
+                self._expires = time.monotonic() + self.ttl
+            finally:
+                self._lock.release()
+        return self._result
+
+    def _run_checks(self) -> dict:
+        """Runs every check and reports whether all of them passed"""
+        pool = check_pool()
+        checks = {
+            "in_flight": {"ok": in_flight.count <= self.max_in_flight, "count": in_flight.count,
+                          "limit": self.max_in_flight},
+            "pool": pool,
+            # an exhausted pool would make the database check wait for a connection
+            "database": check_database(self.db_latency_limit) if pool["ok"] else {"ok": False, "skipped": True},
+        }
+        return {"ready": all(check["ok"] for check in checks.values()), "checks": checks}
+
+
+readiness = Readiness()
+
+
+def init_health(app):
+    """Counts the in-flight requests and configures the readiness checks"""
+    in_flight.attach(app)
+    readiness.configure(app.config)
+
+
+# runs the database check, so a hung connect or SELECT 1 fails the probe
+# instead of hanging it; while one check hangs the next ones time out too
+_database_checker = ThreadPoolExecutor(max_workers=1, thread_name_prefix="health-database")
+
+
+def check_database(latency_limit: float) -> dict:
+    """Times a SELECT 1 and fails when it errors or exceeds the latency limit
+
+    The connect and the statement are given at most latency_limit seconds
+    """
+    start = time.perf_counter()
+    check = _database_checker.submit(_select_one, db.engine, latency_limit)
+    try:
+        check.result(timeout=max(latency_limit, 0))
+    except FutureTimeoutError:
+        return {"ok": False, "error": f"No answer within {latency_limit}s"}
+    except Exception as error:  # pylint: disable=broad-except
+        return {"ok": False, "error": f"{type(error).__name__}: {error}"}
+    latency = time.perf_counter() - start
+    return {"ok": latency <= latency_limit, "latency_ms": round(latency * 1000, 2)}
+
+
+def _select_one(engine, latency_limit: float):
+    """Runs SELECT 1, cancelled by the database once it runs past the latency limit"""
+    with engine.connect() as connection:
+        if connection.dialect.name == "postgresql":
+            connection.exec_driver_sql(f"SET LOCAL statement_timeout = {max(int(latency_limit * 1000), 1)}")
+        connection.execute(text("SELECT 1"))
+
+
+def check_pool() -> dict:
+    """Reports how many pooled connections are in use
+
+    Pools without a limit, like the one SQLite in-memory databases use,
+    always pass
+    """
+    pool = db.engine.pool
+    if not hasattr(pool, "checkedout") or pool._max_overflow < 0:
+        return {"ok": True}
+    capacity = pool.size() + pool._max_overflow
+    checked_out = pool.checkedout()
+    return {"ok": checked_out < capacity, "checked_out": checked_out, "capacity": capacity}
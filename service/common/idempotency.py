@@ -0,0 +1,88 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Idempotency Keys
+
+Requests sent with an Idempotency-Key header are executed once; retries
+with the same key get the stored response back without running again
+"""
+import hashlib
+from functools import wraps
+from flask import request, abort
+from flask import current_app as app  # Import Flask application
+from flask_restx.utils import unpack
+from service.models import IdempotencyKey
+from service.common.background import PeriodicTask
+from . import status
+
+HEADER = "Idempotency-Key"
+MAX_KEY_LENGTH = 255
+
+
+def init_idempotency(flask_app):
+    """Purges the expired keys periodically in every worker"""
+    purge = PeriodicTask(
+        "idempotency-purge",
+        flask_app.config["IDEMPOTENCY_PURGE_INTERVAL"],
+        lambda: IdempotencyKey.purge_expired(flask_app.config["IDEMPOTENCY_PURGE_BATCH_SIZE"]),
+    )
+    purge.attach(flask_app)
+    return purge
+
+
+def idempotent(func):
+    """Makes a resource method replay its stored response for a known key"""
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get(HEADER)
+        if not key:
+            return func(*args, **kwargs)
+        if len(key) > MAX_KEY_LENGTH:
+            abort(status.HTTP_400_BAD_REQUEST, f"{HEADER} must be at most {MAX_KEY_LENGTH} characters")
+
+        endpoint = f"{request.method} {request.path}"
+        fingerprint = hashlib.sha256(request.get_data()).hexdigest()
+        stored = IdempotencyKey.claim(
+            key, endpoint, app.config["IDEMPOTENCY_TTL"], fingerprint, app.config["IDEMPOTENCY_LEASE"]
+        )
+        if stored is not None:
+            return replay(stored, endpoint, fingerprint)
+
+        try:
+            data, code, headers = unpack(func(*args, **kwargs))
+        except Exception:
+            IdempotencyKey.release(key)
+            raise
+        IdempotencyKey.complete(key, data, code, headers.get("Location"))
+        return data, code, headers
+
+    return wrapper
+
+
+def replay(stored, endpoint, fingerprint):
+    """Returns the stored response of an earlier request"""
+    if stored.endpoint != endpoint:
+        abort(status.HTTP_409_CONFLICT, f"{HEADER} was already used for {stored.endpoint}")
+    if stored.fingerprint is not None and stored.fingerprint != fingerprint:
+        abort(status.HTTP_422_UNPROCESSABLE_ENTITY, f"{HEADER} was already used with a different request body")
+    if not stored.completed:
+        abort(status.HTTP_409_CONFLICT, f"A request with this {HEADER} is still in progress")
+    app.logger.info("Replaying stored response for %s", endpoint)
+    data, code, headers = stored.response()
+    headers["Idempotent-Replayed"] = "true"
+    return data, code, headers
@@ -18,19 +18,248 @@
 Log Handlers
 
 This module contains utility functions to set up logging
-consistently
+consistently. With LOG_FORMAT=json every line is a JSON object carrying the
+request id, the latency so far and the time spent in the database, and is
+written by a QueueListener thread so that log I/O stays off the request path
 """
+import os
+import copy
+import json
+import time
+import queue
+import atexit
+import random
 import logging
+import threading
+from logging.handlers import QueueHandler, QueueListener
+from flask import g, request, current_app, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+REQUEST_ID_HEADER = "X-Request-ID"
 
 
 def init_logging(app, logger_name: str):
     """Set up logging for production"""
     app.logger.propagate = False
     gunicorn_logger = logging.getLogger(logger_name)
-    app.logger.handlers = gunicorn_logger.handlers
     app.logger.setLevel(gunicorn_logger.level)
-    # Make all log formats consistent
-    formatter = logging.Formatter("[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s", "%Y-%m-%d %H:%M:%S %z")
-    for handler in app.logger.handlers:
-        handler.setFormatter(formatter)
+    if app.config.get("LOG_FORMAT", "text") == "json":
+        init_json_logging(app, gunicorn_logger.handlers or [logging.StreamHandler()])
+    else:
+        app.logger.handlers = gunicorn_logger.handlers
+        formatter = logging.Formatter("[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s", "%Y-%m-%d %H:%M:%S %z")
+        for handler in app.logger.handlers:
+            handler.setFormatter(formatter)
     app.logger.info("Logging handler established")
+
+
+def init_json_logging(app, handlers: list):
+    """Logs JSON lines through a queue to the given handlers"""
+    formatter = JsonFormatter()
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    queue_handler = AsyncHandler(
+        handlers, app.config.get("LOG_QUEUE_SIZE", 10000), app.config.get("LOG_FLUSH_INTERVAL", 0.2)
+    )
+    queue_handler.addFilter(RequestContextFilter())
+    queue_handler.addFilter(SamplingFilter())
+    app.logger.handlers = [queue_handler]
+    app.extensions["log_queue_handler"] = queue_handler
+    app.before_request(request_timer(app.config.get("LOG_SAMPLE_RATE", 1.0)))
+    app.after_request(log_request)
+    if not event.contains(Engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+        event.listen(Engine, "handle_error", _handle_error)
+
+
+######################################################################
+# Request context
+######################################################################
+def request_timer(sample_rate: float):
+    """Returns a before_request hook that starts timing a request"""
+
+    def start_request():
+        # not uuid4(), whose os.urandom() call costs more than the rest of the logging
+        g.request_id = request.headers.get(REQUEST_ID_HEADER) or f"{random.getrandbits(128):032x}"
+        g.request_start = time.perf_counter()
+        g.db_time = 0.0
+        # INFO lines are kept or dropped for a whole request at once
+        g.log_sampled = sample_rate >= 1 or random.random() < sample_rate
+
+    return start_request
+
+
+def log_request(response):
+    """Echoes the request id and logs one summary line per request"""
+    request_id = g.get("request_id")
+    if request_id is None:
+        return response
+    response.headers[REQUEST_ID_HEADER] = request_id
+    current_app.logger.info(
+        "%s %s %s", request.method, request.path, response.status_code,
+        extra={"status": response.status_code, "always_log": True},
+    )
+    return response
+
+
+def _before_cursor_execute(conn, *_):
+    """Notes when a statement starts"""
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, *_):
+    """Adds the time a statement took to the current request"""
+    elapsed = time.perf_counter() - conn.info["query_start"].pop()
+    if has_request_context() and "db_time" in g:
+        g.db_time += elapsed
+
+
+def _handle_error(context):
+    """Adds the time a failed statement took, which after_cursor_execute never sees"""
+    conn = context.connection
+    if conn is not None and conn.info.get("query_start"):
+        _after_cursor_execute(conn)
+
+
+class RequestContextFilter(logging.Filter):
+    """Adds the request id, latency and database time to each record
+
+    Runs in the thread that logs, where the request context is available
+    """
+
+    def filter(self, record):
+        if has_request_context() and "request_id" in g:
+            record.request_id = g.request_id
+            record.latency_ms = round((time.perf_counter() - g.request_start) * 1000, 2)
+            record.db_ms = round(g.db_time * 1000, 2)
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Drops INFO and DEBUG lines of requests that were not sampled
+
+    Warnings and errors, lines logged outside a request and the request
+    summary line are always kept
+    """
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or getattr(record, "always_log", False):
+            return True
+        return not has_request_context() or g.get("log_sampled", True)
+
+
+######################################################################
+# Formatting and writing
+######################################################################
+class JsonFormatter(logging.Formatter):
+    """Formats records as one JSON object per line"""
+
+    FIELDS = ("request_id", "latency_ms", "db_ms", "status")
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S%z"),
+            "level": record.levelname,
+            "module": record.module,
+            "message": record.getMessage(),
+        }
+        for field in self.FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class BatchQueue(queue.Queue):
+    """A queue that wakes its consumer once per batch instead of per record
+
+    Waking the listener thread for every record costs more than writing the
+    record, so it sleeps until batch_size records are waiting or interval
+    seconds have passed, then writes everything that is queued
+    """
+
+    def __init__(self, maxsize: int = 0, batch_size: int = 100, interval: float = 0.2):
+        super().__init__(maxsize)
+        self.batch_size = batch_size
+        self.interval = interval
+
+    def put(self, item, block=True, timeout=None):
+        with self.not_full:
+            # the stop sentinel is always let through, or stop() would lose the queued records
+            if item is not None and 0 < self.maxsize <= self._qsize():
+                raise queue.Full
+            self._put(item)
+            self.unfinished_tasks += 1
+            # None is the sentinel QueueListener.stop() sends
+            if item is None or self._qsize() >= self.batch_size:
+                self.not_empty.notify()
+
+    def get(self, block=True, timeout=None):
+        with self.not_empty:
+            if not block and not self._qsize():
+                raise queue.Empty
+            while not self._qsize():
+                self.not_empty.wait(self.interval)
+            item = self._get()
+            self.not_full.notify()
+            return item
+
+
+class AsyncHandler(QueueHandler):
+    """Hands records to a QueueListener thread that writes them
+
+    The listener is started by the first record each process logs, so that
+    workers forked from a preloaded app get their own thread. A full queue
+    drops records rather than blocking the request
+    """
+
+    def __init__(self, targets: list, maxsize: int = 0, interval: float = 0.2):
+        super().__init__(BatchQueue(maxsize, interval=interval))
+        self.targets = targets
+        self.dropped = 0
+        self._listener = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def prepare(self, record):
+        """Merges the arguments into the message but keeps the fields apart"""
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        if self._pid != os.getpid():
+            self.start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def start(self):
+        """Starts the listener thread of this process"""
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self.queue = BatchQueue(self.queue.maxsize, self.queue.batch_size, self.queue.interval)
+            self._listener = QueueListener(self.queue, *self.targets, respect_handler_level=True)
+            self._listener.start()
+            self._pid = os.getpid()
+            atexit.register(self.stop)
+
+    def stop(self):
+        """Writes the queued records and stops the listener thread"""
+        with self._start_lock:
+            if self._listener is not None and self._pid == os.getpid():
+                self._listener.stop()
+            self._listener = None
+            self._pid = None
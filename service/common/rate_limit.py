@@ -0,0 +1,304 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Rate Limiting
+
+Each client gets a token bucket per route class (item, collection, restock
+and bulk), keyed by its X-API-Key header when that is one of the configured
+keys, or else by its address. A bucket
+holds up to the limit's number of requests and refills at that many per
+period, so short bursts pass while a sustained flood gets 429 responses.
+Buckets live in a pluggable store: MemoryStore counts per worker,
+SharedStore keeps them in a SQLite file that every worker of a pod uses,
+and RedisStore keeps them in a Redis server that every pod shares. When
+the store fails, the worker falls back to its own buckets.
+"""
+import math
+import time
+import hashlib
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+from flask import g, request, jsonify
+from service.common import status
+from service.common.cache import REDIS_AVAILABLE
+
+logger = logging.getLogger("flask.app")
+
+API_KEY_HEADER = "X-API-Key"
+
+ROUTE_CLASSES = {
+    "inventory_resource": "item",
+    "adjust_resource": "item",
+    "reservation_collection": "item",
+    "reservation_resource": "item",
+    "commit_reservation_resource": "item",
+    "release_reservation_resource": "item",
+    "inventory_collection": "collection",
+    "inventory_change_collection": "collection",
+    "inventory_events": "collection",
+    "restock_resource": "restock",
+    "upsert_collection": "bulk",
+}
+
+
+def parse_limit(limit: str) -> tuple:
+    """Parses "<requests>/<seconds>" into the bucket capacity and refill rate per second"""
+    requests, seconds = limit.split("/")
+    return int(requests), int(requests) / float(seconds)
+
+
+def refill(tokens: float, updated: float, capacity: int, rate: float, now: float) -> float:
+    """Returns the tokens of a bucket after refilling it up to now"""
+    return min(capacity, tokens + max(now - updated, 0) * rate)
+
+
+class Decision:  # pylint: disable=too-few-public-methods
+    """Whether a request may pass and what its rate limit headers say"""
+
+    def __init__(self, allowed: bool, tokens: float, capacity: int, rate: float):
+        self.allowed = allowed
+        self.limit = capacity
+        self.remaining = int(tokens)
+        # a denied request waits for one token, an allowed one reports when the bucket is full again
+        missing = 1 - tokens if not allowed else capacity - tokens
+        self.reset = max(math.ceil(missing / rate), 0)
+
+
+######################################################################
+# Stores
+######################################################################
+class MemoryStore:
+    """Keeps the buckets of one worker in a dictionary of at most max_keys buckets"""
+
+    def __init__(self, max_keys: int = 10000):
+        self.max_keys = max_keys
+        # least recently used first, each with the capacity and rate of its route class
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key: str, capacity: int, rate: float, now: float = None) -> Decision:
+        """Takes a token from a bucket if it has one"""
+        now = time.time() if now is None else now
+        with self._lock:
+            tokens, updated, _, _ = self._buckets.get(key, (capacity, now, capacity, rate))
+            tokens = refill(tokens, updated, capacity, rate, now)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            if len(self._buckets) >= self.max_keys and key not in self._buckets:
+                self._prune(now)
+            self._buckets[key] = (tokens, now, capacity, rate)
+            self._buckets.move_to_end(key)
+        return Decision(allowed, tokens, capacity, rate)
+
+    def _prune(self, now: float):
+        """Forgets the buckets that have refilled completely, then the least recently used ones"""
+        full = [key for key, (tokens, updated, capacity, rate) in self._buckets.items()
+                if refill(tokens, updated, capacity, rate, now) >= capacity]
+        for key in full:
+            del self._buckets[key]
+        while len(self._buckets) >= self.max_keys:
+            self._buckets.popitem(last=False)
+
+
+class SharedStore:
+    """Keeps the buckets in a SQLite file shared by the workers of a pod
+
+    Every take is one IMMEDIATE transaction, which serializes the workers
+    on the file lock; the write-ahead log keeps the commits from syncing
+    the file. Each pod has its own file, so the limits are per pod.
+    """
+
+    def __init__(self, path: str, timeout: float = 1.0):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        self._connection().execute("PRAGMA journal_mode = WAL")
+        self._connection().execute(
+            "CREATE TABLE IF NOT EXISTS rate_limit_bucket (key TEXT PRIMARY KEY, tokens REAL, updated REAL)"
+        )
+
+    def _connection(self) -> sqlite3.Connection:
+        """Returns the connection of the current thread"""
+        if not hasattr(self._local, "connection"):
+            connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            # a bucket lost in a crash only refills early
+            connection.execute("PRAGMA synchronous = NORMAL")
+            self._local.connection = connection
+        return self._local.connection
+
+    def take(self, key: str, capacity: int, rate: float, now: float = None) -> Decision:
+        """Takes a token from a bucket if it has one"""
+        now = time.time() if now is None else now
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute("SELECT tokens, updated FROM rate_limit_bucket WHERE key = ?", (key,)).fetchone()
+            tokens = refill(*(row or (capacity, now)), capacity, rate, now)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            connection.execute(
+                "INSERT INTO rate_limit_bucket (key, tokens, updated) VALUES (?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated",
+                (key, tokens, now),
+            )
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+        return Decision(allowed, tokens, capacity, rate)
+
+
+# refills and takes from a bucket hash in one atomic step, which expires once it would be full again
+TAKE_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call("HMGET", KEYS[1], "tokens", "updated")
+local tokens = tonumber(bucket[1]) or capacity
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(now - updated, 0) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call("HSET", KEYS[1], "tokens", tostring(tokens), "updated", tostring(now))
+redis.call("PEXPIRE", KEYS[1], math.ceil((capacity - tokens) / rate * 1000) + 1000)
+return {allowed, tostring(tokens)}
+"""
+
+
+class RedisStore:
+    """Keeps the buckets in a Redis server shared by every pod
+
+    The client may be anything with the eval method of redis-py, such as a
+    local stand-in in tests. Each take is one script call, so it costs one
+    round trip and needs no lock.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    @classmethod
+    def from_url(cls, url: str, timeout: float = 0.1):
+        """Connects to the Redis server at a redis:// URL"""
+        # pylint: disable=import-outside-toplevel
+        import redis
+
+        return cls(redis.Redis.from_url(url, socket_timeout=timeout, socket_connect_timeout=timeout))
+
+    def take(self, key: str, capacity: int, rate: float, now: float = None) -> Decision:
+        """Takes a token from a bucket if it has one"""
+        now = time.time() if now is None else now
+        allowed, tokens = self.client.eval(TAKE_SCRIPT, 1, f"rate_limit:{key}", capacity, repr(rate), repr(now))
+        return Decision(bool(allowed), float(tokens), capacity, rate)
+
+
+######################################################################
+# The limiter
+######################################################################
+class RateLimiter:
+    """Checks every request against the bucket of its client and route class"""
+
+    def __init__(self):
+        self.enabled = False
+        self.store = MemoryStore()
+        # the buckets of this worker, used while the store fails
+        self.fallback = MemoryStore()
+        self.limits = {}
+        self.api_keys = frozenset()
+
+    def configure(self, config):
+        """Takes the limits and the store from the app configuration"""
+        self.enabled = config["RATE_LIMIT_ENABLED"]
+        self.limits = {name: parse_limit(limit) for name, limit in config["RATE_LIMITS"].items()}
+        self.api_keys = frozenset(config["RATE_LIMIT_API_KEYS"])
+        self.fallback = MemoryStore(config["RATE_LIMIT_MAX_KEYS"])
+        name = config["RATE_LIMIT_STORE"]
+        if name == "redis" and REDIS_AVAILABLE:
+            self.store = RedisStore.from_url(config["RATE_LIMIT_URL"])
+        elif name == "shared":
+            self.store = SharedStore(config["RATE_LIMIT_SHARED_PATH"])
+        else:
+            if name == "redis":
+                logger.warning("The redis package is not installed, rate limits are per worker")
+            self.store = self.fallback
+
+    def attach(self, app):
+        """Limits the requests of the app and adds the headers to its responses"""
+        app.before_request(self.check)
+        app.after_request(add_headers)
+
+    def check(self):
+        """Returns a 429 response when the client has used up its bucket"""
+        route_class = ROUTE_CLASSES.get(request.endpoint)
+        if not self.enabled or route_class not in self.limits:
+            return None
+        capacity, rate = self.limits[route_class]
+        key = f"{route_class}:{client_key(self.api_keys)}"
+        try:
+            decision = self.store.take(key, capacity, rate)
+        except Exception as error:  # pylint: disable=broad-except
+            # an unavailable store must neither take the service down nor lift the limits
+            logger.warning("Rate limit store failed, counting in this worker: %s", error)
+            decision = self.fallback.take(key, capacity, rate)
+        g.rate_limit = decision
+        if decision.allowed:
+            return None
+        response = jsonify(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            error="Too Many Requests",
+            message=f"Rate limit of {capacity} {route_class} requests exceeded; retry in {decision.reset} s",
+        )
+        response.status_code = status.HTTP_429_TOO_MANY_REQUESTS
+        response.headers["Retry-After"] = str(decision.reset)
+        return response
+
+
+limiter = RateLimiter()
+
+
+def init_rate_limit(app):
+    """Rate limits the requests of the app"""
+    limiter.configure(app.config)
+    limiter.attach(app)
+
+
+def client_key(api_keys: frozenset) -> str:
+    """Identifies the client by its API key, or else by its address
+
+    Only the keys in api_keys count, so that made-up keys cannot be rotated
+    to get fresh buckets; the key itself is never stored
+    """
+    api_key = request.headers.get(API_KEY_HEADER)
+    if api_key and api_key in api_keys:
+        return f"key:{hashlib.sha256(api_key.encode()).hexdigest()[:32]}"
+    return f"ip:{request.remote_addr}"
+
+
+def add_headers(response):
+    """Adds the RateLimit headers of the request's bucket to its response"""
+    decision = g.pop("rate_limit", None)
+    if decision is not None:
+        response.headers["RateLimit-Limit"] = str(decision.limit)
+        response.headers["RateLimit-Remaining"] = str(decision.remaining)
+        response.headers["RateLimit-Reset"] = str(decision.reset)
+    return response
@@ -0,0 +1,34 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Reservation Sweeper
+
+Expired holds are released in batches by every worker in the background
+"""
+from service.models import Reservation
+from service.common.background import PeriodicTask
+
+
+def init_reservations(app):
+    """Releases the expired reservations periodically in every worker"""
+    sweeper = PeriodicTask(
+        "reservation-sweep",
+        app.config["RESERVATION_SWEEP_INTERVAL"],
+        lambda: Reservation.release_expired(app.config["RESERVATION_SWEEP_BATCH_SIZE"]),
+    )
+    sweeper.attach(app)
+    return sweeper
@@ -0,0 +1,167 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Database Resilience
+
+Transient database errors, like a connection dropped by a PostgreSQL
+failover, are retried with jittered exponential backoff so that workers
+do not reconnect in lockstep. A circuit breaker counts the operations that
+still fail and, once the database looks down, fails every operation fast
+until a trial operation succeeds again.
+"""
+import time
+import random
+import logging
+import threading
+from retry.api import retry_call
+from sqlalchemy.exc import DBAPIError, DisconnectionError, InterfaceError
+
+logger = logging.getLogger("flask.app")
+
+# SQLSTATEs of connection failures and server shutdowns (class 08 is all connection exceptions)
+TRANSIENT_SQLSTATES = ("08", "57P01", "57P02", "57P03")
+
+
+def is_transient(error) -> bool:
+    """Checks whether a database error is worth retrying on a new connection"""
+    if isinstance(error, (DisconnectionError, InterfaceError)):
+        return True
+    if not isinstance(error, DBAPIError):
+        return False
+    if error.connection_invalidated:
+        return True
+    sqlstate = getattr(error.orig, "sqlstate", None)
+    if sqlstate is None:
+        # psycopg reports failures to connect without a SQLSTATE
+        return type(error.orig).__module__.startswith("psycopg") and type(error.orig).__name__ == "OperationalError"
+    return sqlstate.startswith(TRANSIENT_SQLSTATES)
+
+
+class DatabaseConnectionError(Exception):
+    """Custom Exception when database connection fails"""
+
+
+class TransientError(Exception):
+    """Wraps a transient database error so that only those are retried"""
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling the database while the circuit is open"""
+
+
+class CircuitBreaker:
+    """Opens after failure_threshold consecutive failures and lets a single
+    trial call through every reset_timeout seconds until one succeeds
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 10):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        """Returns closed, open or half-open"""
+        if self.opened_at is None:
+            return "closed"
+        return "half-open" if time.monotonic() - self.opened_at >= self.reset_timeout else "open"
+
+    def allow(self):
+        """Raises CircuitOpenError unless a call may go to the database"""
+        if self.opened_at is None:
+            return
+        with self._lock:
+            if self.state == "half-open" and not self._trial:
+                self._trial = True
+                return
+        raise CircuitOpenError(f"The database is unavailable, not retrying for up to {self.reset_timeout:.0f} s")
+
+    def success(self):
+        """Closes the circuit after a call that reached the database"""
+        if self.failures or self.opened_at is not None:
+            with self._lock:
+                if self.opened_at is not None:
+                    logger.info("Database is back, closing the circuit")
+                self.failures = 0
+                self.opened_at = None
+                self._trial = False
+
+    def failure(self):
+        """Counts a failed call, opening the circuit at the threshold"""
+        with self._lock:
+            self.failures += 1
+            self._trial = False
+            if self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    logger.critical("Database is unavailable, opening the circuit for %s s", self.reset_timeout)
+                self.opened_at = time.monotonic()
+
+
+class RetryPolicy:  # pylint: disable=too-few-public-methods
+    """Retries transient errors with exponential backoff and jitter"""
+
+    def __init__(self, tries: int = 3, delay: float = 0.1, max_delay: float = 2.0):
+        self.tries = tries
+        self.delay = delay
+        self.max_delay = max_delay
+
+    def call(self, func, on_retry=None, retry: bool = True):
+        """Calls func, retrying transient errors; raises TransientError when they persist
+
+        on_retry is called before every retry to reset any state the failed
+        attempt left behind
+        """
+        attempts = []
+
+        def attempt():
+            if attempts and on_retry is not None:
+                on_retry()
+            attempts.append(None)
+            try:
+                return func()
+            except Exception as error:
+                if is_transient(error):
+                    raise TransientError(str(error)) from error
+                raise
+
+        return retry_call(
+            attempt,
+            exceptions=TransientError,
+            tries=self.tries if retry else 1,
+            # a random first delay spreads the workers out from the first retry on
+            delay=random.uniform(0, self.delay),
+            max_delay=self.max_delay,
+            backoff=2,
+            jitter=(0, self.delay),
+            logger=logger,
+        )
+
+
+breaker = CircuitBreaker()
+policy = RetryPolicy()
+
+
+def init_resilience(app):
+    """Takes the retry and circuit breaker settings from the app configuration"""
+    policy.tries = app.config["DB_RETRY_COUNT"]
+    policy.delay = app.config["DB_RETRY_DELAY"]
+    policy.max_delay = app.config["DB_RETRY_MAX_DELAY"]
+    breaker.failure_threshold = app.config["DB_BREAKER_THRESHOLD"]
+    breaker.reset_timeout = app.config["DB_BREAKER_RESET_TIMEOUT"]
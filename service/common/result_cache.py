@@ -0,0 +1,71 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+List Result Cache
+
+The bytes of list responses are cached in the cache tier, keyed on the
+normalized query arguments, the media type and the generations of the
+category they filter on (of every category when they do not). A write
+bumps the generations of the categories it touches, so the lists that may
+have changed get new keys while the others keep being served without a
+query or any serialization.
+"""
+from urllib.parse import urlencode
+import msgpack
+from flask import request, Response
+from service.common.cache import cache
+
+# the filters Inventory.search() ignores when they are empty, like ?category=
+FILTERS = ("name", "category", "quantity", "restock_level", "condition")
+
+
+def result_key(args: dict, mimetype: str, generations: str) -> str:
+    """Returns the cache key of a list response"""
+    normalized = sorted((name, value) for name, value in args.items() if value is not None)
+    # the Link header of a full page holds the request's URL
+    return f"list:{generations}:{mimetype}:{request.base_url}?{urlencode(normalized)}"
+
+
+# marks a page forced on a list request that asked for every item
+TRUNCATED_HEADER = "X-Result-Truncated"
+# the headers of a list response that describe its page
+PAGE_HEADERS = ("Link", TRUNCATED_HEADER)
+
+
+def pack(response: Response) -> bytes:
+    """Packs the body, media type and page headers of a response"""
+    headers = {name: response.headers[name] for name in PAGE_HEADERS if name in response.headers}
+    return msgpack.packb([response.get_data(), response.mimetype, headers])
+
+
+def unpack(data: bytes) -> Response:
+    """Rebuilds a packed response"""
+    body, mimetype, headers = msgpack.unpackb(data)
+    response = Response(body, mimetype=mimetype)
+    response.headers.extend(headers)
+    return response
+
+
+def cached_list(args: dict, mimetype: str, build) -> Response:
+    """Returns the cached list response of the arguments, building it with build() on a miss"""
+    # an empty filter lists every item, so it shares the key and the generations of no filter
+    args = dict(args, **{name: args.get(name) or None for name in FILTERS})
+    generations = cache.generations(args["category"]) if cache.enabled else None
+    if generations is None:
+        return build()
+    data = cache.get(result_key(args, mimetype, generations), lambda: pack(build()), ttl=cache.result_ttl)
+    return unpack(data)
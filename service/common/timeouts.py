@@ -0,0 +1,92 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Statement Timeouts
+
+Every transaction a request opens gets the statement timeout of its route
+class (SET LOCAL statement_timeout on PostgreSQL), so a runaway query is
+cancelled instead of holding its connection. SQLite has no statement
+timeout, so there each statement is interrupted through a progress handler
+once it runs past the deadline. Cancelled statements are answered with 503
+by the error handlers.
+"""
+import time
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from service.common.rate_limit import ROUTE_CLASSES
+
+# SQLSTATE of a statement cancelled by statement_timeout on PostgreSQL
+QUERY_CANCELED = "57014"
+# SQLite virtual machine instructions between two deadline checks
+PROGRESS_STEPS = 10000
+
+
+def init_timeouts(app):
+    """Applies the statement timeout of each request's route class"""
+    timeouts = app.config["STATEMENT_TIMEOUTS"]
+
+    def choose_timeout():
+        g.statement_timeout = timeouts.get(ROUTE_CLASSES.get(request.endpoint), timeouts["default"])
+
+    app.before_request(choose_timeout)
+    if not event.contains(Session, "after_begin", _set_local_timeout):
+        event.listen(Session, "after_begin", _set_local_timeout)
+        event.listen(Engine, "before_cursor_execute", _start_deadline)
+        event.listen(Engine, "after_cursor_execute", _clear_deadline)
+        event.listen(Engine, "handle_error", _clear_deadline_on_error)
+
+
+def current_timeout() -> int:
+    """Returns the statement timeout of the current request in milliseconds, 0 for none"""
+    return g.get("statement_timeout", 0) if has_request_context() else 0
+
+
+def is_statement_timeout(error) -> bool:
+    """Checks whether a database error is a statement cancelled by its timeout"""
+    original = getattr(error, "orig", None)
+    if getattr(original, "sqlstate", None) == QUERY_CANCELED:
+        return True
+    return str(original) == "interrupted"
+
+
+def _set_local_timeout(_session, _transaction, connection):
+    """Sets the statement timeout of a transaction on PostgreSQL"""
+    timeout = current_timeout()
+    if timeout and connection.dialect.name == "postgresql":
+        connection.exec_driver_sql(f"SET LOCAL statement_timeout = {int(timeout)}")
+
+
+def _start_deadline(conn, *_):
+    """Interrupts a SQLite statement that runs past the timeout"""
+    timeout = current_timeout()
+    if timeout and conn.dialect.name == "sqlite":
+        deadline = time.monotonic() + timeout / 1000
+        conn.connection.driver_connection.set_progress_handler(lambda: time.monotonic() > deadline, PROGRESS_STEPS)
+
+
+def _clear_deadline(conn, *_):
+    """Removes the deadline of a SQLite statement"""
+    if conn.dialect.name == "sqlite":
+        conn.connection.driver_connection.set_progress_handler(None, PROGRESS_STEPS)
+
+
+def _clear_deadline_on_error(context):
+    """Removes the deadline of a SQLite statement that failed"""
+    if context.connection is not None and not context.connection.closed:
+        _clear_deadline(context.connection)
@@ -0,0 +1,314 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Request Tracing
+
+Records a span for each traced request, the JSON parsing of its body, each
+model method it calls and each SQL statement it runs, and exports the spans
+of a request together once it ends. Trace context is taken from and returned
+in W3C traceparent headers; requests that arrive without one are sampled at
+TRACE_SAMPLE_RATE. When a request is not sampled nothing is recorded and a
+traced call costs one context variable lookup.
+"""
+import json
+import time
+import random
+import functools
+import threading
+from contextvars import ContextVar
+from contextlib import contextmanager
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+TRACEPARENT = "traceparent"
+STATEMENT_LENGTH = 200
+
+_current = ContextVar("current_span", default=None)
+
+
+######################################################################
+# Spans and sinks
+######################################################################
+class Span:  # pylint: disable=too-many-instance-attributes
+    """A timed operation within a trace"""
+
+    def __init__(self, name: str, trace_id: str, parent_id: str = None, spans: list = None, **attributes):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.error = None
+        self.start = time.time()
+        self.duration_ms = None
+        self._started = time.perf_counter()
+        # the spans of the whole trace, shared with the root span
+        self.spans = spans if spans is not None else []
+        self.spans.append(self)
+
+    def child(self, name: str, **attributes) -> "Span":
+        """Starts a span within this one"""
+        return Span(name, self.trace_id, self.span_id, self.spans, **attributes)
+
+    def end(self, error: BaseException = None):
+        """Records the duration and the error that ended the span, if any"""
+        self.duration_ms = round((time.perf_counter() - self._started) * 1000, 3)
+        if error is not None:
+            self.error = f"{type(error).__name__}: {error}"
+
+    def traceparent(self) -> str:
+        """Returns the W3C traceparent header of this span"""
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    def to_dict(self) -> dict:
+        """Returns the span as a dictionary"""
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start": self.start,
+            "duration_ms": self.duration_ms,
+            "error": self.error,
+            "attributes": self.attributes,
+        }
+
+
+class MemorySink:
+    """Keeps exported spans in a list, for tests"""
+
+    def __init__(self):
+        self.spans = []
+
+    def export(self, spans: list):
+        """Appends the spans of a trace"""
+        self.spans.extend(spans)
+
+    def names(self) -> list:
+        """Returns the names of the exported spans in the order they started"""
+        return [span.name for span in self.spans]
+
+    def clear(self):
+        """Forgets every exported span"""
+        self.spans.clear()
+
+
+class FileSink:
+    """Appends each span to a file as a line of JSON"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, spans: list):
+        """Writes the spans of a trace"""
+        lines = "".join(json.dumps(span.to_dict(), default=str) + "\n" for span in spans)
+        with self._lock, open(self.path, "a", encoding="utf-8") as file:
+            file.write(lines)
+
+
+# TRACE_EXPORTER names; any object with an export(spans) method can be
+# assigned to tracer.sink instead
+SINKS = {
+    "none": lambda config: None,
+    "memory": lambda config: MemorySink(),
+    "file": lambda config: FileSink(config["TRACE_FILE"]),
+}
+
+
+######################################################################
+# The tracer
+######################################################################
+class Tracer:
+    """Starts, samples and exports traces"""
+
+    def __init__(self, sink=None, sample_rate: float = 1.0):
+        self.sink = sink
+        self.sample_rate = sample_rate
+
+    def start_trace(self, name: str, traceparent: str = None, **attributes):
+        """Starts the root span of a trace, or returns None when it is not sampled
+
+        A valid traceparent continues the caller's trace and its sampled
+        flag decides instead of the sample rate
+        """
+        if self.sink is None:
+            return None
+        parent = parse_traceparent(traceparent)
+        if parent is not None:
+            trace_id, parent_id, sampled = parent
+        else:
+            trace_id, parent_id = f"{random.getrandbits(128):032x}", None
+            sampled = random.random() < self.sample_rate
+        if not sampled:
+            return None
+        return Span(name, trace_id, parent_id, **attributes)
+
+    def end_trace(self, root: Span, error: BaseException = None):
+        """Ends the root span and exports the whole trace"""
+        root.end(error)
+        if self.sink is not None:
+            self.sink.export(root.spans)
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        """Records the enclosed code as a child of the current span, if any"""
+        parent = _current.get()
+        if parent is None:
+            yield None
+            return
+        span = parent.child(name, **attributes)
+        token = _current.set(span)
+        try:
+            yield span
+        except BaseException as error:
+            span.end(error)
+            raise
+        else:
+            span.end()
+        finally:
+            _current.reset(token)
+
+
+tracer = Tracer()
+
+
+def current_span():
+    """Returns the span being recorded, if any"""
+    return _current.get()
+
+
+def parse_traceparent(header: str):
+    """Returns the trace id, parent span id and sampled flag of a W3C traceparent
+
+    Returns None when the header is missing or malformed
+    """
+    parts = (header or "").strip().lower().split("-")
+    if [len(part) for part in parts] != [2, 32, 16, 2] or parts[0] == "ff":
+        return None
+    try:
+        trace_id, parent_id, flags = (int(part, 16) for part in parts[1:])
+    except ValueError:
+        return None
+    if not trace_id or not parent_id:
+        return None
+    return parts[1], parts[2], bool(flags & 1)
+
+
+######################################################################
+# Instrumentation
+######################################################################
+def traced(function, name: str):
+    """Wraps a function in a span named name"""
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if _current.get() is None:
+            return function(*args, **kwargs)
+        with tracer.span(name):
+            return function(*args, **kwargs)
+
+    return wrapper
+
+
+def trace_methods(cls):
+    """Class decorator that records a span for each method of the class
+
+    Instance methods, class methods and static methods defined on the class
+    itself are wrapped; dunder methods are left alone
+    """
+    for attribute, value in list(vars(cls).items()):
+        if attribute.startswith("__"):
+            continue
+        name = f"{cls.__name__}.{attribute}"
+        if isinstance(value, (classmethod, staticmethod)):
+            setattr(cls, attribute, type(value)(traced(value.__func__, name)))
+        elif callable(value) and hasattr(value, "__code__"):
+            setattr(cls, attribute, traced(value, name))
+    return cls
+
+
+def init_tracing(app):
+    """Traces the requests of the app and the SQL statements they run"""
+    tracer.sink = SINKS[app.config.get("TRACE_EXPORTER", "none")](app.config)
+    tracer.sample_rate = app.config.get("TRACE_SAMPLE_RATE", 1.0)
+
+    class TracedRequest(app.request_class):  # pylint: disable=too-many-ancestors
+        """Records the parsing of the request body"""
+
+        def get_json(self, *args, **kwargs):
+            with tracer.span("request.get_json"):
+                return super().get_json(*args, **kwargs)
+
+    app.request_class = TracedRequest
+    app.before_request(start_request_span)
+    app.after_request(add_traceparent)
+    app.teardown_request(end_request_span)
+    if not event.contains(Engine, "before_cursor_execute", _start_statement):
+        event.listen(Engine, "before_cursor_execute", _start_statement)
+        event.listen(Engine, "after_cursor_execute", _end_statement)
+        event.listen(Engine, "handle_error", _fail_statement)
+
+
+def start_request_span():
+    """Starts the trace of a request"""
+    rule = request.url_rule.rule if request.url_rule else request.path
+    root = tracer.start_trace(f"{request.method} {rule}", request.headers.get(TRACEPARENT),
+                              method=request.method, path=request.path)
+    if root is not None:
+        g.trace_root = root
+        g.trace_token = _current.set(root)
+
+
+def add_traceparent(response):
+    """Returns the trace context to the caller"""
+    root = g.get("trace_root")
+    if root is not None:
+        root.attributes["status"] = response.status_code
+        response.headers[TRACEPARENT] = root.traceparent()
+    return response
+
+
+def end_request_span(error=None):
+    """Ends the trace of a request and exports it"""
+    root = g.pop("trace_root", None)
+    if root is not None:
+        _current.reset(g.pop("trace_token"))
+        tracer.end_trace(root, error)
+
+
+def _start_statement(conn, _cursor, statement, *_):
+    """Starts a span for a SQL statement run within a trace"""
+    parent = _current.get()
+    if parent is not None:
+        span = parent.child(f"SQL {statement.split(None, 1)[0].upper()}", statement=statement[:STATEMENT_LENGTH])
+        conn.info.setdefault("trace_spans", []).append(span)
+
+
+def _end_statement(conn, *_):
+    """Ends the span of a SQL statement"""
+    spans = conn.info.get("trace_spans")
+    if spans:
+        spans.pop().end()
+
+
+def _fail_statement(context):
+    """Ends the span of a SQL statement that raised"""
+    spans = context.connection.info.get("trace_spans") if context.connection is not None else None
+    if spans:
+        spans.pop().end(context.original_exception)
@@ -0,0 +1,180 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Transactions
+
+Model writes commit one by one, unless they run inside unit_of_work(),
+which defers their commits to a single one at the end and gives every write
+a savepoint of its own. Model methods are made resilient to lost database
+connections with the retries and the circuit breaker of the resilience
+module.
+"""
+import functools
+from contextlib import contextmanager
+from contextvars import ContextVar
+from flask import current_app
+from sqlalchemy import inspect
+from sqlalchemy.exc import InterfaceError, OperationalError
+from sqlalchemy.orm import InstanceState
+from service.common.resilience import breaker, policy, CircuitOpenError, DatabaseConnectionError, TransientError
+
+
+def session():
+    """Returns the scoped session of the application's Flask-SQLAlchemy object"""
+    return current_app.extensions["sqlalchemy"].session
+
+
+# errors of the connection rather than of the data, which are not turned into DataValidationError
+CONNECTION_ERRORS = (OperationalError, InterfaceError)
+
+
+class UnitOfWork:
+    """Runs the Inventory writes of a request or job in a single transaction
+
+    Inside unit_of_work() the writes release a savepoint instead of
+    committing, and a failed write rolls back to its savepoint, so the
+    caller can skip it and carry on. A savepoint is always open, so an
+    update() also flushes the changes made to its item inside it.
+    """
+
+    def __init__(self):
+        connection = session().connection()
+        if connection.dialect.name == "sqlite" and not connection.connection.driver_connection.in_transaction:
+            # pysqlite only begins a transaction before a write, the first SAVEPOINT would become it
+            connection.exec_driver_sql("BEGIN")
+        self.savepoint = session().begin_nested()
+
+    def _check(self):
+        # a failed flush only ends the savepoint, a lost connection ends the transaction
+        if not self.savepoint.parent.is_active:
+            raise DatabaseConnectionError("The unit of work was rolled back after a database error")
+
+    def release(self):
+        """Keeps the writes since the last savepoint and starts the next one"""
+        self._check()
+        self.savepoint.commit()
+        self.savepoint = session().begin_nested()
+
+    def rollback(self):
+        """Undoes the writes since the last savepoint and starts the next one"""
+        self._check()
+        self.savepoint.rollback()
+        self.savepoint = session().begin_nested()
+
+    def commit(self):
+        """Commits every write of the unit of work"""
+        self._check()
+        self.savepoint.commit()
+        session().commit()
+
+
+_unit_of_work = ContextVar("unit_of_work", default=None)
+
+
+@contextmanager
+def unit_of_work():
+    """Defers the commits of the Inventory writes inside it to a single one at the end
+
+    Everything is rolled back when an exception leaves the block; a unit of
+    work nested in another one joins it. Writes are not retried inside it.
+    """
+    work = _unit_of_work.get()
+    if work is not None:
+        yield work
+        return
+    work = UnitOfWork()
+    token = _unit_of_work.set(work)
+    try:
+        yield work
+        work.commit()
+    except BaseException:
+        session().rollback()
+        raise
+    finally:
+        _unit_of_work.reset(token)
+
+
+def commit_write():
+    """Commits a write, or only releases its savepoint inside a unit of work"""
+    work = _unit_of_work.get()
+    if work is None:
+        session().commit()
+    else:
+        work.release()
+
+
+def rollback_write(error: Exception = None):
+    """Rolls back a failed write, only to its savepoint inside a unit of work
+
+    A connection error rolls back the whole session, since the connection
+    is gone, and is raised again for resilient() to handle
+    """
+    if isinstance(error, CONNECTION_ERRORS):
+        session().rollback()
+        raise error
+    work = _unit_of_work.get()
+    if work is None:
+        session().rollback()
+    else:
+        work.rollback()
+
+
+def resilient(retry: bool = True):
+    """Retries transient database errors and fails fast while the circuit is open
+
+    Only reads and idempotent writes may be retried; the columns of an
+    instance are restored before each retry since the rollback expires them.
+    Raises DatabaseConnectionError once the database looks unavailable.
+
+    Args:
+        retry (bool): False to keep the circuit breaker but never retry
+    """
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            try:
+                breaker.allow()
+            except CircuitOpenError as error:
+                raise DatabaseConnectionError(str(error)) from error
+            # a retry would replay only the last write of a unit of work
+            retrying = retry and _unit_of_work.get() is None
+            instance = args[0] if args and isinstance(inspect(args[0], raiseerr=False), InstanceState) else None
+            # only the loaded values, reading expired ones would query the database
+            state = {key: value for key, value in inspect(instance).dict.items() if key in instance.__table__.c} \
+                if instance is not None and retrying else {}
+
+            def reset():
+                session().rollback()
+                for key, value in state.items():
+                    setattr(instance, key, value)
+
+            try:
+                result = policy.call(lambda: function(*args, **kwargs), on_retry=reset, retry=retrying)
+            except TransientError as error:
+                breaker.failure()
+                session().rollback()
+                raise DatabaseConnectionError(f"Database unavailable: {error}") from error.__cause__
+            except Exception:
+                breaker.success()
+                raise
+            breaker.success()
+            return result
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,92 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Payload Validation
+
+A Schema is compiled once from its fields into a list of checks, so that
+validating a payload is a single pass of plain comparisons with no
+per-call setup. Every problem is reported as a structured error instead
+of stopping at the first one.
+"""
+
+
+class Field:  # pylint: disable=too-few-public-methods
+    """A field of a payload
+
+    Args:
+        name (str): the key of the field
+        kind (type): the exact type the value must have (bool is not an int)
+        choices (iterable): the allowed values, if limited
+        required (bool): whether the field must be present
+    """
+
+    def __init__(self, name: str, kind: type, choices=None, required: bool = True):
+        self.name = name
+        self.kind = kind
+        self.choices = frozenset(choices) if choices is not None else None
+        self.required = required
+
+
+class Schema:
+    """A precompiled validator for dictionaries of fields"""
+
+    def __init__(self, *fields: Field):
+        self.fields = fields
+        self._checks = [self._compile(field) for field in fields]
+
+    @staticmethod
+    def _compile(field: Field):
+        """Returns a function that returns the error of one field or None"""
+        name, kind, choices, required = field.name, field.kind, field.choices, field.required
+        type_error = {"field": name, "message": f"must be of type {kind.__name__}"}
+        missing_error = {"field": name, "message": "is required"}
+        choice_error = {"field": name, "message": f"must be one of {', '.join(sorted(choices or ()))}"}
+
+        def check(data: dict):
+            if name not in data:
+                return missing_error if required else None
+            value = data[name]
+            if type(value) is not kind:  # pylint: disable=unidiomatic-typecheck
+                return type_error
+            if choices is not None and value not in choices:
+                return choice_error
+            return None
+
+        return check
+
+    def validate(self, data) -> list:
+        """Returns the errors of a payload, an empty list when it is valid"""
+        if not isinstance(data, dict):
+            return [{"field": None, "message": "must be an object"}]
+        return [error for error in (check(data) for check in self._checks) if error is not None]
+
+    def validate_many(self, payloads: list) -> list:
+        """Returns the errors of many payloads, each with the index of its payload"""
+        return [
+            dict(error, index=index)
+            for index, payload in enumerate(payloads)
+            for error in self.validate(payload)
+        ]
+
+
+def describe(errors: list) -> str:
+    """Joins structured errors into one message"""
+    return "; ".join(
+        (f"item {error['index']}: " if "index" in error else "")
+        + (f"{error['field']} {error['message']}" if error["field"] else error["message"])
+        for error in errors
+    )
@@ -0,0 +1,67 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Wire Formats
+
+This module negotiates the representation of list responses from the
+Accept header and encodes them as MessagePack or an Arrow IPC stream
+"""
+import importlib.util
+import msgpack
+from flask import request, Response
+
+# pyarrow is optional and slow to import, so it is only loaded when an
+# Arrow response is actually requested
+ARROW_AVAILABLE = importlib.util.find_spec("pyarrow") is not None
+
+JSON = "application/json"
+MSGPACK = "application/x-msgpack"
+ARROW = "application/vnd.apache.arrow.stream"
+
+
+def available() -> list:
+    """Returns the media types this server can produce, JSON first"""
+    mimetypes = [JSON, MSGPACK]
+    if ARROW_AVAILABLE:
+        mimetypes.append(ARROW)
+    return mimetypes
+
+
+def negotiate() -> str:
+    """Returns the media type that best matches the Accept header
+
+    JSON is returned when the client accepts anything or nothing that
+    this server can produce
+    """
+    return request.accept_mimetypes.best_match(available(), default=JSON)
+
+
+def msgpack_response(rows: list) -> Response:
+    """Encodes a list of serialized items as MessagePack"""
+    return Response(msgpack.packb(rows), mimetype=MSGPACK)
+
+
+def arrow_response(columns: dict) -> Response:
+    """Encodes a dictionary of column name to values as an Arrow IPC stream"""
+    # pylint: disable=import-outside-toplevel
+    import pyarrow
+    import pyarrow.ipc
+    table = pyarrow.table(columns)
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return Response(sink.getvalue().to_pybytes(), mimetype=ARROW)
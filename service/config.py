@@ -14,7 +14,180 @@ DATABASE_URI = os.getenv(
 SQLALCHEMY_DATABASE_URI = DATABASE_URI
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 # SQLALCHEMY_POOL_SIZE = 2
+# test pooled connections before use, so that those a failover closed are replaced
+SQLALCHEMY_ENGINE_OPTIONS = {"pool_pre_ping": True}
+
+# Reads and idempotent writes are tried up to DB_RETRY_COUNT times on transient
+# connection errors, sleeping DB_RETRY_DELAY seconds with jitter, doubled on
+# each retry up to DB_RETRY_MAX_DELAY; after DB_BREAKER_THRESHOLD operations
+# fail in a row every operation fails fast with 503 for DB_BREAKER_RESET_TIMEOUT
+# seconds before one is let through to test the database
+DB_RETRY_COUNT = int(os.getenv("DB_RETRY_COUNT", "3"))
+DB_RETRY_DELAY = float(os.getenv("DB_RETRY_DELAY", "0.1"))
+DB_RETRY_MAX_DELAY = float(os.getenv("DB_RETRY_MAX_DELAY", "2.0"))
+DB_BREAKER_THRESHOLD = int(os.getenv("DB_BREAKER_THRESHOLD", "5"))
+DB_BREAKER_RESET_TIMEOUT = float(os.getenv("DB_BREAKER_RESET_TIMEOUT", "10"))
+
+# Create the tables when a worker boots; turn off in production and run
+# `flask db-upgrade` once per deploy so that workers start without the database
+DB_CREATE_ON_STARTUP = os.getenv("DB_CREATE_ON_STARTUP", "true").lower() == "true"
+
+# Migrations give up on a table lock after MIGRATION_LOCK_TIMEOUT instead of
+# blocking traffic, and backfill MIGRATION_BATCH_SIZE rows per statement
+MIGRATION_LOCK_TIMEOUT = os.getenv("MIGRATION_LOCK_TIMEOUT", "5s")
+MIGRATION_BATCH_SIZE = int(os.getenv("MIGRATION_BATCH_SIZE", "5000"))
+
+# Largest list of items accepted by POST /inventory/upsert in one request
+UPSERT_MAX_ITEMS = int(os.getenv("UPSERT_MAX_ITEMS", "1000"))
+
+# Rows loaded per transaction by `flask inventory-import`
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "5000"))
+
+# Readiness fails when SELECT 1 takes longer than HEALTH_DB_LATENCY_LIMIT
+# seconds or more than HEALTH_MAX_IN_FLIGHT requests are being served; its
+# result is cached for HEALTH_CACHE_TTL seconds
+HEALTH_CACHE_TTL = float(os.getenv("HEALTH_CACHE_TTL", "5"))
+HEALTH_DB_LATENCY_LIMIT = float(os.getenv("HEALTH_DB_LATENCY_LIMIT", "1.0"))
+HEALTH_MAX_IN_FLIGHT = int(os.getenv("HEALTH_MAX_IN_FLIGHT", "50"))
+
+# Admission control sheds requests with 503 once more than
+# ADMISSION_MAX_IN_FLIGHT requests (set it to the gunicorn threads per worker)
+# are in flight, writes and plain lists at three quarters and filtered lists
+# without a limit at half of that, or, for everything but health
+# probes and single-item reads, once the average statement takes longer than
+# ADMISSION_DB_LATENCY_LIMIT seconds. The average halves every
+# ADMISSION_LATENCY_HALF_LIFE seconds without statements, so shedding stops
+# once the database has had time to recover
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "true").lower() == "true"
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv("ADMISSION_MAX_IN_FLIGHT", "8"))
+ADMISSION_DB_LATENCY_LIMIT = float(os.getenv("ADMISSION_DB_LATENCY_LIMIT", "0.25"))
+ADMISSION_RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", "2"))
+ADMISSION_LATENCY_HALF_LIFE = float(os.getenv("ADMISSION_LATENCY_HALF_LIFE", "5"))
+
+# Per-client rate limits ("<requests>/<seconds>") for each route class, keyed
+# by the X-API-Key header when it is one of RATE_LIMIT_API_KEYS (comma
+# separated) or else the client address. RATE_LIMIT_STORE is memory (at most
+# RATE_LIMIT_MAX_KEYS buckets per worker), shared (a SQLite file used by the
+# workers of one pod) or redis (the server at RATE_LIMIT_URL, shared by every
+# pod); a failing store falls back to the memory buckets
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "false").lower() == "true"
+RATE_LIMIT_STORE = os.getenv("RATE_LIMIT_STORE", "memory").lower()
+RATE_LIMIT_SHARED_PATH = os.getenv("RATE_LIMIT_SHARED_PATH", "/tmp/rate_limits.db")
+RATE_LIMIT_URL = os.getenv("RATE_LIMIT_URL", os.getenv("CACHE_URL", "redis://localhost:6379/0"))
+RATE_LIMIT_API_KEYS = [key.strip() for key in os.getenv("RATE_LIMIT_API_KEYS", "").split(",") if key.strip()]
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "10000"))
+
+# Number of reverse proxies in front of the service (the Kubernetes ingress)
+# whose X-Forwarded-For entry is trusted for the client address
+TRUSTED_PROXIES = int(os.getenv("TRUSTED_PROXIES", "0"))
+RATE_LIMITS = {
+    "item": os.getenv("RATE_LIMIT_ITEM", "100/1"),
+    "collection": os.getenv("RATE_LIMIT_COLLECTION", "20/1"),
+    "restock": os.getenv("RATE_LIMIT_RESTOCK", "20/1"),
+    "bulk": os.getenv("RATE_LIMIT_BULK", "10/60"),
+}
+
+# Statement timeouts in milliseconds for the transactions of each route
+# class (0 for none); other endpoints get the default
+STATEMENT_TIMEOUTS = {
+    "item": int(os.getenv("STATEMENT_TIMEOUT_ITEM", "2000")),
+    "collection": int(os.getenv("STATEMENT_TIMEOUT_COLLECTION", "10000")),
+    "restock": int(os.getenv("STATEMENT_TIMEOUT_RESTOCK", "2000")),
+    "bulk": int(os.getenv("STATEMENT_TIMEOUT_BULK", "60000")),
+    "default": int(os.getenv("STATEMENT_TIMEOUT_DEFAULT", "10000")),
+}
+
+# Item lists expected to return more than SEARCH_MAX_ROWS rows without a
+# limit are returned whole by default (SEARCH_COST_ACTION "allow"), cut to
+# pages of SEARCH_PAGE_SIZE when it is "paginate", or rejected with 400 when
+# it is "reject"
+SEARCH_MAX_ROWS = int(os.getenv("SEARCH_MAX_ROWS", "10000"))
+SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", "1000"))
+SEARCH_COST_ACTION = os.getenv("SEARCH_COST_ACTION", "allow").lower()
+
+# Item lookups are cached for CACHE_TTL seconds and list responses for
+# CACHE_RESULT_TTL seconds in CACHE_BACKEND: none, memory (per worker, at
+# most CACHE_MAX_ITEMS entries, only coherent with a single worker) or redis
+# (the server at CACHE_URL, shared by every pod)
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "none").lower()
+CACHE_URL = os.getenv("CACHE_URL", "redis://localhost:6379/0")
+CACHE_TTL = float(os.getenv("CACHE_TTL", "30"))
+CACHE_RESULT_TTL = float(os.getenv("CACHE_RESULT_TTL", "300"))
+CACHE_MAX_ITEMS = int(os.getenv("CACHE_MAX_ITEMS", "10000"))
 
 # Secret for session management
 SECRET_KEY = os.getenv("SECRET_KEY", "sup3r-s3cr3t")
 LOGGING_LEVEL = logging.INFO
+
+# LOG_FORMAT=json writes one JSON object per line from a background thread
+# every LOG_FLUSH_INTERVAL seconds, holding at most LOG_QUEUE_SIZE records;
+# LOG_SAMPLE_RATE is the fraction of requests whose INFO lines are kept
+# (warnings and errors are always kept)
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_FLUSH_INTERVAL = float(os.getenv("LOG_FLUSH_INTERVAL", "0.2"))
+
+# Request tracing: TRACE_EXPORTER is none, file (JSON lines in TRACE_FILE) or
+# memory; requests without a traceparent header are sampled at TRACE_SAMPLE_RATE
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "none").lower()
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.1"))
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "1.0"))
+
+# Unfiltered counts use the PostgreSQL planner estimate above this many rows
+# (0 always runs an exact COUNT(*))
+COUNT_ESTIMATE_THRESHOLD = int(os.getenv("COUNT_ESTIMATE_THRESHOLD", "0"))
+
+# Response compression (gzip/brotli negotiated from Accept-Encoding)
+COMPRESS_ENABLED = os.getenv("COMPRESS_ENABLED", "true").lower() == "true"
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "500"))
+COMPRESS_LEVEL = int(os.getenv("COMPRESS_LEVEL", "6"))
+COMPRESS_BR_LEVEL = int(os.getenv("COMPRESS_BR_LEVEL", "4"))
+COMPRESS_MIMETYPES = [
+    "application/json",
+    "application/x-msgpack",
+    "application/vnd.apache.arrow.stream",
+    "application/x-ndjson",
+    "text/html",
+    "text/css",
+    "application/javascript",
+]
+
+# Responses stored for Idempotency-Key retries and how often they are purged.
+# A request that has not completed within IDEMPOTENCY_LEASE seconds is taken
+# to have died with its worker, so a retry may claim its key again
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", "86400"))
+IDEMPOTENCY_LEASE = int(os.getenv("IDEMPOTENCY_LEASE", "120"))
+IDEMPOTENCY_PURGE_INTERVAL = int(os.getenv("IDEMPOTENCY_PURGE_INTERVAL", "3600"))
+IDEMPOTENCY_PURGE_BATCH_SIZE = int(os.getenv("IDEMPOTENCY_PURGE_BATCH_SIZE", "1000"))
+
+# Buffered quantity adjustments are written every interval seconds or once
+# this many items are pending; durable mode writes them before responding
+ADJUST_FLUSH_INTERVAL = float(os.getenv("ADJUST_FLUSH_INTERVAL", "0.5"))
+ADJUST_FLUSH_SIZE = int(os.getenv("ADJUST_FLUSH_SIZE", "1000"))
+ADJUST_DURABLE = os.getenv("ADJUST_DURABLE", "false").lower() == "true"
+
+# Reservations hold units for RESERVATION_TTL seconds by default; expired
+# holds are released in batches every RESERVATION_SWEEP_INTERVAL seconds
+RESERVATION_TTL = int(os.getenv("RESERVATION_TTL", "900"))
+RESERVATION_MAX_TTL = int(os.getenv("RESERVATION_MAX_TTL", "86400"))
+RESERVATION_SWEEP_INTERVAL = int(os.getenv("RESERVATION_SWEEP_INTERVAL", "30"))
+RESERVATION_SWEEP_BATCH_SIZE = int(os.getenv("RESERVATION_SWEEP_BATCH_SIZE", "500"))
+
+# Change log streaming and compaction; consumers that have not synced for
+# CHANGES_CONSUMER_TTL seconds no longer hold back compaction
+CHANGES_BATCH_SIZE = int(os.getenv("CHANGES_BATCH_SIZE", "500"))
+CHANGES_COMPACT_INTERVAL = int(os.getenv("CHANGES_COMPACT_INTERVAL", "3600"))
+CHANGES_CONSUMER_TTL = int(os.getenv("CHANGES_CONSUMER_TTL", "604800"))
+
+# Server-Sent Events: the change log is polled once per worker and fanned
+# out to the subscribers with bounded queues. A stream holds its request's
+# thread for as long as it is open, so streams are served by the gevent
+# workers of the events process, up to EVENTS_MAX_SUBSCRIBERS per worker;
+# the thread workers of the API keep their threads for the API and take at
+# most EVENTS_THREAD_SUBSCRIBERS
+EVENTS_POLL_INTERVAL = float(os.getenv("EVENTS_POLL_INTERVAL", "1"))
+EVENTS_QUEUE_SIZE = int(os.getenv("EVENTS_QUEUE_SIZE", "100"))
+EVENTS_MAX_SUBSCRIBERS = int(os.getenv("EVENTS_MAX_SUBSCRIBERS", "1000"))
+EVENTS_THREAD_SUBSCRIBERS = int(os.getenv("EVENTS_THREAD_SUBSCRIBERS", "0"))
+EVENTS_KEEPALIVE = float(os.getenv("EVENTS_KEEPALIVE", "15"))
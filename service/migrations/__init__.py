@@ -0,0 +1,271 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Schema Migrations
+
+Every module in this package named vNNNN_<description>.py is a migration
+with a REVISION number and upgrade(op) / downgrade(op) functions. The
+applied revisions are recorded in the schema_version table.
+
+A migration runs in a single transaction unless it sets
+TRANSACTIONAL = False. Non-transactional migrations run in autocommit
+mode, which is what CREATE INDEX CONCURRENTLY and batched backfills need
+so that a schema change on a large table never holds a long lock.
+"""
+import pkgutil
+import logging
+import importlib
+from contextlib import contextmanager
+from sqlalchemy import inspect, select, delete, text
+from sqlalchemy.exc import IntegrityError
+from service.models import db, SchemaVersion
+
+logger = logging.getLogger("flask.app")
+
+# key of the PostgreSQL advisory lock held while migrations are applied
+MIGRATION_LOCK = 7260002
+
+
+class MigrationError(Exception):
+    """Used when the schema cannot be moved to the requested revision"""
+
+
+class Operations:
+    """The schema operations available to a migration"""
+
+    def __init__(self, connection, transactional: bool, lock_timeout: str, batch_size: int):
+        self.connection = connection
+        self.transactional = transactional
+        self.batch_size = batch_size
+        self.postgres = connection.dialect.name == "postgresql"
+        if self.postgres and transactional:
+            # fail fast instead of queueing every query behind our DDL lock
+            self.execute(f"SET LOCAL lock_timeout = '{lock_timeout}'")
+
+    def execute(self, sql: str, **params):
+        """Runs a SQL statement and returns the result"""
+        return self.connection.execute(text(sql), params)
+
+    def create_table(self, table):
+        """Creates a table given as a sqlalchemy Table with its indexes unless it exists"""
+        table.create(self.connection, checkfirst=True)
+
+    def drop_table(self, table):
+        """Drops a table given as a sqlalchemy Table if it exists"""
+        table.drop(self.connection, checkfirst=True)
+
+    def add_column(self, table: str, column: str):
+        """Adds a column given as its DDL, e.g. "sku VARCHAR(63)"
+
+        Leave new columns nullable or give them a constant default so that
+        adding them does not rewrite the table, then backfill them. A column
+        that already exists, e.g. on a database created by db.create_all(),
+        is left alone.
+        """
+        if column.split()[0] not in self._columns(table):
+            self.execute(f"ALTER TABLE {table} ADD COLUMN {column}")
+
+    def drop_column(self, table: str, column: str):
+        """Removes a column if it exists"""
+        if column in self._columns(table):
+            self.execute(f"ALTER TABLE {table} DROP COLUMN {column}")
+
+    def create_index(self, name: str, table: str, columns: list, unique: bool = False):
+        """Creates an index, concurrently on PostgreSQL outside a transaction
+
+        A failed concurrent build leaves an invalid index behind, which is
+        dropped and built again
+        """
+        concurrently = self._concurrently()
+        if concurrently and self._invalid_index(name):
+            logger.warning("Rebuilding invalid index %s", name)
+            self.drop_index(name)
+        kind = "UNIQUE INDEX" if unique else "INDEX"
+        self.execute(f"CREATE {kind} {concurrently}IF NOT EXISTS {name} ON {table} ({', '.join(columns)})")
+
+    def drop_index(self, name: str):
+        """Drops an index, concurrently on PostgreSQL outside a transaction"""
+        self.execute(f"DROP INDEX {self._concurrently()}IF EXISTS {name}")
+
+    def backfill(self, table: str, assignment: str, where: str) -> int:
+        """Updates the rows matching where in batches and returns the count
+
+        Each batch commits on its own outside a transaction, so row locks
+        are only held for one batch at a time. The where clause must stop
+        matching a row once it is updated.
+        """
+        total = 0
+        while True:
+            updated = self.execute(
+                f"UPDATE {table} SET {assignment} WHERE id IN "
+                f"(SELECT id FROM {table} WHERE {where} LIMIT :batch_size)",
+                batch_size=self.batch_size,
+            ).rowcount
+            total += updated
+            if updated < self.batch_size:
+                logger.info("Backfilled %d rows of %s", total, table)
+                return total
+
+    def _columns(self, table: str) -> set:
+        """Returns the names of the columns of a table"""
+        return {column["name"] for column in inspect(self.connection).get_columns(table)}
+
+    def _concurrently(self) -> str:
+        """Returns the CONCURRENTLY keyword when it can be used"""
+        return "CONCURRENTLY " if self.postgres and not self.transactional else ""
+
+    def _invalid_index(self, name: str) -> bool:
+        """Checks whether a concurrent build of an index failed"""
+        return bool(
+            self.execute(
+                "SELECT 1 FROM pg_index WHERE indexrelid = to_regclass(:name) AND NOT indisvalid", name=name
+            ).first()
+        )
+
+
+######################################################################
+# Revisions
+######################################################################
+def migrations() -> list:
+    """Returns every migration module ordered by revision"""
+    modules = [
+        importlib.import_module(f"{__name__}.{info.name}")
+        for info in pkgutil.iter_modules(__path__)
+        if info.name.startswith("v")
+    ]
+    return sorted(modules, key=lambda module: module.REVISION)
+
+
+def head() -> int:
+    """Returns the latest revision"""
+    return migrations()[-1].REVISION
+
+
+def current():
+    """Returns the revision of the database or None when it is unversioned"""
+    if not inspect(db.engine).has_table(SchemaVersion.__tablename__):
+        return None
+    return db.session.execute(select(db.func.max(SchemaVersion.version))).scalar()
+
+
+def stamp(revision: int):
+    """Records every migration up to revision as applied without running it"""
+    applied = set(db.session.execute(select(SchemaVersion.version)).scalars())
+    for module in migrations():
+        if module.REVISION <= revision and module.REVISION not in applied:
+            db.session.add(SchemaVersion(version=module.REVISION, description=_description(module)))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # another worker stamped the same revisions first
+        db.session.rollback()
+
+
+def init_schema() -> int:
+    """Prepares the database for migrations and returns its revision
+
+    An empty database gets every table and is stamped at the head. A
+    database created by db.create_all() before versioning is stamped at
+    the baseline so that the later migrations still run.
+    """
+    revision = current()
+    if revision is not None:
+        return revision
+    baseline = migrations()[0].REVISION
+    if inspect(db.engine).has_table("inventory"):
+        SchemaVersion.__table__.create(db.engine, checkfirst=True)
+        stamp(baseline)
+        return baseline
+    db.create_all()
+    stamp(head())
+    return head()
+
+
+def upgrade(target: int = None, lock_timeout: str = "5s", batch_size: int = 5000) -> list:
+    """Applies the pending migrations up to target and returns their revisions
+
+    Workers that upgrade on startup and the db-upgrade command may run at
+    the same time, so they take turns and each one only applies what is
+    still pending once it holds the lock
+    """
+    target = head() if target is None else target
+    applied = []
+    with _upgrade_lock():
+        revision = init_schema()
+        for module in migrations():
+            if revision < module.REVISION <= target:
+                _run(module, module.upgrade, lock_timeout, batch_size)
+                db.session.add(SchemaVersion(version=module.REVISION, description=_description(module)))
+                db.session.commit()
+                applied.append(module.REVISION)
+    return applied
+
+
+def downgrade(target: int, lock_timeout: str = "5s", batch_size: int = 5000) -> list:
+    """Reverts the applied migrations above target and returns their revisions"""
+    revision = current()
+    if revision is None:
+        raise MigrationError("The database is not versioned, run db-upgrade first")
+    if target < migrations()[0].REVISION:
+        raise MigrationError("Cannot downgrade past the baseline")
+    reverted = []
+    for module in reversed(migrations()):
+        if target < module.REVISION <= revision:
+            _run(module, module.downgrade, lock_timeout, batch_size)
+            db.session.execute(delete(SchemaVersion).where(SchemaVersion.version == module.REVISION))
+            db.session.commit()
+            reverted.append(module.REVISION)
+    return reverted
+
+
+@contextmanager
+def _upgrade_lock():
+    """Holds an advisory lock on PostgreSQL so that one process migrates at a time
+
+    The lock lives on its own connection in autocommit mode, because an
+    idle open transaction would block CREATE INDEX CONCURRENTLY
+    """
+    if db.engine.dialect.name != "postgresql":
+        yield
+        return
+    with db.engine.connect() as connection:
+        connection = connection.execution_options(isolation_level="AUTOCOMMIT")
+        connection.execute(text("SELECT pg_advisory_lock(:key)"), {"key": MIGRATION_LOCK})
+        try:
+            yield
+        finally:
+            connection.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": MIGRATION_LOCK})
+
+
+def _run(module, step, lock_timeout: str, batch_size: int):
+    """Runs one step of a migration in a transaction or in autocommit mode"""
+    transactional = getattr(module, "TRANSACTIONAL", True)
+    logger.info("Running %s.%s", module.__name__, step.__name__)
+    # release the session's connection so no open transaction blocks the DDL
+    db.session.close()
+    if transactional:
+        with db.engine.begin() as connection:
+            step(Operations(connection, True, lock_timeout, batch_size))
+        return
+    with db.engine.connect() as connection:
+        connection = connection.execution_options(isolation_level="AUTOCOMMIT")
+        step(Operations(connection, False, lock_timeout, batch_size))
+
+
+def _description(module) -> str:
+    """Returns the first line of a migration's docstring"""
+    return (module.__doc__ or module.__name__).strip().splitlines()[0]
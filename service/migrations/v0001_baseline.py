@@ -0,0 +1,31 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Baseline schema created by db.create_all() before migrations were versioned
+"""
+from service.migrations import MigrationError
+
+REVISION = 1
+
+
+def upgrade(op):  # pylint: disable=unused-argument
+    """The baseline tables already exist when a database is stamped"""
+
+
+def downgrade(op):  # pylint: disable=unused-argument
+    """Dropping the baseline would drop every table"""
+    raise MigrationError("Cannot downgrade past the baseline")
@@ -0,0 +1,31 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Index inventory by category for the category filter
+"""
+REVISION = 2
+TRANSACTIONAL = False
+
+
+def upgrade(op):
+    """Builds the index without blocking writes"""
+    op.create_index("ix_inventory_category", "inventory", ["category"])
+
+
+def downgrade(op):
+    """Drops the index without blocking writes"""
+    op.drop_index("ix_inventory_category")
@@ -0,0 +1,42 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Make inventory name, category and condition unique for upserts
+"""
+from service.migrations import MigrationError
+
+REVISION = 3
+TRANSACTIONAL = False
+
+
+def upgrade(op):
+    """Builds the unique index without blocking writes once no duplicates are left"""
+    duplicates = op.execute(
+        "SELECT COUNT(*) FROM (SELECT 1 FROM inventory GROUP BY inventory_name, category, condition "
+        "HAVING COUNT(*) > 1) AS duplicates"
+    ).scalar()
+    if duplicates:
+        raise MigrationError(
+            f"{duplicates} names are used more than once in the same category and condition, "
+            "merge or rename those items before upgrading"
+        )
+    op.create_index("uq_inventory_natural_key", "inventory", ["inventory_name", "category", "condition"], unique=True)
+
+
+def downgrade(op):
+    """Drops the unique index without blocking writes"""
+    op.drop_index("uq_inventory_natural_key")
@@ -0,0 +1,87 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Create the idempotency key, reservation and change log tables
+
+Databases created by db.create_all() before versioning only have the
+inventory table, so the tables added since are created here. The schema is
+frozen as of this revision instead of taken from the models, and tables
+that already exist are left alone.
+"""
+from sqlalchemy import MetaData, Table, Column, Index, ForeignKey
+from sqlalchemy import Integer, BigInteger, SmallInteger, String, Text, DateTime, Enum
+
+REVISION = 4
+
+metadata = MetaData()
+
+# only referenced by the reservation foreign key, never created here
+Table("inventory", metadata, Column("id", Integer, primary_key=True))
+
+TABLES = [
+    Table(
+        "idempotency_key",
+        metadata,
+        Column("key", String(255), primary_key=True),
+        Column("endpoint", String(255), nullable=False),
+        Column("status_code", SmallInteger, nullable=True),
+        Column("body", Text, nullable=True),
+        Column("location", String(255), nullable=True),
+        Column("expires_at", DateTime, nullable=False, index=True),
+    ),
+    Table(
+        "reservation",
+        metadata,
+        Column("id", Integer, primary_key=True),
+        Column("inventory_id", Integer, ForeignKey("inventory.id", ondelete="CASCADE"), nullable=False, index=True),
+        Column("quantity", Integer, nullable=False),
+        Column(
+            "status", Enum("HELD", "COMMITTED", "RELEASED", name="reservationstatus"),
+            nullable=False, server_default="HELD",
+        ),
+        Column("expires_at", DateTime, nullable=False),
+        Index("ix_reservation_status_expires_at", "status", "expires_at"),
+    ),
+    Table(
+        "inventory_change",
+        metadata,
+        Column("seq", BigInteger().with_variant(Integer, "sqlite"), primary_key=True),
+        Column("inventory_id", Integer, nullable=False),
+        Column("operation", String(16), nullable=False),
+        Column("data", Text, nullable=False),
+        Column("created_at", DateTime, nullable=False),
+    ),
+    Table(
+        "change_consumer",
+        metadata,
+        Column("name", String(63), primary_key=True),
+        Column("last_seq", BigInteger, nullable=False),
+        Column("seen_at", DateTime, nullable=False),
+    ),
+]
+
+
+def upgrade(op):
+    """Creates the missing tables with their indexes"""
+    for table in TABLES:
+        op.create_table(table)
+
+
+def downgrade(op):
+    """Drops the tables"""
+    for table in reversed(TABLES):
+        op.drop_table(table)
@@ -0,0 +1,32 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Record when idempotency keys were claimed and a fingerprint of their request
+"""
+REVISION = 5
+
+
+def upgrade(op):
+    """Adds the nullable columns, so keys claimed before them can be claimed again"""
+    op.add_column("idempotency_key", "fingerprint VARCHAR(64)")
+    op.add_column("idempotency_key", "claimed_at TIMESTAMP")
+
+
+def downgrade(op):
+    """Drops the columns"""
+    op.drop_column("idempotency_key", "claimed_at")
+    op.drop_column("idempotency_key", "fingerprint")
@@ -0,0 +1,39 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Count the units held by reservations in a reserved column of inventory
+"""
+REVISION = 6
+TRANSACTIONAL = False
+
+HELD_UNITS = "(SELECT SUM(quantity) FROM reservation WHERE inventory_id = inventory.id AND status = 'HELD')"
+
+
+def upgrade(op):
+    """Adds the column and moves the units of the held reservations from quantity into it"""
+    op.add_column("inventory", "reserved INTEGER NOT NULL DEFAULT 0")
+    op.backfill(
+        "inventory",
+        f"reserved = {HELD_UNITS}, quantity = quantity + {HELD_UNITS}",
+        "reserved = 0 AND id IN (SELECT inventory_id FROM reservation WHERE status = 'HELD')",
+    )
+
+
+def downgrade(op):
+    """Takes the held units back out of quantity and drops the column"""
+    op.backfill("inventory", "quantity = quantity - reserved, reserved = 0", "reserved > 0")
+    op.drop_column("inventory", "reserved")
@@ -0,0 +1,33 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Record the transaction of each change, whose commit renumbers it
+"""
+REVISION = 7
+TRANSACTIONAL = False
+
+
+def upgrade(op):
+    """Adds the nullable column, which changes recorded before it do not need, and indexes it"""
+    op.add_column("inventory_change", "txid BIGINT")
+    op.create_index("ix_inventory_change_txid", "inventory_change", ["txid"])
+
+
+def downgrade(op):
+    """Drops the index and the column"""
+    op.drop_index("ix_inventory_change_txid")
+    op.drop_column("inventory_change", "txid")
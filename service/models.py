@@ -4,22 +4,44 @@ Models for YourResourceModel
 All of the models are stored in this module
 """
 
+import json
 import logging
 from enum import Enum
+from datetime import datetime, timedelta, timezone
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import func, text, select, delete, update, bindparam, inspect, case, cast, BigInteger, Text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import make_transient_to_detached
+from service.common.validation import Schema, Field, describe
+from service.common.tracing import trace_methods
+from service.common.cache import cache, invalidate_on_commit, PENDING, ALL_CATEGORIES
+from service.common.resilience import DatabaseConnectionError  # noqa: F401 pylint: disable=unused-import
+from service.common.transactions import commit_write, rollback_write, resilient
 
 logger = logging.getLogger("flask.app")
 
 # Create the SQLAlchemy object to be initialized later in init_db()
 db = SQLAlchemy()
 
-
-class DatabaseConnectionError(Exception):
-    """Custom Exception when database connection fails"""
+# the session.info key of a transaction that recorded changes, which sequence() renumbers as it commits
+UNSEQUENCED = "unsequenced_changes"
+# the advisory lock that orders the commits of changes on PostgreSQL
+CHANGE_LOG_LOCK = 7260001
 
 
 class DataValidationError(Exception):
-    """Used for an data validation errors when deserializing"""
+    """Used for an data validation errors when deserializing
+
+    The structured errors of the validator, if any, are kept in errors
+    """
+
+    def __init__(self, message="", errors: list = None):
+        super().__init__(message)
+        self.errors = errors or []
+
+
+class DuplicateItemError(DataValidationError):
+    """Used when an item with the same name, category and condition exists"""
 
 
 class Condition(Enum):
@@ -30,7 +52,17 @@ class Condition(Enum):
     USED = 3
 
 
-class Inventory(db.Model):
+INVENTORY_SCHEMA = Schema(
+    Field("inventory_name", str),
+    Field("category", str),
+    Field("quantity", int),
+    Field("condition", str, Condition.__members__),
+    Field("restock_level", int),
+)
+
+
+@trace_methods
+class Inventory(db.Model):  # pylint: disable=too-many-public-methods
     """
     Class that represents a Inventory
     """
@@ -40,12 +72,18 @@ class Inventory(db.Model):
     ##################################################
     id = db.Column(db.Integer, primary_key=True)
     inventory_name = db.Column(db.String(63), nullable=False)
-    category = db.Column(db.String(63), nullable=False)
+    category = db.Column(db.String(63), nullable=False, index=True)
     quantity = db.Column(db.Integer, nullable=False)
     condition = db.Column(
         db.Enum(Condition), nullable=False, server_default=(Condition.NEW.name)
     )
     restock_level = db.Column(db.Integer, nullable=False)
+    # units held by reservations, which only the reservations change
+    reserved = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+
+    # the natural key supplier feeds upsert on
+    NATURAL_KEY = ("inventory_name", "category", "condition")
+    __table_args__ = (db.Index("uq_inventory_natural_key", *NATURAL_KEY, unique=True),)
 
     ##################################################
     # INSTANCE METHODS
@@ -54,6 +92,7 @@ class Inventory(db.Model):
     def __repr__(self):
         return f"<Inventory {self.inventory_name} id=[{self.id}]>"
 
+    @resilient(retry=False)
     def create(self):
         """
         Creates a Inventory to the database
@@ -62,37 +101,62 @@ class Inventory(db.Model):
         self.id = None  # pylint: disable=invalid-name
         try:
             db.session.add(self)
-            db.session.commit()
+            db.session.flush()
+            InventoryChange.record(self, "create")
+            commit_write()
+        except IntegrityError as e:
+            rollback_write()
+            raise self._integrity_error(e) from e
         except Exception as e:
-            db.session.rollback()
+            rollback_write(e)
             logger.error("Error creating record: %s", self)
             raise DataValidationError(e) from e
 
-    def update(self):
+    @resilient()
+    def update(self, operation: str = "update"):
         """
         Updates a Inventory to the database
+
+        Args:
+            operation (str): the name of the change recorded in the change log
         """
         logger.info("Saving %s", self.inventory_name)
         if not self.id:
             raise DataValidationError("Update called with empty ID field")
         try:
-            db.session.commit()
+            InventoryChange.record(self, operation)
+            commit_write()
+        except IntegrityError as e:
+            rollback_write()
+            raise self._integrity_error(e) from e
         except Exception as e:
-            db.session.rollback()
+            rollback_write(e)
             logger.error("Error updating record: %s", self)
             raise DataValidationError(e) from e
 
+    @resilient()
     def delete(self):
         """Removes a Inventory from the data store"""
         logger.info("Deleting %s", self.inventory_name)
         try:
+            InventoryChange.record(self, "delete")
             db.session.delete(self)
-            db.session.commit()
+            commit_write()
         except Exception as e:
-            db.session.rollback()
+            rollback_write(e)
             logger.error("Error deleting record: %s", self)
             raise DataValidationError(e) from e
 
+    def _integrity_error(self, error: IntegrityError) -> DataValidationError:
+        """Returns the validation error for a constraint the database enforced"""
+        logger.error("Error saving record: %s", self)
+        if "unique" not in str(error.orig).lower():
+            return DataValidationError(error)
+        return DuplicateItemError(
+            f"An item named '{self.inventory_name}' in category '{self.category}' "
+            f"with condition {self.condition.name} already exists"
+        )
+
     def serialize(self) -> dict:
         """Serializes a Inventory into a dictionary"""
         return {
@@ -102,6 +166,23 @@ class Inventory(db.Model):
             "quantity": self.quantity,
             "condition": self.condition.name,
             "restock_level": self.restock_level,
+            "reserved": self.reserved or 0,
+            "available": self.available,
+        }
+
+    @property
+    def available(self) -> int:
+        """The units that are neither sold nor held by a reservation"""
+        return max((self.quantity or 0) - (self.reserved or 0), 0)
+
+    def to_row(self) -> dict:
+        """Returns the column values of an unsaved item for the bulk writes"""
+        return {
+            "inventory_name": self.inventory_name,
+            "category": self.category,
+            "quantity": self.quantity,
+            "condition": self.condition,
+            "restock_level": self.restock_level,
         }
 
     def deserialize(self, data: dict):
@@ -111,36 +192,18 @@ class Inventory(db.Model):
         Args:
             data (dict): A dictionary containing the resource data
         """
-        try:
-            self.inventory_name = data["inventory_name"]
-            self.category = data["category"]
-            if isinstance(data["quantity"], int):
-                self.quantity = data["quantity"]
-            else:
-                raise DataValidationError(
-                    "Invalid type for int [quantity]: " + str(type(data["quantity"]))
-                )
-            self.condition = getattr(Condition, data["condition"])
-            if isinstance(data["restock_level"], int):
-                self.restock_level = data["restock_level"]
-            else:
-                raise DataValidationError(
-                    "Invalid type for int [restock_level]: "
-                    + str(type(data["restock_level"]))
-                )
-        except KeyError as error:
-            raise DataValidationError(
-                "Invalid Inventory: missing " + error.args[0]
-            ) from error
-        except TypeError as error:
-            raise DataValidationError(
-                "Invalid Inventory: body of request contained bad or no data "
-                + str(error)
-            ) from error
-        except AttributeError as error:
-            raise DataValidationError(
-                "Invalid Condition Word. Expect: NEW, OPENED, USED; Got: " + str(error)
-            ) from error
+        errors = INVENTORY_SCHEMA.validate(data)
+        if errors:
+            raise DataValidationError("Invalid Inventory: " + describe(errors), errors)
+        return self._assign(data)
+
+    def _assign(self, data: dict):
+        """Copies the fields of a validated dictionary"""
+        self.inventory_name = data["inventory_name"]
+        self.category = data["category"]
+        self.quantity = data["quantity"]
+        self.condition = Condition[data["condition"]]
+        self.restock_level = data["restock_level"]
         return self
 
     ##################################################
@@ -148,21 +211,358 @@ class Inventory(db.Model):
     ##################################################
 
     @classmethod
+    def deserialize_many(cls, payloads: list) -> list:
+        """Validates many payloads in one pass and returns them as unsaved items
+
+        Raises a DataValidationError with the errors of every invalid
+        payload, each carrying the index of its payload
+        """
+        errors = INVENTORY_SCHEMA.validate_many(payloads)
+        if errors:
+            raise DataValidationError("Invalid Inventory: " + describe(errors), errors)
+        return [cls()._assign(payload) for payload in payloads]
+
+    @classmethod
+    @resilient()
     def all(cls):
         """Returns all of the Inventories in the database"""
         logger.info("Processing all Inventories")
         return cls.query.all()
 
     @classmethod
+    @resilient()
     def find(cls, inventory_id: int):
-        """Finds a Inventories by it's ID"""
+        """Finds a Inventories by it's ID
+
+        The item comes from the cache unless the session already holds it
+        or has uncommitted changes, which the cache must not see
+        """
         logger.info("Processing lookup for id %s ...", inventory_id)
-        return cls.query.get(inventory_id)
+        if not cls._cacheable(inventory_id):
+            return cls.query.get(inventory_id)
+        inventory_id = int(inventory_id)
+        data = cache.get(cls.cache_key(inventory_id), lambda: cls._load_cached(inventory_id))
+        if data is None:
+            return None
+        data = json.loads(data)
+        item = cls(id=inventory_id, reserved=data["reserved"])._assign(data)
+        make_transient_to_detached(item)
+        return db.session.merge(item, load=False)
+
+    @classmethod
+    def cache_key(cls, inventory_id: int) -> str:
+        """Returns the cache key of an item"""
+        return f"inventory:{inventory_id}"
+
+    @classmethod
+    def _cacheable(cls, inventory_id) -> bool:
+        """Checks whether a lookup may go through the cache"""
+        session = db.session
+        if not cache.enabled or not str(inventory_id).isdigit():
+            return False
+        if session.info.get(PENDING) or session.new or session.dirty or session.deleted:
+            return False
+        return session.identity_map.get(session.identity_key(cls, int(inventory_id))) is None
+
+    @classmethod
+    def _load_cached(cls, inventory_id: int):
+        """Returns the serialized item to cache, or None when there is no such item"""
+        row = db.session.execute(select(*cls.__table__.columns).where(cls.id == inventory_id)).mappings().first()
+        if row is None:
+            return None
+        return json.dumps(dict(row, condition=row["condition"].name)).encode()
 
     @classmethod
     def search(cls, args: dict):
         """Finds an item by multiple criteria"""
         logger.info("Processing query for multiple filter %s ...", args)
+        return cls.query.filter(*cls._search_filters(args))
+
+    @classmethod
+    @resilient(retry=False)
+    def adjust_quantities(cls, deltas: dict) -> list:
+        """Adds a delta to the quantity of many items in a single statement
+
+        The rows are locked first so that no item is deleted under the
+        write, and the deltas of items that no longer exist are skipped.
+
+        Args:
+            deltas (dict): a dictionary of inventory id to quantity delta
+
+        Returns:
+            list: the ids of the skipped items
+        """
+        logger.info("Adjusting quantity of %d items", len(deltas))
+        try:
+            present = set(db.session.execute(
+                select(cls.id).where(cls.id.in_(list(deltas))).order_by(cls.id).with_for_update()
+            ).scalars())
+            missing = [key for key in deltas if key not in present]
+            if present:
+                cls._apply_deltas({key: value for key, value in deltas.items() if key in present}, "adjust")
+            commit_write()
+        except Exception as e:
+            rollback_write(e)
+            logger.error("Error adjusting quantities: %s", deltas)
+            raise DataValidationError(e) from e
+        return missing
+
+    @classmethod
+    def _apply_deltas(cls, deltas: dict, operation: str):
+        """Runs one batched UPDATE adding each delta to its item's quantity
+
+        A quantity never goes below zero. The deltas are recorded in the
+        change log under the operation name
+        """
+        table = cls.__table__
+        adjusted = table.c.quantity + bindparam("delta")
+        statement = (
+            update(table)
+            .where(table.c.id == bindparam("item_id"))
+            .values(quantity=case((adjusted < 0, 0), else_=adjusted))
+        )
+        db.session.execute(statement, [{"item_id": key, "delta": value} for key, value in deltas.items()])
+        InventoryChange.record_deltas(deltas, operation)
+
+    @classmethod
+    @resilient()
+    def bulk_upsert(cls, rows: list) -> int:
+        """Inserts or updates many items in one transaction and returns the count
+
+        Rows with an id replace the item with that id and rows without one
+        are matched on the natural key like upsert(). PostgreSQL loads the rows with COPY into a staging table
+        and merges it with INSERT ... ON CONFLICT; other databases run a
+        batched executemany upsert. Every row is recorded in the change log.
+
+        Args:
+            rows (list): deserialized items as dictionaries with an optional id
+        """
+        logger.info("Importing %d items", len(rows))
+        try:
+            if db.session.get_bind().dialect.name == "postgresql":
+                items = cls._copy_upsert(rows)
+            else:
+                items = cls._executemany_upsert(rows)
+            InventoryChange.record_many({item.id: cls._serialize_row(item) for item in items}, "import")
+            if any("id" in row for row in rows):
+                # a row with an id may move its item to another category, whose lists it changes too
+                invalidate_on_commit(db.session, categories=[ALL_CATEGORIES])
+            commit_write()
+        except Exception as e:
+            rollback_write(e)
+            logger.error("Error importing %d items", len(rows))
+            raise DataValidationError(e) from e
+        return len(items)
+
+    @classmethod
+    @resilient()
+    def upsert(cls, rows: list) -> list:
+        """Inserts or updates many items matched on their natural key in one statement
+
+        An existing item with the same name, category and condition gets the
+        quantity and restock level of the row; when rows repeat a natural key
+        the last one wins. Every item is recorded in the change log.
+
+        Args:
+            rows (list): deserialized items as dictionaries without ids
+
+        Returns:
+            list: the serialized items
+        """
+        logger.info("Upserting %d items", len(rows))
+        latest = {tuple(row[name] for name in cls.NATURAL_KEY): row for row in rows}
+        try:
+            items = db.session.execute(cls._natural_key_upsert().values(list(latest.values()))).all()
+            serialized = [cls._serialize_row(item) for item in items]
+            InventoryChange.record_many({item["id"]: item for item in serialized}, "upsert")
+            commit_write()
+        except Exception as e:
+            rollback_write(e)
+            logger.error("Error upserting %d items", len(rows))
+            raise DataValidationError(e) from e
+        return serialized
+
+    @classmethod
+    def _insert(cls):
+        """Returns an INSERT with the ON CONFLICT clause of the database in use"""
+        # pylint: disable=import-outside-toplevel
+        if db.session.get_bind().dialect.name == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert
+        else:
+            from sqlalchemy.dialects.sqlite import insert
+        return insert(cls.__table__)
+
+    @classmethod
+    def _natural_key_upsert(cls):
+        """Returns an INSERT that updates the item with the same natural key"""
+        table = cls.__table__
+        statement = cls._insert()
+        return statement.on_conflict_do_update(
+            index_elements=[table.c[name] for name in cls.NATURAL_KEY],
+            set_={"quantity": statement.excluded.quantity, "restock_level": statement.excluded.restock_level},
+        ).returning(*table.columns)
+
+    @classmethod
+    def _serialize_row(cls, row) -> dict:
+        """Serializes a row of the inventory table like serialize()"""
+        data = {column.name: getattr(row, column.name) for column in cls.__table__.columns}
+        data["condition"] = row.condition.name
+        data["available"] = max(row.quantity - row.reserved, 0)
+        return data
+
+    @classmethod
+    def _written_columns(cls) -> list:
+        """Returns the columns that imports and upserts write, leaving the holds alone"""
+        return [column for column in cls.__table__.columns if column.name not in ("id", "reserved")]
+
+    @classmethod
+    def _executemany_upsert(cls, rows: list) -> list:
+        """Upserts the rows with batched executemany statements"""
+        table = cls.__table__
+        columns = cls._written_columns()
+        items = []
+        keyed = [row for row in rows if row.get("id") is not None]
+        if keyed:
+            statement = cls._insert()
+            statement = statement.on_conflict_do_update(
+                index_elements=[table.c.id], set_={column.name: statement.excluded[column.name] for column in columns}
+            )
+            items += db.session.execute(statement.returning(*table.columns), keyed).all()
+        new = [row for row in rows if row.get("id") is None]
+        if new:
+            items += db.session.execute(cls._natural_key_upsert(), new).all()
+        return items
+
+    @classmethod
+    def _copy_upsert(cls, rows: list) -> list:
+        """Upserts the rows through COPY into a staging table on PostgreSQL"""
+        values = [column.name for column in cls._written_columns()]
+        names = ["id", *values]
+        connection = db.session.connection().connection.driver_connection
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "CREATE TEMP TABLE inventory_import (id integer, inventory_name varchar(63), category varchar(63), "
+                "quantity integer, condition text, restock_level integer) ON COMMIT DROP"
+            )
+            with cursor.copy(f"COPY inventory_import ({', '.join(names)}) FROM STDIN") as copy:
+                for row in rows:
+                    copy.write_row([row["condition"].name if name == "condition" else row.get(name) for name in names])
+
+        def select_list(columns):
+            return ", ".join(f"CAST({name} AS condition)" if name == "condition" else name for name in columns)
+
+        updates = ", ".join(f"{name} = EXCLUDED.{name}" for name in values)
+        returning = f" RETURNING {', '.join(column.name for column in cls.__table__.columns)}"
+        merge = text(
+            f"INSERT INTO inventory ({', '.join(names)}) SELECT {select_list(names)} FROM inventory_import "
+            f"WHERE id IS NOT NULL ON CONFLICT (id) DO UPDATE SET {updates}{returning}"
+        ).columns(*cls.__table__.columns)
+        items = db.session.execute(merge).all()
+        if items:
+            # explicit ids bypass the sequence, so move it past them
+            db.session.execute(
+                text("SELECT setval(pg_get_serial_sequence('inventory', 'id'), (SELECT MAX(id) FROM inventory))")
+            )
+        insert_new = text(
+            f"INSERT INTO inventory ({', '.join(values)}) SELECT {select_list(values)} "
+            f"FROM inventory_import WHERE id IS NULL ON CONFLICT ({', '.join(cls.NATURAL_KEY)}) "
+            f"DO UPDATE SET quantity = EXCLUDED.quantity, restock_level = EXCLUDED.restock_level{returning}"
+        ).columns(*cls.__table__.columns)
+        items += db.session.execute(insert_new).all()
+        # dropped now rather than on commit, which a unit of work defers past the next batch
+        db.session.execute(text("DROP TABLE inventory_import"))
+        return items
+
+    @classmethod
+    @resilient()
+    def stock_levels(cls, inventory_ids) -> dict:
+        """Returns the category and quantity of many items keyed by id"""
+        rows = db.session.execute(
+            select(cls.id, cls.category, cls.quantity).where(cls.id.in_(inventory_ids))
+        ).all()
+        return {row.id: {"category": row.category, "quantity": row.quantity} for row in rows}
+
+    @classmethod
+    @resilient()
+    def fetch(cls, query) -> list:
+        """Returns the items of a list query"""
+        return query.all()
+
+    @classmethod
+    @resilient()
+    def columns(cls, query) -> dict:
+        """Returns the rows of a query as a dictionary of column name to values
+
+        Only the column values are fetched so that no Inventory objects or
+        per-row dictionaries are built
+        """
+        names = [column.name for column in cls.__table__.columns]
+        rows = query.with_entities(*cls.__table__.columns).all()
+        values = [list(column) for column in zip(*rows)] or [[] for _ in names]
+        columns = dict(zip(names, values))
+        columns["condition"] = [condition.name for condition in columns["condition"]]
+        # computed like the available property so that every format has the same fields
+        columns["available"] = [
+            max(quantity - reserved, 0) for quantity, reserved in zip(columns["quantity"], columns["reserved"])
+        ]
+        return columns
+
+    @classmethod
+    @resilient()
+    def count(cls, args: dict, estimate_above: int = 0) -> int:
+        """Counts the items matching the criteria without loading any rows
+
+        Args:
+            args (dict): the same filter criteria accepted by search()
+            estimate_above (int): when non zero and no filter is given, the
+                planner's row estimate is returned on PostgreSQL instead of an
+                exact count once the table has grown beyond this many rows
+        """
+        logger.info("Processing count for multiple filter %s ...", args)
+        query_filter = cls._search_filters(args)
+        if estimate_above and not query_filter:
+            estimated = cls._estimated_count()
+            if estimated >= estimate_above:
+                return estimated
+        return db.session.query(func.count(cls.id)).filter(*query_filter).scalar()
+
+    @classmethod
+    def _estimated_count(cls) -> int:
+        """Returns the planner's row estimate for the table or -1 if unknown"""
+        if db.engine.dialect.name != "postgresql":
+            return -1
+        estimated = db.session.execute(
+            text("SELECT reltuples::bigint FROM pg_class WHERE oid = CAST(:table AS regclass)"),
+            {"table": cls.__tablename__},
+        ).scalar()
+        return -1 if estimated is None else int(estimated)
+
+    @classmethod
+    @resilient()
+    def estimate_rows(cls, query, ceiling: int) -> int:
+        """Returns how many rows a query is expected to return
+
+        PostgreSQL answers with the planner's estimate without running the
+        query; other databases count the matching rows, but stop at ceiling + 1
+        """
+        if db.engine.dialect.name == "postgresql":
+            compiled = query.statement.compile(dialect=db.engine.dialect)
+            plan = db.session.connection().exec_driver_sql(
+                f"EXPLAIN (FORMAT JSON) {compiled}", compiled.params
+            ).scalar()
+            return int(plan[0]["Plan"]["Plan Rows"])
+        return db.session.query(func.count()).select_from(query.limit(ceiling + 1).subquery()).scalar()
+
+    @classmethod
+    def page(cls, query, after: int, limit: int):
+        """Returns the page of a query with the limit items after an id, in id order"""
+        if after is not None:
+            query = query.filter(cls.id > after)
+        return query.order_by(cls.id).limit(limit)
+
+    @classmethod
+    def _search_filters(cls, args: dict) -> list:
+        """Builds the filter criteria shared by search() and count()"""
         query_filter = []
         if args["name"]:
             query_filter.append(cls.inventory_name == args["name"])
@@ -174,10 +574,518 @@ class Inventory(db.Model):
             query_filter.append(cls.restock_level == int(args["restock_level"]))
         if args["condition"]:
             query_filter.append(cls.condition == args["condition"])
-        return cls.query.filter(*query_filter)
+        return query_filter
 
     @classmethod
     def remove_all(cls):
         """Removes all documents from the database (use for testing)"""
-        for document in cls.database:  # pylint: disable=(not-an-iterable
-            document.delete()
+        db.session.execute(delete(Reservation))
+        removed = db.session.execute(delete(cls).returning(cls.id)).scalars().all()
+        invalidate_on_commit(db.session, [cls.cache_key(item_id) for item_id in removed], [ALL_CATEGORIES])
+        db.session.commit()
+
+
+def utcnow() -> datetime:
+    """Returns the current UTC time as stored in the database"""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class IdempotencyKey(db.Model):
+    """
+    Class that represents the stored outcome of a request sent with an
+    Idempotency-Key header
+    """
+
+    ##################################################
+    # Table Schema
+    ##################################################
+    key = db.Column(db.String(255), primary_key=True)
+    endpoint = db.Column(db.String(255), nullable=False)
+    status_code = db.Column(db.SmallInteger, nullable=True)
+    body = db.Column(db.Text, nullable=True)
+    location = db.Column(db.String(255), nullable=True)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+    fingerprint = db.Column(db.String(64), nullable=True)
+    claimed_at = db.Column(db.DateTime, nullable=True)
+
+    def __repr__(self):
+        return f"<IdempotencyKey {self.key} endpoint=[{self.endpoint}]>"
+
+    @property
+    def completed(self) -> bool:
+        """True once the response of the original request has been stored"""
+        return self.status_code is not None
+
+    def response(self) -> tuple:
+        """Returns the stored response as (data, status code, headers)"""
+        headers = {"Location": self.location} if self.location else {}
+        return json.loads(self.body), self.status_code, headers
+
+    ##################################################
+    # CLASS METHODS
+    ##################################################
+
+    @classmethod
+    def claim(cls, key: str, endpoint: str, ttl: int, fingerprint: str = None, lease: int = None):
+        """Claims a key for a new request
+
+        Returns None when the caller now owns the key and must run the
+        request, or the IdempotencyKey already stored for it. A key whose
+        request has not completed within lease seconds is claimed again,
+        since the worker that ran it most likely died.
+        """
+        now = utcnow()
+        stored = db.session.get(cls, key)
+        claim = {"endpoint": endpoint, "fingerprint": fingerprint, "claimed_at": now,
+                 "expires_at": now + timedelta(seconds=ttl)}
+        if stored is not None:
+            if stored.expires_at > now:
+                if lease is None or stored.completed:
+                    return stored
+                return cls._take_over(key, claim, now - timedelta(seconds=lease))
+            db.session.delete(stored)
+            db.session.flush()
+        db.session.add(cls(key=key, **claim))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # another worker claimed the same key concurrently
+            db.session.rollback()
+            return db.session.get(cls, key)
+        return None
+
+    @classmethod
+    def _take_over(cls, key: str, claim: dict, stale_before: datetime):
+        """Claims a key whose lease ran out, unless another retry got it first"""
+        taken = db.session.execute(
+            update(cls)
+            .where(cls.key == key, cls.status_code.is_(None))
+            .where((cls.claimed_at.is_(None)) | (cls.claimed_at <= stale_before))
+            .values(**claim)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        db.session.commit()
+        if taken:
+            logger.warning("Reclaimed idempotency key %s after its lease ran out", key)
+            return None
+        return db.session.get(cls, key)
+
+    @classmethod
+    def complete(cls, key: str, data, status_code: int, location: str = None):
+        """Stores the response of the request that owns the key"""
+        stored = db.session.get(cls, key)
+        stored.body = json.dumps(data)
+        stored.status_code = status_code
+        stored.location = location
+        db.session.commit()
+
+    @classmethod
+    def release(cls, key: str):
+        """Gives up a claimed key so that the request can be retried"""
+        db.session.rollback()
+        db.session.execute(delete(cls).where(cls.key == key))
+        db.session.commit()
+
+    @classmethod
+    def purge_expired(cls, batch_size: int = 1000) -> int:
+        """Deletes the expired keys in batches and returns how many were removed"""
+        now = utcnow()
+        total = 0
+        while True:
+            expired = select(cls.key).where(cls.expires_at <= now).limit(batch_size)
+            deleted = db.session.execute(
+                delete(cls).where(cls.key.in_(expired)).execution_options(synchronize_session=False)
+            ).rowcount
+            db.session.commit()
+            total += deleted
+            if deleted < batch_size:
+                logger.info("Purged %d expired idempotency keys", total)
+                return total
+
+
+class ReservationStatus(Enum):
+    """Enumeration of valid Reservation status"""
+
+    HELD = 0
+    COMMITTED = 1
+    RELEASED = 2
+
+
+class Reservation(db.Model):
+    """
+    Class that represents a hold on some units of an Inventory item
+
+    Held units are counted in the reserved column of the item and left in
+    its quantity until the reservation is committed, so writes that set the
+    quantity of an item never lose or double count the holds on it
+    """
+
+    ##################################################
+    # Table Schema
+    ##################################################
+    id = db.Column(db.Integer, primary_key=True)
+    inventory_id = db.Column(
+        db.Integer, db.ForeignKey("inventory.id", ondelete="CASCADE"), nullable=False, index=True
+    )
+    quantity = db.Column(db.Integer, nullable=False)
+    status = db.Column(
+        db.Enum(ReservationStatus), nullable=False, server_default=(ReservationStatus.HELD.name)
+    )
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (db.Index("ix_reservation_status_expires_at", "status", "expires_at"),)
+
+    def __repr__(self):
+        return f"<Reservation {self.quantity} of item {self.inventory_id} id=[{self.id}]>"
+
+    def serialize(self) -> dict:
+        """Serializes a Reservation into a dictionary"""
+        return {
+            "id": self.id,
+            "inventory_id": self.inventory_id,
+            "quantity": self.quantity,
+            "status": self.status.name,
+            "expires_at": self.expires_at.isoformat(),
+        }
+
+    def commit(self) -> bool:
+        """Turns a held reservation into a sale, taking its units out of the quantity
+
+        Returns False if the reservation is no longer held or has expired
+        """
+        logger.info("Committing %s", self)
+        return self._finish(ReservationStatus.COMMITTED, utcnow())
+
+    def release(self) -> bool:
+        """Gives the held units back to the item
+
+        Returns False if the reservation is no longer held
+        """
+        logger.info("Releasing %s", self)
+        return self._finish(ReservationStatus.RELEASED)
+
+    def _finish(self, new_status: ReservationStatus, unexpired_at: datetime = None) -> bool:
+        """Moves a held reservation to its final status in one transaction"""
+        table = Reservation.__table__
+        criteria = [table.c.id == self.id, table.c.status == ReservationStatus.HELD]
+        if unexpired_at is not None:
+            criteria.append(table.c.expires_at > unexpired_at)
+        try:
+            result = db.session.execute(update(table).where(*criteria).values(status=new_status))
+            if result.rowcount == 0:
+                db.session.rollback()
+                return False
+            sold = new_status == ReservationStatus.COMMITTED
+            Reservation._settle({self.inventory_id: self.quantity}, sold)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error("Error finishing reservation: %s", self)
+            raise DataValidationError(e) from e
+        db.session.refresh(self)
+        return True
+
+    ##################################################
+    # CLASS METHODS
+    ##################################################
+
+    @classmethod
+    def find(cls, reservation_id: int):
+        """Finds a Reservation by it's ID"""
+        logger.info("Processing lookup for reservation %s ...", reservation_id)
+        return db.session.get(cls, reservation_id)
+
+    @classmethod
+    def reserve(cls, inventory_id: int, quantity: int, ttl: int):
+        """Holds quantity units of an item for ttl seconds
+
+        The units are held with a single conditional UPDATE so concurrent
+        reservations can never oversell. Returns None when the item does
+        not have enough units available.
+        """
+        logger.info("Reserving %d of item %s", quantity, inventory_id)
+        table = Inventory.__table__
+        try:
+            result = db.session.execute(
+                update(table)
+                .where(table.c.id == inventory_id, table.c.quantity - table.c.reserved >= quantity)
+                .values(reserved=table.c.reserved + quantity)
+            )
+            if result.rowcount == 0:
+                db.session.rollback()
+                return None
+            InventoryChange.record_many({inventory_id: {"reserved_delta": quantity}}, "reserve")
+            reservation = cls(
+                inventory_id=inventory_id,
+                quantity=quantity,
+                status=ReservationStatus.HELD,
+                expires_at=utcnow() + timedelta(seconds=ttl),
+            )
+            db.session.add(reservation)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error("Error reserving %d of item %s", quantity, inventory_id)
+            raise DataValidationError(e) from e
+        return reservation
+
+    @classmethod
+    def release_expired(cls, batch_size: int = 500) -> int:
+        """Releases the expired holds in batches and returns how many were released
+
+        Each batch gives the units back with one UPDATE per item, and rows
+        locked by another sweeper are skipped
+        """
+        released = 0
+        while True:
+            expired = db.session.execute(
+                select(cls.id, cls.inventory_id, cls.quantity)
+                .where(cls.status == ReservationStatus.HELD, cls.expires_at <= utcnow())
+                .limit(batch_size)
+                .with_for_update(skip_locked=True)
+            ).all()
+            if not expired:
+                break
+            deltas = {}
+            for _, inventory_id, quantity in expired:
+                deltas[inventory_id] = deltas.get(inventory_id, 0) + quantity
+            db.session.execute(
+                update(cls)
+                .where(cls.id.in_([row.id for row in expired]))
+                .values(status=ReservationStatus.RELEASED)
+                .execution_options(synchronize_session=False)
+            )
+            cls._settle(deltas)
+            db.session.commit()
+            released += len(expired)
+        if released:
+            logger.info("Released %d expired reservations", released)
+        return released
+
+    @classmethod
+    def _settle(cls, holds: dict, sold: bool = False):
+        """Takes finished holds keyed by inventory id off the items in one batched UPDATE
+
+        Sold units also leave the quantity, which never goes below zero
+        """
+        table = Inventory.__table__
+        values = {"reserved": table.c.reserved - bindparam("held")}
+        changed = ["reserved_delta"]
+        if sold:
+            remaining = table.c.quantity - bindparam("held")
+            values["quantity"] = case((remaining < 0, 0), else_=remaining)
+            changed.append("quantity_delta")
+        statement = update(table).where(table.c.id == bindparam("item_id")).values(**values)
+        db.session.execute(statement, [{"item_id": key, "held": value} for key, value in holds.items()])
+        changes = {key: {name: -value for name in changed} for key, value in holds.items()}
+        InventoryChange.record_many(changes, "commit" if sold else "release")
+
+
+class InventoryChange(db.Model):
+    """
+    Class that represents one entry of the append-only inventory change log
+
+    Entries are numbered by a monotonically increasing sequence so that
+    downstream systems can ask for everything after the last one they read
+    """
+
+    ##################################################
+    # Table Schema
+    ##################################################
+    seq = db.Column(db.BigInteger().with_variant(db.Integer, "sqlite"), primary_key=True)
+    inventory_id = db.Column(db.Integer, nullable=False)
+    operation = db.Column(db.String(16), nullable=False)
+    data = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=utcnow)
+    # the PostgreSQL transaction that recorded the change, whose commit renumbers it
+    txid = db.Column(db.BigInteger, nullable=True, index=True)
+
+    def __repr__(self):
+        return f"<InventoryChange {self.operation} of item {self.inventory_id} seq=[{self.seq}]>"
+
+    def serialize(self) -> dict:
+        """Serializes an InventoryChange into a dictionary"""
+        return {
+            "seq": self.seq,
+            "inventory_id": self.inventory_id,
+            "operation": self.operation,
+            "data": json.loads(self.data),
+            "created_at": self.created_at.isoformat(),
+        }
+
+    ##################################################
+    # CLASS METHODS
+    ##################################################
+
+    @classmethod
+    def record(cls, item: Inventory, operation: str):
+        """Adds the new state of an item (its last one when deleted) to the current transaction"""
+        # an update that moves the item changes the lists of its old category too
+        categories = {item.category, *inspect(item).attrs.category.history.deleted}
+        invalidate_on_commit(db.session, [Inventory.cache_key(item.id)], categories)
+        db.session.add(cls(inventory_id=item.id, operation=operation, data=json.dumps(item.serialize()),
+                           txid=cls._current_txid()))
+        db.session.info[UNSEQUENCED] = True
+
+    @classmethod
+    def record_deltas(cls, deltas: dict, operation: str):
+        """Adds quantity deltas of many items to the current transaction in one INSERT"""
+        cls.record_many({key: {"quantity_delta": value} for key, value in deltas.items()}, operation)
+
+    @classmethod
+    def record_many(cls, changes: dict, operation: str):
+        """Adds the data of many items keyed by id to the current transaction in one INSERT"""
+        if cache.enabled:
+            categories = {value.get("category") for value in changes.values()}
+            if None in categories:
+                # quantity deltas do not say which category the items are in
+                categories.discard(None)
+                categories.update(db.session.execute(
+                    select(Inventory.category).where(Inventory.id.in_(list(changes))).distinct()
+                ).scalars())
+            invalidate_on_commit(db.session, [Inventory.cache_key(key) for key in changes], categories)
+        now = utcnow()
+        statement = cls.__table__.insert()
+        txid = cls._current_txid()
+        if txid is not None:
+            statement = statement.values(txid=txid)
+        db.session.info[UNSEQUENCED] = True
+        db.session.execute(
+            statement,
+            [
+                {
+                    "inventory_id": key,
+                    "operation": operation,
+                    "data": json.dumps(value),
+                    "created_at": now,
+                }
+                for key, value in changes.items()
+            ],
+        )
+
+    @staticmethod
+    def _current_txid():
+        """Returns the id of the current transaction on PostgreSQL, None elsewhere"""
+        if db.session.get_bind().dialect.name != "postgresql":
+            return None
+        return cast(cast(func.pg_current_xact_id(), Text), BigInteger)
+
+    @classmethod
+    def sequence(cls, session):
+        """Renumbers the changes of a transaction that is about to commit
+
+        A seq is taken when a change is recorded, so a transaction that
+        records early and commits late would make its changes visible behind
+        a seq readers have already passed. On PostgreSQL every commit that
+        recorded changes takes the change log lock and gives its changes the
+        next seqs, in the order they were recorded, so seq order is commit
+        order. SQLite runs one write transaction at a time, which already
+        gives that order.
+        """
+        if session.get_bind().dialect.name != "postgresql":
+            return
+        session.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": CHANGE_LOG_LOCK})
+        session.execute(text(
+            "UPDATE inventory_change SET seq = renumbered.seq FROM ("
+            "SELECT old_seq, nextval(pg_get_serial_sequence('inventory_change', 'seq')) AS seq FROM ("
+            "SELECT seq AS old_seq FROM inventory_change WHERE txid = pg_current_xact_id()::text::bigint "
+            "ORDER BY seq) recorded) renumbered WHERE inventory_change.seq = renumbered.old_seq"
+        ))
+
+    @classmethod
+    def last_seq(cls) -> int:
+        """Returns the seq of the latest change or 0 if there is none"""
+        return db.session.execute(select(func.max(cls.seq))).scalar() or 0
+
+    @classmethod
+    def since(cls, seq: int, limit: int) -> list:
+        """Returns up to limit changes committed after seq, oldest first
+
+        Changes are numbered in commit order (see sequence()), so no change
+        can become visible behind one that was already read
+        """
+        return db.session.execute(select(cls).where(cls.seq > seq).order_by(cls.seq).limit(limit)).scalars().all()
+
+    @classmethod
+    def compact(cls, batch_size: int = 1000) -> int:
+        """Deletes the changes every known consumer has read past
+
+        Nothing is deleted while no consumer is known
+        """
+        low_water_mark = ChangeConsumer.low_water_mark()
+        if low_water_mark is None:
+            return 0
+        total = 0
+        while True:
+            read = select(cls.seq).where(cls.seq <= low_water_mark).order_by(cls.seq).limit(batch_size)
+            deleted = db.session.execute(
+                delete(cls).where(cls.seq.in_(read)).execution_options(synchronize_session=False)
+            ).rowcount
+            db.session.commit()
+            total += deleted
+            if deleted < batch_size:
+                logger.info("Compacted %d changes up to seq %d", total, low_water_mark)
+                return total
+
+
+class ChangeConsumer(db.Model):
+    """
+    Class that represents a downstream system reading the change log
+    """
+
+    ##################################################
+    # Table Schema
+    ##################################################
+    name = db.Column(db.String(63), primary_key=True)
+    last_seq = db.Column(db.BigInteger, nullable=False)
+    seen_at = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return f"<ChangeConsumer {self.name} last_seq=[{self.last_seq}]>"
+
+    ##################################################
+    # CLASS METHODS
+    ##################################################
+
+    @classmethod
+    def acknowledge(cls, name: str, last_seq: int):
+        """Records that a consumer has read every change up to last_seq"""
+        consumer = db.session.get(cls, name)
+        if consumer is None:
+            consumer = cls(name=name, last_seq=last_seq)
+            db.session.add(consumer)
+        consumer.last_seq = max(consumer.last_seq, last_seq)
+        consumer.seen_at = utcnow()
+        db.session.commit()
+
+    @classmethod
+    def forget_stale(cls, max_age: int) -> int:
+        """Removes the consumers that have not been seen for max_age seconds"""
+        deleted = db.session.execute(
+            delete(cls).where(cls.seen_at < utcnow() - timedelta(seconds=max_age))
+        ).rowcount
+        db.session.commit()
+        return deleted
+
+    @classmethod
+    def low_water_mark(cls):
+        """Returns the last seq every consumer has read or None without consumers"""
+        return db.session.execute(select(func.min(cls.last_seq))).scalar()
+
+
+class SchemaVersion(db.Model):  # pylint: disable=too-few-public-methods
+    """
+    Class that represents a schema migration applied to the database
+    """
+
+    __tablename__ = "schema_version"
+
+    ##################################################
+    # Table Schema
+    ##################################################
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    description = db.Column(db.String(255), nullable=False)
+    applied_at = db.Column(db.DateTime, nullable=False, default=utcnow)
+
+    def __repr__(self):
+        return f"<SchemaVersion {self.version} {self.description}>"
@@ -21,11 +21,15 @@ This service implements a REST API that allows you to Create, Read, Update
 and Delete Items from the inventory of Items in the InventoryShop
 """
 # pylint: disable=redefined-builtin, cyclic-import
-from flask import jsonify, abort
+import json
+from urllib.parse import urlencode
+from flask import jsonify, abort, request, Response, stream_with_context
 from flask import current_app as app  # Import Flask application
-from flask_restx import Resource, fields, reqparse
-from service.models import Inventory, Condition
-from service.common import status  # HTTP Status Codes
+from flask_restx import Resource, fields, reqparse, inputs
+from service.models import Inventory, InventoryChange, ChangeConsumer, Condition, Reservation, db
+from service.common import status, wire_formats, adjustments, events, health  # HTTP Status Codes
+from service.common import result_cache
+from service.common.idempotency import idempotent
 from . import api
 
 
@@ -38,6 +42,25 @@ def health_check():
     return jsonify(status=200, message="Healthy"), status.HTTP_200_OK
 
 
+@app.route("/health/live")
+def liveness_check():
+    """Return 200 while the worker can answer, without checking its dependencies"""
+    return jsonify(status=200, message="Alive"), status.HTTP_200_OK
+
+
+@app.route("/health/ready")
+def readiness_check():
+    """Return 200 when the database, the pool and the worker can take traffic, else 503"""
+    result = health.readiness.check()
+    if result["ready"]:
+        return jsonify(status=200, message="Ready", checks=result["checks"]), status.HTTP_200_OK
+    app.logger.warning("Not ready: %s", result["checks"])
+    return (
+        jsonify(status=503, message="Not ready", checks=result["checks"]),
+        status.HTTP_503_SERVICE_UNAVAILABLE,
+    )
+
+
 ######################################################################
 # GET INDEX
 ######################################################################
@@ -47,6 +70,8 @@ def index():
     return app.send_static_file("index.html")
 
 
+NDJSON = "application/x-ndjson"
+
 # Define the model so that the docs reflect what can be sent
 inventory_item = api.model(
     "InventoryItem",
@@ -78,6 +103,45 @@ item_model = api.inherit(
         "id": fields.Integer(  # "_id": fields.String won't work
             readOnly=True, description="The unique id assigned internally by service"
         ),
+        "reserved": fields.Integer(readOnly=True, description="The units held by reservations"),
+        "available": fields.Integer(readOnly=True, description="The units neither sold nor held"),
+    },
+)
+
+adjustment_model = api.model(
+    "Adjustment",
+    {
+        "delta": fields.Integer(
+            required=True, description="The amount to add to the quantity (negative to remove)"
+        ),
+        "durable": fields.Boolean(
+            required=False, description="Write the change before responding instead of buffering it"
+        ),
+    },
+)
+
+reservation_request = api.model(
+    "ReservationRequest",
+    {
+        "quantity": fields.Integer(
+            required=True, min=1, description="The number of units to hold"
+        ),
+        "ttl": fields.Integer(
+            required=False, min=1, description="How many seconds to hold the units for"
+        ),
+    },
+)
+
+reservation_model = api.model(
+    "Reservation",
+    {
+        "id": fields.Integer(readOnly=True, description="The unique id of the reservation"),
+        "inventory_id": fields.Integer(readOnly=True, description="The item the units are held from"),
+        "quantity": fields.Integer(readOnly=True, description="The number of units held"),
+        "status": fields.String(
+            readOnly=True, enum=["HELD", "COMMITTED", "RELEASED"], description="The reservation status"
+        ),
+        "expires_at": fields.DateTime(readOnly=True, description="When a held reservation is released"),
     },
 )
 
@@ -99,6 +163,39 @@ item_args.add_argument(
 item_args.add_argument(
     "restock_level", type=int, location="args", required=False, help="List items by restock_level",
 )
+item_args.add_argument(
+    "count_only", type=inputs.boolean, location="args", required=False, default=False,
+    help="Only return the number of matching items",
+)
+item_args.add_argument(
+    "limit", type=inputs.positive, location="args", required=False,
+    help="Return at most this many items, in id order",
+)
+item_args.add_argument(
+    "after", type=int, location="args", required=False,
+    help="Only return items with a greater id (the last id of the previous page)",
+)
+
+changes_args = reqparse.RequestParser()
+changes_args.add_argument(
+    "since", type=int, location="args", required=False, default=0,
+    help="Only return changes after this sequence number",
+)
+changes_args.add_argument(
+    "limit", type=int, location="args", required=False, help="Return at most this many changes",
+)
+changes_args.add_argument(
+    "consumer", type=str, location="args", required=False,
+    help="Name of the consumer; 'since' acknowledges everything up to it",
+)
+
+events_args = reqparse.RequestParser()
+events_args.add_argument(
+    "category", type=str, location="args", required=False, help="Only send events of this category",
+)
+events_args.add_argument(
+    "id", type=int, location="args", required=False, help="Only send events of this item",
+)
 
 ######################################################################
 #  R E S T   A P I   E N D P O I N T S
@@ -194,27 +291,47 @@ class InventoryCollection(Resource):
     # LIST ALL ITEMS IN THE INVENTORY
     # ------------------------------------------------------------------
     @api.doc("list_items")
+    @api.produces(wire_formats.available())
     @api.expect(item_args, validate=True)
-    @api.marshal_list_with(item_model)
+    @api.response(200, "Success", [item_model])
     def get(self):
         """Returns all of the Items"""
         app.logger.info("Request for item list")
-        inventory = []
         args = item_args.parse_args()
 
+        if args["count_only"]:
+            count = count_items(args)
+            app.logger.info("Returning count of %d items", count)
+            return {"count": count}, status.HTTP_200_OK, {"X-Total-Count": str(count)}
+
         app.logger.info("Returning filtered list.")
-        inventory = Inventory.search(args)
+        mimetype = wire_formats.negotiate()
+        response = result_cache.cached_list(args, mimetype, lambda: list_response(args, mimetype))
+        # the representation depends on Accept, so shared caches must key on it
+        response.vary.add("Accept")
+        return response
 
-        results = [item.serialize() for item in inventory]
-        app.logger.info("Returning %d items", len(results))
-        return results, status.HTTP_200_OK
+    # ------------------------------------------------------------------
+    # COUNT THE ITEMS IN THE INVENTORY
+    # ------------------------------------------------------------------
+    @api.doc("count_items")
+    @api.expect(item_args, validate=True)
+    @api.response(200, "Count returned in the X-Total-Count header")
+    def head(self):
+        """Returns the number of matching Items in the X-Total-Count header"""
+        app.logger.info("Request for item count")
+        args = item_args.parse_args()
+        count = count_items(args)
+        return "", status.HTTP_200_OK, {"X-Total-Count": str(count)}
 
     # ------------------------------------------------------------------
     # ADD A NEW ITEM
     # ------------------------------------------------------------------
     @api.doc("create_item")
     @api.response(400, "The posted data was not valid")
+    @api.response(409, "The Idempotency-Key was used for another request")
     @api.expect(inventory_item)
+    @idempotent
     @api.marshal_with(item_model, code=201)
     def post(self):
         """
@@ -252,6 +369,40 @@ class InventoryCollection(Resource):
         return "", status.HTTP_204_NO_CONTENT
 
 
+######################################################################
+#  PATH: /inventory/upsert
+######################################################################
+@api.route("/inventory/upsert")
+class UpsertCollection(Resource):
+    """Creates or updates items matched on name, category and condition"""
+
+    @api.doc("upsert_items")
+    @api.response(400, "The posted data was not valid")
+    @api.response(200, "Items created or updated", [item_model])
+    @api.expect([inventory_item])
+    def post(self):
+        """
+        Create or update items by their natural key
+
+        This endpoint takes one item or a list of items. An item with the
+        same name, category and condition gets the posted quantity and
+        restock level, any other item is created, all in one statement
+        """
+        data = api.payload
+        many = isinstance(data, list)
+        rows = data if many else [data]
+        app.logger.info("Request to upsert %d items", len(rows))
+        if not rows or len(rows) > app.config["UPSERT_MAX_ITEMS"]:
+            error(
+                status.HTTP_400_BAD_REQUEST,
+                f"Send between 1 and {app.config['UPSERT_MAX_ITEMS']} items per request.",
+            )
+        items = [item.to_row() for item in Inventory.deserialize_many(rows)]
+        results = Inventory.upsert(items)
+        app.logger.info("Upserted %d items", len(results))
+        return (results if many else results[0]), status.HTTP_200_OK
+
+
 ######################################################################
 #  PATH: /inventory/{id}/restock
 ######################################################################
@@ -263,6 +414,8 @@ class RestockResource(Resource):
     @api.doc("restock_item")
     @api.response(404, "Item not found")
     @api.response(400, "Bad quantity: quantity not enough for restock")
+    @api.response(409, "The Idempotency-Key was used for another request")
+    @idempotent
     def put(self, id):
         """
         Restock an item
@@ -286,11 +439,310 @@ class RestockResource(Resource):
         # the more we sold, the more we add, vice versa
         # (may use more sophisticated rule)
         item.quantity = 2*item.restock_level-item.quantity
-        item.update()
+        item.update("restock")
         app.logger.info("Item %s restocked.", item.inventory_name)
         return item.serialize(), status.HTTP_200_OK
 
 
+######################################################################
+#  PATH: /inventory/changes
+######################################################################
+@api.route("/inventory/changes")
+class InventoryChangeCollection(Resource):
+    """Incremental sync of the inventory through its change log"""
+
+    @api.doc("list_changes")
+    @api.expect(changes_args, validate=True)
+    @api.produces([NDJSON])
+    def get(self):
+        """
+        Stream the changes after a sequence number
+
+        This endpoint streams one JSON change per line, oldest first, so
+        that consumers can sync incrementally from the last seq they read
+        """
+        args = changes_args.parse_args()
+        app.logger.info("Request for changes since %s", args["since"])
+        if args["consumer"]:
+            ChangeConsumer.acknowledge(args["consumer"], args["since"])
+        changes = stream_changes(args["since"], args["limit"], app.config["CHANGES_BATCH_SIZE"])
+        return Response(stream_with_context(changes), mimetype=NDJSON)
+
+
+######################################################################
+#  PATH: /inventory/events
+######################################################################
+@api.route("/inventory/events")
+class InventoryEvents(Resource):
+    """Server-Sent Events stream of inventory changes"""
+
+    @api.doc("stream_events")
+    @api.expect(events_args, validate=True)
+    @api.produces(["text/event-stream"])
+    @api.response(503, "Too many subscribers")
+    def get(self):
+        """
+        Stream inventory changes as Server-Sent Events
+
+        This endpoint pushes create, update, delete, restock and quantity
+        events as they happen instead of having clients poll every item
+        """
+        args = events_args.parse_args()
+        app.logger.info("Request to subscribe to events for %s", args)
+        subscriber = events.Subscriber(app.config["EVENTS_QUEUE_SIZE"], args["category"], args["id"])
+        if not events.broker.subscribe(subscriber, events.subscriber_limit(app.config)):
+            error(status.HTTP_503_SERVICE_UNAVAILABLE, "Too many event subscribers, try again later.")
+        return Response(
+            events.stream(subscriber, app.config["EVENTS_KEEPALIVE"]),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+
+######################################################################
+#  PATH: /inventory/{id}/adjust
+######################################################################
+@api.route("/inventory/<id>/adjust")
+@api.param("id", "The Inventory identifier")
+class AdjustResource(Resource):
+    """Increments or decrements the quantity of an item"""
+
+    @api.doc("adjust_item")
+    @api.response(404, "Item not found")
+    @api.response(400, "The posted adjustment was not valid")
+    @api.response(409, "Not enough units to take out")
+    @api.response(202, "Adjustment buffered")
+    @api.expect(adjustment_model, validate=True)
+    def post(self, id):
+        """
+        Adjust the quantity of an item
+
+        This endpoint buffers the delta and writes it together with the
+        other pending adjustments, unless a durable write is requested
+        """
+        app.logger.info("Request to adjust item with id: %s", id)
+        data = api.payload
+        item = Inventory.find(id)
+        if not item:
+            error(status.HTTP_404_NOT_FOUND, f"Item with id '{id}' was not found.")
+
+        pending = adjustments.buffer.add(item.id, data["delta"], item.quantity)
+        if pending is None:
+            error(status.HTTP_409_CONFLICT, f"Item with id '{id}' does not have {-data['delta']} units to take out.")
+        if data.get("durable", app.config["ADJUST_DURABLE"]):
+            adjustments.buffer.flush()
+            item = db.session.get(Inventory, item.id, populate_existing=True)
+            if not item:
+                error(status.HTTP_404_NOT_FOUND, f"Item with id '{id}' was deleted before the adjustment was written.")
+            app.logger.info("Item %s adjusted.", item.inventory_name)
+            return item.serialize(), status.HTTP_200_OK
+
+        return {"id": item.id, "pending_delta": pending}, status.HTTP_202_ACCEPTED
+
+
+######################################################################
+#  PATH: /inventory/{id}/reservations
+######################################################################
+@api.route("/inventory/<id>/reservations")
+@api.param("id", "The Inventory identifier")
+class ReservationCollection(Resource):
+    """Holds units of an item for a checkout"""
+
+    @api.doc("reserve_item")
+    @api.response(404, "Item not found")
+    @api.response(409, "Not enough units available")
+    @api.expect(reservation_request, validate=True)
+    @idempotent
+    @api.marshal_with(reservation_model, code=201)
+    def post(self, id):
+        """
+        Reserve units of an item
+
+        This endpoint takes the units out of the quantity of the item
+        until the reservation is committed, released or expires
+        """
+        app.logger.info("Request to reserve item with id: %s", id)
+        data = api.payload
+        ttl = min(data.get("ttl") or app.config["RESERVATION_TTL"], app.config["RESERVATION_MAX_TTL"])
+        reservation = Reservation.reserve(id, data["quantity"], ttl)
+        if not reservation:
+            if not Inventory.find(id):
+                error(status.HTTP_404_NOT_FOUND, f"Item with id '{id}' was not found.")
+            error(status.HTTP_409_CONFLICT, f"Item with id '{id}' does not have {data['quantity']} units available.")
+        app.logger.info("Reservation %s created.", reservation.id)
+        location_url = api.url_for(ReservationResource, reservation_id=reservation.id, _external=True)
+        return reservation.serialize(), status.HTTP_201_CREATED, {"Location": location_url}
+
+
+######################################################################
+#  PATH: /reservations/{reservation_id}
+######################################################################
+@api.route("/reservations/<reservation_id>")
+@api.param("reservation_id", "The Reservation identifier")
+class ReservationResource(Resource):
+    """Retrieves a single reservation"""
+
+    @api.doc("get_reservation")
+    @api.response(404, "Reservation not found")
+    @api.marshal_with(reservation_model)
+    def get(self, reservation_id):
+        """Retrieve a single reservation"""
+        app.logger.info("Request for reservation with id: %s", reservation_id)
+        reservation = find_reservation(reservation_id)
+        return reservation.serialize(), status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /reservations/{reservation_id}/commit
+######################################################################
+@api.route("/reservations/<reservation_id>/commit")
+@api.param("reservation_id", "The Reservation identifier")
+class CommitReservationResource(Resource):
+    """Commit action on a reservation"""
+
+    @api.doc("commit_reservation")
+    @api.response(404, "Reservation not found")
+    @api.response(409, "Reservation is no longer held")
+    @api.marshal_with(reservation_model)
+    def put(self, reservation_id):
+        """
+        Commit a reservation
+
+        This endpoint turns the held units into a sale
+        """
+        app.logger.info("Request to commit reservation with id: %s", reservation_id)
+        reservation = find_reservation(reservation_id)
+        if not reservation.commit():
+            error(status.HTTP_409_CONFLICT, f"Reservation with id '{reservation_id}' is no longer held.")
+        return reservation.serialize(), status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /reservations/{reservation_id}/release
+######################################################################
+@api.route("/reservations/<reservation_id>/release")
+@api.param("reservation_id", "The Reservation identifier")
+class ReleaseReservationResource(Resource):
+    """Release action on a reservation"""
+
+    @api.doc("release_reservation")
+    @api.response(404, "Reservation not found")
+    @api.response(409, "Reservation is no longer held")
+    @api.marshal_with(reservation_model)
+    def put(self, reservation_id):
+        """
+        Release a reservation
+
+        This endpoint gives the held units back to the item
+        """
+        app.logger.info("Request to release reservation with id: %s", reservation_id)
+        reservation = find_reservation(reservation_id)
+        if not reservation.release():
+            error(status.HTTP_409_CONFLICT, f"Reservation with id '{reservation_id}' is no longer held.")
+        return reservation.serialize(), status.HTTP_200_OK
+
+
+######################################################################
+# Finds a reservation or aborts with 404
+######################################################################
+def find_reservation(reservation_id):
+    """Returns the reservation with the id or aborts with 404"""
+    reservation = Reservation.find(reservation_id)
+    if not reservation:
+        error(status.HTTP_404_NOT_FOUND, f"Reservation with id '{reservation_id}' was not found.")
+    return reservation
+
+
+######################################################################
+# Streams the change log in batches
+######################################################################
+def stream_changes(since, limit, batch_size):
+    """Yields the changes after since as JSON lines, one batch at a time"""
+    sent = 0
+    while limit is None or sent < limit:
+        size = batch_size if limit is None else min(batch_size, limit - sent)
+        changes = InventoryChange.since(since, size)
+        for change in changes:
+            yield json.dumps(change.serialize()) + "\n"
+        if len(changes) < size:
+            return
+        since = changes[-1].seq
+        sent += len(changes)
+        db.session.expunge_all()
+
+
+######################################################################
+# Lists the items matching the query string filters
+######################################################################
+def list_response(args, mimetype):
+    """Queries the items matching the arguments and encodes them as mimetype"""
+    inventory, limit, truncated = paginate(Inventory.search(args), args)
+    if mimetype == wire_formats.ARROW:
+        app.logger.info("Returning columns as %s", mimetype)
+        columns = Inventory.columns(inventory)
+        response = wire_formats.arrow_response(columns)
+        response.headers.extend(page_headers(columns["id"], limit, truncated))
+        return response
+
+    results = [item.serialize() for item in Inventory.fetch(inventory)]
+    app.logger.info("Returning %d items as %s", len(results), mimetype)
+    headers = page_headers([item["id"] for item in results], limit, truncated)
+    if mimetype == wire_formats.MSGPACK:
+        response = wire_formats.msgpack_response(results)
+        response.headers.extend(headers)
+        return response
+    return api.make_response(results, status.HTTP_200_OK, headers)
+
+
+######################################################################
+# Counts the items matching the query string filters
+######################################################################
+def count_items(args):
+    """Counts the matching items without materializing any rows"""
+    return Inventory.count(args, estimate_above=app.config["COUNT_ESTIMATE_THRESHOLD"])
+
+
+def paginate(query, args):
+    """Applies the requested page to a list query, forcing one on queries that are too costly
+
+    Returns the query, its page size, which is None when it is not paged, and
+    whether the page was forced on a request that asked for more
+    """
+    max_rows = app.config["SEARCH_MAX_ROWS"]
+    limit = args["limit"]
+    truncated = False
+    action = app.config["SEARCH_COST_ACTION"]
+    if action in ("paginate", "reject") and (limit is None or limit > max_rows):
+        estimated = Inventory.estimate_rows(query, max_rows)
+        if estimated > max_rows:
+            if action == "reject":
+                error(
+                    status.HTTP_400_BAD_REQUEST,
+                    f"The query matches more than {max_rows} items; filter it or page through it with limit and after",
+                )
+            app.logger.warning("Paging a list of about %d items", estimated)
+            limit = app.config["SEARCH_PAGE_SIZE"]
+            truncated = True
+    if limit is None and args["after"] is None:
+        return query, None, False
+    return Inventory.page(query, args["after"], limit), limit, truncated
+
+
+def page_headers(ids: list, limit, truncated: bool) -> dict:
+    """Returns the Link header of the next page when the page is full
+
+    A page forced on the request also says so in X-Result-Truncated
+    """
+    if limit is None or not ids or len(ids) < limit:
+        return {}
+    params = request.args.to_dict()
+    params.update(after=ids[-1], limit=limit)
+    headers = {"Link": f'<{request.base_url}?{urlencode(params)}>; rel="next"'}
+    if truncated:
+        headers[result_cache.TRUNCATED_HEADER] = "true"
+    return headers
+
+
 ######################################################################
 # Logs error messages before aborting
 ######################################################################
@@ -30,7 +30,8 @@ class InventoryFactory(factory.Factory):
         model = Inventory
 
     id = factory.Sequence(lambda n: n)
-    inventory_name = FuzzyChoice(choices=["Apple", "Iphone", "telephone"])
+    # names are unique so that items never collide on the natural key
+    inventory_name = factory.Sequence(lambda n: f"{['Apple', 'Iphone', 'telephone'][n % 3]} {n}")
     category = FuzzyChoice(choices=["Fruits", "Electronic"])
     quantity = FuzzyChoice(choices=[20, 90, 40])
     condition = FuzzyChoice(choices=[Condition.NEW, Condition.OPENED, Condition.USED])
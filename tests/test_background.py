@@ -0,0 +1,42 @@
+"""
+Test cases for Background Tasks
+"""
+import threading
+from unittest import TestCase
+from wsgi import app
+from service.common.background import PeriodicTask
+
+
+######################################################################
+#  B A C K G R O U N D   T A S K   T E S T   C A S E S
+######################################################################
+class TestPeriodicTask(TestCase):
+    """Periodic Task Tests"""
+
+    def test_runs_periodically(self):
+        """It should call the function in a background thread"""
+        called = threading.Event()
+        task = PeriodicTask("test-task", 0.01, called.set)
+        with app.app_context():
+            task.start()
+            task.start()  # a second start is a no-op
+        self.assertTrue(called.wait(5))
+        task.stop()
+
+    def test_disabled(self):
+        """It should not start a task with no interval"""
+        task = PeriodicTask("disabled-task", 0, lambda: None)
+        with app.app_context():
+            task.start()
+        task.stop()
+        self.assertIsNone(task._thread)
+
+    def test_errors_are_logged(self):
+        """It should log instead of raising when the function fails"""
+
+        def fail():
+            raise ValueError("boom")
+
+        task = PeriodicTask("failing-task", 60, fail)
+        with self.assertLogs(app.logger, level="ERROR"):
+            task.run_once(app)
@@ -2,12 +2,17 @@
 CLI Command Extensions for Flask
 """
 import os
+import tempfile
 from unittest import TestCase
 from unittest.mock import patch, MagicMock
 from click.testing import CliRunner
 # pylint: disable=unused-import
 from wsgi import app  # noqa: F401
-from service.common.cli_commands import db_create  # noqa: E402
+from service.common.cli_commands import (  # noqa: E402
+    db_create, db_init, db_upgrade, db_downgrade, db_current, inventory_import,
+    idempotency_purge, reservations_sweep, changes_compact
+)
+from service.migrations import MigrationError  # noqa: E402
 
 
 class TestFlaskCLI(TestCase):
@@ -16,10 +21,108 @@ class TestFlaskCLI(TestCase):
     def setUp(self):
         self.runner = CliRunner()
 
+    @patch('service.common.cli_commands.migrations')
     @patch('service.common.cli_commands.db')
-    def test_db_create(self, db_mock):
+    def test_db_create(self, db_mock, migrations_mock):
         """It should call the db-create command"""
         db_mock.return_value = MagicMock()
+        migrations_mock.head.return_value = 2
         with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True):
             result = self.runner.invoke(db_create)
             self.assertEqual(result.exit_code, 0)
+            migrations_mock.stamp.assert_called_once_with(2)
+
+    @patch('service.common.cli_commands.migrations')
+    def test_db_init(self, migrations_mock):
+        """It should initialize the schema without dropping anything"""
+        migrations_mock.init_schema.return_value = 2
+        with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True):
+            result = self.runner.invoke(db_init)
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn("revision 2", result.output)
+
+    @patch('service.common.cli_commands.migrations')
+    def test_db_upgrade(self, migrations_mock):
+        """It should apply the pending migrations"""
+        migrations_mock.upgrade.return_value = [2, 3]
+        migrations_mock.current.return_value = 3
+        with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True):
+            result = self.runner.invoke(db_upgrade, ["--to", "3"])
+            self.assertEqual(result.exit_code, 0)
+            self.assertEqual(migrations_mock.upgrade.call_args[0][0], 3)
+            self.assertIn("Applied revision 3", result.output)
+
+    @patch('service.common.cli_commands.migrations')
+    def test_db_downgrade(self, migrations_mock):
+        """It should revert the last migration by default"""
+        migrations_mock.current.return_value = 2
+        migrations_mock.downgrade.return_value = [2]
+        with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True):
+            result = self.runner.invoke(db_downgrade)
+            self.assertEqual(result.exit_code, 0)
+            self.assertEqual(migrations_mock.downgrade.call_args[0][0], 1)
+            self.assertIn("Reverted revision 2", result.output)
+
+    @patch('service.common.cli_commands.migrations')
+    def test_db_downgrade_error(self, migrations_mock):
+        """It should report a migration that cannot be reverted"""
+        migrations_mock.MigrationError = MigrationError
+        migrations_mock.current.return_value = 1
+        migrations_mock.downgrade.side_effect = MigrationError("Cannot downgrade past the baseline")
+        with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True):
+            result = self.runner.invoke(db_downgrade)
+            self.assertEqual(result.exit_code, 1)
+            self.assertIn("baseline", result.output)
+
+    @patch('service.common.cli_commands.migrations')
+    def test_db_current(self, migrations_mock):
+        """It should show the current and latest revisions"""
+        migrations_mock.current.return_value = 1
+        migrations_mock.head.return_value = 2
+        with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True):
+            result = self.runner.invoke(db_current)
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn("revision 1 of 2", result.output)
+
+    @patch('service.common.cli_commands.bulk_import')
+    def test_inventory_import(self, bulk_import_mock):
+        """It should import a CSV file and report the rejected rows"""
+        report = bulk_import_mock.import_csv.return_value
+        report.loaded, report.elapsed, report.rate, report.rejected = 2, 0.5, 4, [(3, "bad quantity")]
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "items.csv")
+            with open(path, "w", encoding="utf-8") as file:
+                file.write("inventory_name\n")
+            with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True):
+                result = self.runner.invoke(inventory_import, [path, "--batch-size", "10"])
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual(bulk_import_mock.import_csv.call_args[0][1], 10)
+        self.assertIn("Rejected line 3: bad quantity", result.output)
+        self.assertIn("Imported 2 rows in 0.50s (4 rows/s), rejected 1", result.output)
+
+    @patch('service.common.cli_commands.IdempotencyKey')
+    def test_idempotency_purge(self, key_mock):
+        """It should purge the expired idempotency keys"""
+        key_mock.purge_expired.return_value = 3
+        with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True):
+            result = self.runner.invoke(idempotency_purge)
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn("Purged 3", result.output)
+
+    @patch('service.common.cli_commands.Reservation')
+    def test_reservations_sweep(self, reservation_mock):
+        """It should release the expired reservations"""
+        reservation_mock.release_expired.return_value = 2
+        with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True):
+            result = self.runner.invoke(reservations_sweep)
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn("Released 2", result.output)
+
+    @patch('service.common.cli_commands.change_log')
+    def test_changes_compact(self, change_log_mock):
+        """It should compact the change log"""
+        change_log_mock.compact.return_value = 7
+        with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True):
+            result = self.runner.invoke(changes_compact)
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn("Compacted 7", result.output)
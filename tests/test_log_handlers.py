@@ -0,0 +1,164 @@
+"""
+Test cases for the Log Handlers
+"""
+import json
+import queue
+import logging
+from unittest import TestCase
+from flask import Flask, g
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+from service.common import log_handlers
+from service.common.log_handlers import AsyncHandler, BatchQueue, JsonFormatter, REQUEST_ID_HEADER
+
+
+class ListHandler(logging.Handler):
+    """Keeps the formatted lines it is given"""
+
+    def __init__(self):
+        super().__init__()
+        self.lines = []
+
+    def emit(self, record):
+        self.lines.append(self.format(record))
+
+
+def json_app(sample_rate: float = 1.0):
+    """Returns an app logging JSON to a list, with a route that queries a database"""
+    app = Flask("json_logging")
+    app.config.update(LOG_FORMAT="json", LOG_QUEUE_SIZE=100, LOG_SAMPLE_RATE=sample_rate)
+    engine = create_engine("sqlite://")
+    target = ListHandler()
+    gunicorn_logger = logging.getLogger("test.gunicorn")
+    gunicorn_logger.handlers = [target]
+    gunicorn_logger.setLevel(logging.INFO)
+
+    @app.route("/items")
+    def items():
+        app.logger.info("Listing %d items", 3)
+        with engine.connect() as connection:
+            connection.execute(text("SELECT 1"))
+        return "[]"
+
+    log_handlers.init_logging(app, "test.gunicorn")
+    return app, target
+
+
+######################################################################
+#  L O G   H A N D L E R   T E S T   C A S E S
+######################################################################
+class TestLogHandlers(TestCase):
+    """Log Handler Tests"""
+
+    def stop(self, app):
+        """Stops the listener so that every queued line is written"""
+        app.extensions["log_queue_handler"].stop()
+
+    def test_text_format(self):
+        """It should use the gunicorn handlers directly by default"""
+        app = Flask("text_logging")
+        target = ListHandler()
+        logging.getLogger("test.text").handlers = [target]
+        logging.getLogger("test.text").setLevel(logging.INFO)
+        log_handlers.init_logging(app, "test.text")
+        self.assertEqual(app.logger.handlers, [target])
+        self.assertIn("[INFO] [log_handlers] Logging handler established", target.lines[0])
+
+    def test_json_request_lines(self):
+        """It should log JSON lines with the request id, latency and database time"""
+        app, target = json_app()
+        response = app.test_client().get("/items", headers={REQUEST_ID_HEADER: "abc123"})
+        self.assertEqual(response.headers[REQUEST_ID_HEADER], "abc123")
+        self.stop(app)
+        lines = [json.loads(line) for line in target.lines]
+        self.assertEqual(lines[0]["message"], "Logging handler established")
+        self.assertNotIn("request_id", lines[0])
+        listing, summary = lines[1:]
+        self.assertEqual(listing["message"], "Listing 3 items")
+        self.assertEqual(listing["level"], "INFO")
+        self.assertEqual(listing["request_id"], "abc123")
+        self.assertEqual(summary["message"], "GET /items 200")
+        self.assertEqual(summary["status"], 200)
+        self.assertGreater(summary["db_ms"], 0)
+        self.assertGreaterEqual(summary["latency_ms"], summary["db_ms"])
+
+    def test_generated_request_id(self):
+        """It should generate a request id when the client sends none"""
+        app, _ = json_app()
+        first = app.test_client().get("/items").headers[REQUEST_ID_HEADER]
+        second = app.test_client().get("/items").headers[REQUEST_ID_HEADER]
+        self.stop(app)
+        self.assertEqual(len(first), 32)
+        self.assertNotEqual(first, second)
+
+    def test_sampling(self):
+        """It should drop the INFO lines of unsampled requests but keep the summary and warnings"""
+        app, target = json_app(sample_rate=0.0)
+        with app.test_request_context("/items"):
+            app.preprocess_request()
+            app.logger.info("Dropped")
+            app.logger.warning("Kept")
+        app.test_client().get("/items")
+        self.stop(app)
+        messages = [json.loads(line)["message"] for line in target.lines]
+        self.assertEqual(messages, ["Logging handler established", "Kept", "GET /items 200"])
+
+    def test_exception(self):
+        """It should log the traceback of an exception as a field"""
+        app, target = json_app()
+        try:
+            raise ValueError("bad value")
+        except ValueError:
+            app.logger.exception("Failed")
+        self.stop(app)
+        line = json.loads(target.lines[-1])
+        self.assertEqual(line["message"], "Failed")
+        self.assertIn("ValueError: bad value", line["exception"])
+
+    def test_full_queue(self):
+        """It should drop records rather than block when the queue is full"""
+        handler = AsyncHandler([ListHandler()], maxsize=1)
+        handler.start()
+        handler._listener.stop()
+        record = logging.makeLogRecord({"msg": "line"})
+        handler.handle(record)
+        handler.handle(record)
+        self.assertEqual(handler.dropped, 1)
+        handler._listener = None
+        handler.stop()
+
+    def test_batch_queue(self):
+        """It should hand over queued records after the flush interval"""
+        records = BatchQueue(maxsize=10, batch_size=5, interval=0.01)
+        self.assertRaises(queue.Empty, records.get, False)
+        records.put_nowait("first")
+        records.put_nowait("second")
+        self.assertEqual(records.get(), "first")
+        self.assertEqual(records.get(), "second")
+
+    def test_stop_with_full_queue(self):
+        """It should let the stop sentinel into a full queue"""
+        records = BatchQueue(maxsize=1)
+        records.put_nowait("line")
+        self.assertRaises(queue.Full, records.put_nowait, "dropped")
+        records.put_nowait(None)
+        self.assertEqual([records.get(), records.get()], ["line", None])
+
+    def test_failed_statement(self):
+        """It should stop timing a statement that fails"""
+        app, _ = json_app()
+        engine = create_engine("sqlite://")
+        with app.test_request_context("/items"), engine.connect() as connection:
+            app.preprocess_request()
+            self.assertRaises(OperationalError, connection.execute, text("SELECT * FROM missing"))
+            self.assertEqual(connection.info["query_start"], [])
+            self.assertGreater(g.db_time, 0)
+        self.stop(app)
+
+    def test_formatter(self):
+        """It should only add the request fields that a record has"""
+        record = logging.makeLogRecord({"msg": "%s items", "args": (3,), "levelname": "INFO", "db_ms": 1.5})
+        line = json.loads(JsonFormatter().format(record))
+        self.assertEqual(line["message"], "3 items")
+        self.assertEqual(line["db_ms"], 1.5)
+        self.assertNotIn("request_id", line)
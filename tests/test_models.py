@@ -6,8 +6,12 @@ import os
 import logging
 from unittest import TestCase
 from unittest.mock import patch
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
 from wsgi import app
-from service.models import Inventory, Condition, DataValidationError, db
+from service.models import Inventory, InventoryChange, Condition, DataValidationError, DuplicateItemError, db
+from service.models import DatabaseConnectionError
+from service.common.transactions import unit_of_work
 from tests.factories import InventoryFactory
 
 DATABASE_URI = os.getenv(
@@ -226,6 +230,28 @@ class TestInventoryModel(TestCaseBase):
         inventory = Inventory()
         self.assertRaises(DataValidationError, inventory.deserialize, data)
 
+    def test_deserialize_errors(self):
+        """It should report every invalid field of a payload"""
+        data = InventoryFactory().serialize()
+        data.update(quantity=True, condition="__class__")
+        del data["category"]
+        with self.assertRaises(DataValidationError) as context:
+            Inventory().deserialize(data)
+        self.assertEqual(
+            [error["field"] for error in context.exception.errors], ["category", "quantity", "condition"]
+        )
+
+    def test_deserialize_many(self):
+        """It should deserialize a batch or report the errors of each payload"""
+        payloads = [item.serialize() for item in InventoryFactory.build_batch(3)]
+        items = Inventory.deserialize_many(payloads)
+        self.assertEqual([item.inventory_name for item in items], [data["inventory_name"] for data in payloads])
+        payloads[2]["restock_level"] = "ten"
+        with self.assertRaises(DataValidationError) as context:
+            Inventory.deserialize_many(payloads)
+        self.assertEqual(context.exception.errors[0]["index"], 2)
+        self.assertIn("item 2: restock_level", str(context.exception))
+
     def test_deserialize_bad_condition(self):
         """It should not deserialize a bad condition value"""
         test_inventory = InventoryFactory()
@@ -255,6 +281,29 @@ class TestExceptionHandlers(TestCaseBase):
         inventory = InventoryFactory()
         self.assertRaises(DataValidationError, inventory.update)
 
+    def test_create_duplicate(self):
+        """It should not create a second item with the same natural key"""
+        inventory = InventoryFactory()
+        inventory.create()
+        duplicate = InventoryFactory(
+            inventory_name=inventory.inventory_name, category=inventory.category, condition=inventory.condition
+        )
+        self.assertRaises(DuplicateItemError, duplicate.create)
+        other = InventoryFactory()
+        other.create()
+        other = Inventory.find(other.id)
+        other.inventory_name, other.category, other.condition = (
+            inventory.inventory_name, inventory.category, inventory.condition
+        )
+        self.assertRaises(DuplicateItemError, other.update)
+
+    def test_create_integrity_error(self):
+        """It should report other constraint violations as validation errors"""
+        inventory = InventoryFactory(quantity=None)
+        with self.assertRaises(DataValidationError) as context:
+            inventory.create()
+        self.assertNotIsInstance(context.exception, DuplicateItemError)
+
     @patch("service.models.db.session.commit")
     def test_delete_exception(self, exception_mock):
         """It should catch a delete exception"""
@@ -387,3 +436,144 @@ class TestModelQueries(TestCaseBase):
         self.assertEqual(found.count(), count)
         for item in found:
             self.assertEqual(item.restock_level, restock_level)
+
+    def test_count_by_category(self):
+        """It should Count Items by category without loading them"""
+        inventory = InventoryFactory.create_batch(10)
+        for item in inventory:
+            item.create()
+        selected_category = inventory[0].category
+        count = len(
+            [item for item in inventory if item.category == selected_category]
+        )
+        args = {'name': None,
+                'category': selected_category,
+                'quantity': None,
+                'condition': None,
+                'restock_level': None}
+        self.assertEqual(Inventory.count(args), count)
+
+    def test_count_estimate_falls_back(self):
+        """It should run an exact count when no estimate is available"""
+        for item in InventoryFactory.create_batch(3):
+            item.create()
+        args = {'name': None,
+                'category': None,
+                'quantity': None,
+                'condition': None,
+                'restock_level': None}
+        self.assertEqual(Inventory.count(args, estimate_above=1), 3)
+
+    def test_upsert(self):
+        """It should create and update items by natural key in one statement"""
+        existing = InventoryFactory(quantity=1, restock_level=1)
+        existing.create()
+        rows = [
+            dict(existing.to_row(), quantity=5),
+            dict(existing.to_row(), quantity=7, restock_level=9),
+            InventoryFactory(quantity=3).to_row(),
+        ]
+        items = Inventory.upsert(rows)
+        self.assertEqual(len(items), 2)
+        self.assertEqual(items[0]["id"], existing.id)
+        self.assertEqual((items[0]["quantity"], items[0]["restock_level"]), (7, 9))
+        self.assertEqual(items[1]["quantity"], 3)
+        self.assertEqual(len(Inventory.all()), 2)
+        changes = InventoryChange.since(InventoryChange.last_seq() - 2, 10)
+        self.assertEqual([change.operation for change in changes], ["upsert", "upsert"])
+
+    @patch("service.models.db.session.commit")
+    def test_upsert_exception(self, exception_mock):
+        """It should catch an upsert exception"""
+        exception_mock.side_effect = Exception()
+        self.assertRaises(DataValidationError, Inventory.upsert, [InventoryFactory().to_row()])
+
+
+######################################################################
+#  U N I T   O F   W O R K   T E S T   C A S E S
+######################################################################
+class TestUnitOfWork(TestCaseBase):
+    """Unit of Work Tests"""
+
+    def setUp(self):
+        super().setUp()
+        self.commits = []
+        event.listen(db.engine, "commit", self.count_commit)
+
+    def tearDown(self):
+        event.remove(db.engine, "commit", self.count_commit)
+        super().tearDown()
+
+    def count_commit(self, _):
+        """Counts the transactions committed"""
+        self.commits.append(None)
+
+    def test_single_commit(self):
+        """It should commit many writes once at the end of the unit of work"""
+        with unit_of_work():
+            items = InventoryFactory.build_batch(3)
+            for item in items:
+                item.create()
+            items[0].quantity = 99
+            items[0].update()
+            items[1].delete()
+            self.assertEqual(self.commits, [])
+        self.assertEqual(len(self.commits), 1)
+        db.session.expunge_all()
+        self.assertEqual(sorted(item.quantity == 99 for item in Inventory.all()), [False, True])
+
+    def test_commit_per_write(self):
+        """It should keep committing every write outside a unit of work"""
+        for item in InventoryFactory.build_batch(2):
+            item.create()
+        self.assertEqual(len(self.commits), 2)
+
+    def test_partial_failure(self):
+        """It should roll back only the failed write to its savepoint"""
+        existing = InventoryFactory()
+        existing.create()
+        other = InventoryFactory()
+        other.create()
+        taken = existing.serialize()
+        with unit_of_work():
+            self.assertRaises(DuplicateItemError, Inventory().deserialize(taken).create)
+            other.deserialize(dict(other.serialize(), inventory_name=taken["inventory_name"],
+                                   category=taken["category"], condition=taken["condition"]))
+            self.assertRaises(DuplicateItemError, other.update)
+            kept = InventoryFactory()
+            kept.create()
+        name = kept.inventory_name
+        db.session.expunge_all()
+        names = [item.inventory_name for item in Inventory.all()]
+        self.assertEqual(len(names), 3)
+        self.assertIn(name, names)
+
+    def test_rollback_on_exception(self):
+        """It should roll back every write when an exception leaves the unit of work"""
+        with self.assertRaises(ValueError):
+            with unit_of_work() as work:
+                InventoryFactory().create()
+                with unit_of_work() as nested:
+                    self.assertIs(nested, work)
+                    InventoryFactory().create()
+                raise ValueError("stop")
+        self.assertEqual(Inventory.all(), [])
+        self.assertEqual(self.commits, [])
+
+    @patch("retry.api.time.sleep")
+    def test_connection_lost(self, sleep):
+        """It should not retry inside a unit of work and refuse writes after the connection is lost"""
+        def fail(*_):
+            raise OperationalError("SELECT 1", {}, type("DriverError", (Exception,), {"sqlstate": "08006"})())
+
+        with self.assertRaises(DatabaseConnectionError):
+            with unit_of_work():
+                InventoryFactory().create()
+                event.listen(db.engine, "before_cursor_execute", fail)
+                try:
+                    self.assertRaises(DatabaseConnectionError, Inventory.all)
+                finally:
+                    event.remove(db.engine, "before_cursor_execute", fail)
+                InventoryFactory().create()
+        sleep.assert_not_called()
+        self.assertEqual(Inventory.all(), [])
@@ -4,9 +4,11 @@ TestYourResourceModel API Service Test Suite
 import os
 import logging
 from unittest import TestCase
+import msgpack
+import pyarrow
 from wsgi import app
 from service.common import status
-from service.models import Condition, db, Inventory
+from service.models import Condition, db, Inventory, Reservation
 from .factories import InventoryFactory
 
 DATABASE_URI = os.getenv(
@@ -165,9 +167,9 @@ class TestYourResourceService(TestCase):
 
     def test_list_inventory_with_name_filter(self):
         """Test listing inventory with name filter"""
-        test_inventory_1 = InventoryFactory(inventory_name="Item1")
+        test_inventory_1 = InventoryFactory(inventory_name="Item1", category="Fruits")
         test_inventory_2 = InventoryFactory(inventory_name="Item2")
-        test_inventory_3 = InventoryFactory(inventory_name="Item1")
+        test_inventory_3 = InventoryFactory(inventory_name="Item1", category="Electronic")
 
         self.client.post(BASE_URL, json=test_inventory_1.serialize())
         self.client.post(BASE_URL, json=test_inventory_2.serialize())
@@ -234,6 +236,83 @@ class TestYourResourceService(TestCase):
         for item in data:
             self.assertEqual(item["quantity"], 100)
 
+    def test_count_only(self):
+        """It should return only the number of items"""
+        self._create_items(5)
+        response = self.client.get(f"{BASE_URL}?count_only=true")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json(), {"count": 5})
+        self.assertEqual(response.headers["X-Total-Count"], "5")
+
+    def test_count_only_with_filter(self):
+        """It should count only the items matching the filter"""
+        self.client.post(BASE_URL, json=InventoryFactory(category="Category1").serialize())
+        self.client.post(BASE_URL, json=InventoryFactory(category="Category2").serialize())
+        self.client.post(BASE_URL, json=InventoryFactory(category="Category1").serialize())
+        response = self.client.get(f"{BASE_URL}?category=Category1&count_only=true")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get_json()["count"], 2)
+
+    def test_head_item_count(self):
+        """It should return the item count in a header on HEAD"""
+        self._create_items(3)
+        response = self.client.head(BASE_URL)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.headers["X-Total-Count"], "3")
+        self.assertEqual(response.data, b"")
+
+    def test_list_as_msgpack(self):
+        """It should return the list as MessagePack when asked for it"""
+        items = self._create_items(3)
+        response = self.client.get(BASE_URL, headers={"Accept": "application/x-msgpack"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.mimetype, "application/x-msgpack")
+        self.assertIn("Accept", response.vary)
+        data = msgpack.unpackb(response.data)
+        self.assertEqual(sorted(item["id"] for item in data), sorted(item.id for item in items))
+
+    def test_list_as_arrow(self):
+        """It should return the list as an Arrow stream when asked for it"""
+        self.client.post(BASE_URL, json=InventoryFactory(category="Category1").serialize())
+        self.client.post(BASE_URL, json=InventoryFactory(category="Category2").serialize())
+        response = self.client.get(
+            f"{BASE_URL}?category=Category1", headers={"Accept": "application/vnd.apache.arrow.stream"}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        table = pyarrow.ipc.open_stream(response.data).read_all()
+        self.assertEqual(table.num_rows, 1)
+        self.assertEqual(table.column("category").to_pylist(), ["Category1"])
+        self.assertIn(table.column("condition").to_pylist()[0], ["NEW", "OPENED", "USED"])
+
+    def test_formats_have_same_fields(self):
+        """It should return the same fields and values as JSON, MessagePack and Arrow"""
+        item = InventoryFactory(quantity=5)
+        item.create()
+        Reservation.reserve(item.id, 2, 60)
+        rows = self.client.get(BASE_URL).get_json()
+        packed = msgpack.unpackb(self.client.get(BASE_URL, headers={"Accept": "application/x-msgpack"}).data)
+        response = self.client.get(BASE_URL, headers={"Accept": "application/vnd.apache.arrow.stream"})
+        table = pyarrow.ipc.open_stream(response.data).read_all()
+        self.assertEqual(set(table.column_names), set(rows[0]))
+        self.assertEqual(set(packed[0]), set(rows[0]))
+        self.assertEqual(table.to_pylist(), rows)
+        self.assertEqual(packed, rows)
+        self.assertEqual((rows[0]["reserved"], rows[0]["available"]), (2, 3))
+
+    def test_empty_list_as_arrow(self):
+        """It should return an empty Arrow stream when nothing matches"""
+        response = self.client.get(BASE_URL, headers={"Accept": "application/vnd.apache.arrow.stream"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(pyarrow.ipc.open_stream(response.data).read_all().num_rows, 0)
+
+    def test_list_defaults_to_json(self):
+        """It should return JSON when the client accepts anything"""
+        self._create_items(1)
+        response = self.client.get(BASE_URL, headers={"Accept": "*/*"})
+        self.assertEqual(response.mimetype, "application/json")
+        self.assertIn("Accept", response.vary)
+        self.assertEqual(len(response.get_json()), 1)
+
     def test_create_inventory(self):
         """It should Create a new item"""
         test_inventory = InventoryFactory()
@@ -313,10 +392,68 @@ class TestYourResourceService(TestCase):
         resp = self.client.put(f"{BASE_URL}/0/restock", content_type="application/json")
         self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
 
+    def test_upsert_item(self):
+        """It should create an item and then update it by its natural key"""
+        payload = InventoryFactory(quantity=5).serialize()
+        del payload["id"]
+        created = self.client.post(f"{BASE_URL}/upsert", json=payload)
+        self.assertEqual(created.status_code, status.HTTP_200_OK)
+        updated = self.client.post(f"{BASE_URL}/upsert", json=dict(payload, quantity=8))
+        self.assertEqual(updated.get_json()["id"], created.get_json()["id"])
+        self.assertEqual(updated.get_json()["quantity"], 8)
+
+    def test_upsert_batch(self):
+        """It should upsert a list of items in one request"""
+        existing = self._create_items(1)[0]
+        payload = [dict(existing.serialize(), quantity=0), InventoryFactory().serialize()]
+        response = self.client.post(f"{BASE_URL}/upsert", json=payload)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = response.get_json()
+        self.assertEqual(len(data), 2)
+        self.assertEqual((data[0]["id"], data[0]["quantity"]), (existing.id, 0))
+        self.assertEqual(len(self.client.get(BASE_URL).get_json()), 2)
+
+    def test_upsert_bad_requests(self):
+        """It should not upsert invalid items or batches of the wrong size"""
+        payload = InventoryFactory().serialize()
+        response = self.client.post(f"{BASE_URL}/upsert", json=[payload, dict(payload, condition="BROKEN")])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(
+            response.get_json()["errors"],
+            [{"field": "condition", "message": "must be one of NEW, OPENED, USED", "index": 1}],
+        )
+        response = self.client.post(f"{BASE_URL}/upsert", json=[])
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        app.config["UPSERT_MAX_ITEMS"] = 1
+        response = self.client.post(f"{BASE_URL}/upsert", json=[payload, payload])
+        app.config["UPSERT_MAX_ITEMS"] = 1000
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(len(self.client.get(BASE_URL).get_json()), 0)
+
+    def test_delete_all_items(self):
+        """It should delete every item only while under test"""
+        self._create_items(3)
+        app.config["TESTING"] = False
+        response = self.client.delete(BASE_URL)
+        app.config["TESTING"] = True
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(len(self.client.get(BASE_URL).get_json()), 3)
+        response = self.client.delete(BASE_URL)
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(len(self.client.get(BASE_URL).get_json()), 0)
+
     ######################################################################
     #  T E S T   S A D   P A T H S
     ######################################################################
 
+    def test_create_duplicate_inventory(self):
+        """It should not Create an Inventory with an existing natural key"""
+        payload = InventoryFactory().serialize()
+        self.client.post(BASE_URL, json=payload)
+        response = self.client.post(BASE_URL, json=payload)
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertIn("already exists", response.get_json()["message"])
+
     def test_create_inventory_no_content_type(self):
         """It should not Create a Inventory with no content type"""
         response = self.client.post(BASE_URL)
@@ -0,0 +1,36 @@
+"""
+Test cases for application startup
+"""
+from unittest import TestCase
+from unittest.mock import patch
+from wsgi import app
+from service import init_db
+
+
+class TestStartup(TestCase):
+    """Application Startup Tests"""
+
+    def tearDown(self):
+        app.config["DB_CREATE_ON_STARTUP"] = True
+
+    @patch("service.migrations.upgrade")
+    def test_create_on_startup(self, upgrade_mock):
+        """It should create the tables and apply pending migrations on startup by default"""
+        upgrade_mock.return_value = [6, 7]
+        init_db(app)
+        upgrade_mock.assert_called_once_with(None, "5s", 5000)
+
+    @patch("service.migrations.upgrade")
+    def test_skip_create_on_startup(self, upgrade_mock):
+        """It should not touch the database when creation is turned off"""
+        app.config["DB_CREATE_ON_STARTUP"] = False
+        init_db(app)
+        upgrade_mock.assert_not_called()
+
+    @patch("service.migrations.upgrade")
+    def test_create_failure(self, upgrade_mock):
+        """It should exit with code 4 when the tables cannot be created"""
+        upgrade_mock.side_effect = RuntimeError("no database")
+        with self.assertRaises(SystemExit) as context:
+            init_db(app)
+        self.assertEqual(context.exception.code, 4)
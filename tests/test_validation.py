@@ -0,0 +1,54 @@
+"""
+Test cases for the Payload Validation
+"""
+from unittest import TestCase
+from service.common.validation import Schema, Field, describe
+
+SCHEMA = Schema(
+    Field("name", str),
+    Field("count", int),
+    Field("color", str, ["RED", "BLUE"]),
+    Field("note", str, required=False),
+)
+
+
+######################################################################
+#  V A L I D A T I O N   T E S T   C A S E S
+######################################################################
+class TestValidation(TestCase):
+    """Payload Validation Tests"""
+
+    def test_valid(self):
+        """It should accept a valid payload with or without optional fields"""
+        self.assertEqual(SCHEMA.validate({"name": "a", "count": 1, "color": "RED"}), [])
+        self.assertEqual(SCHEMA.validate({"name": "a", "count": 1, "color": "RED", "note": "n"}), [])
+
+    def test_every_error(self):
+        """It should report every invalid field, not only the first"""
+        errors = SCHEMA.validate({"count": True, "color": "GREEN", "note": 5})
+        self.assertEqual(
+            errors,
+            [
+                {"field": "name", "message": "is required"},
+                {"field": "count", "message": "must be of type int"},
+                {"field": "color", "message": "must be one of BLUE, RED"},
+                {"field": "note", "message": "must be of type str"},
+            ],
+        )
+
+    def test_not_an_object(self):
+        """It should reject a payload that is not an object"""
+        self.assertEqual(SCHEMA.validate(["name"]), [{"field": None, "message": "must be an object"}])
+
+    def test_validate_many(self):
+        """It should validate a batch in one pass and index its errors"""
+        payloads = [{"name": "a", "count": 1, "color": "RED"}, {"name": "b", "count": "2", "color": "RED"}, None]
+        errors = SCHEMA.validate_many(payloads)
+        self.assertEqual(
+            errors,
+            [
+                {"field": "count", "message": "must be of type int", "index": 1},
+                {"field": None, "message": "must be an object", "index": 2},
+            ],
+        )
+        self.assertEqual(describe(errors), "item 1: count must be of type int; item 2: must be an object")